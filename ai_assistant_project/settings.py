@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 
 from django.core.exceptions import ImproperlyConfigured
@@ -16,8 +17,24 @@ if not SECRET_KEY:
     raise ImproperlyConfigured("DJANGO_SECRET_KEY environment variable must be set.")
 
 DEBUG = os.environ.get('DJANGO_DEBUG', '0') == '1'
+# Under `manage.py test` a few defaults below differ (static storage,
+# request log level).
+TESTING = sys.argv[1:2] == ['test']
 ALLOWED_HOSTS = [host for host in os.environ.get('DJANGO_ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',') if host]
 
+# Static files: with the manifest storage (default outside DEBUG and tests)
+# collectstatic writes content-hashed copies plus .gz/.br variants, which
+# WhiteNoise serves with a one-year immutable Cache-Control. Requires running
+# collectstatic; without it every page linking a static file fails with 500.
+STATIC_MANIFEST = os.environ.get('DJANGO_STATIC_MANIFEST', '0' if DEBUG or TESTING else '1') == '1'
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage' if STATIC_MANIFEST
+        else 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -31,6 +48,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'backend.metrics.RequestMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -58,12 +76,21 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'ai_assistant_project.wsgi.application'
+ASGI_APPLICATION = 'ai_assistant_project.asgi.application'
+
+# Serve the chat endpoints with the native async views (backend/async_views.py).
+# Only worth enabling when running under ASGI (uvicorn), see README.
+CHAT_ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_CHAT', '0') == '1'
+
+# Persistent connections don't play well with ASGI (each request may run its
+# ORM calls on a different thread) - set DJANGO_CONN_MAX_AGE=0 there.
+CONN_MAX_AGE = int(os.environ.get('DJANGO_CONN_MAX_AGE', '600'))
 
 default_db_url = os.environ.get('DATABASE_URL')
 if default_db_url:
     import dj_database_url
     DATABASES = {
-        'default': dj_database_url.parse(default_db_url, conn_max_age=600, ssl_require=not DEBUG),
+        'default': dj_database_url.parse(default_db_url, conn_max_age=CONN_MAX_AGE, ssl_require=not DEBUG),
     }
 else:
     DATABASES = {
@@ -76,6 +103,180 @@ else:
             'PORT': os.environ.get('DJANGO_DB_PORT', ''),
         }
     }
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        # Writers take the lock at BEGIN and wait for it; a deferred
+        # transaction upgrading to a write fails at once with "database is
+        # locked" when another one is writing (e.g. the FTS index triggers).
+        # The option needs Django 5.1 (requirements.txt).
+        DATABASES['default']['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+
+# Shared cache (character catalog, completion cache, ...). The default is
+# per-process memory; point it at Redis/Memcached when running several
+# workers, e.g. DJANGO_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# DJANGO_CACHE_LOCATION=redis://127.0.0.1:6379/1
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+# Upper bound on how long another worker may serve a stale landing page
+# with a per-process cache; with a shared cache edits show up immediately.
+CHARACTER_CATALOG_TIMEOUT = int(os.environ.get('CHARACTER_CATALOG_TIMEOUT', '300'))
+
+# Sessions only hold the visitor's conversation ids (and staff logins) and
+# are written only when one changes. cached_db reads them from the cache
+# above; signed_cookies keeps them out of the database altogether, but then
+# a copied cookie stays valid until SESSION_COOKIE_AGE runs out and logout
+# can't revoke it (see README).
+SESSION_ENGINE = os.environ.get('DJANGO_SESSION_ENGINE', 'django.contrib.sessions.backends.db')
+
+# Local copies of external Character.avatar_url images (backend/avatar_proxy.py)
+AVATAR_PROXY_REFRESH = int(os.environ.get('AVATAR_PROXY_REFRESH', '86400'))
+AVATAR_PROXY_TIMEOUT = float(os.environ.get('AVATAR_PROXY_TIMEOUT', '5'))
+AVATAR_PROXY_MAX_BYTES = int(os.environ.get('AVATAR_PROXY_MAX_BYTES', str(5 * 1024 * 1024)))
+
+# OpenAI client pool (backend/llm.py), one per worker process
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '2'))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', '30'))
+
+# LLM backends (backend/llm_backends.py). A chat turn tries the character's
+# route (Character.llm_backends, else LLM_DEFAULT_ROUTE) fastest first and
+# falls back to the next backend on timeouts and errors. LOCAL_LLM_BASE_URL
+# adds an OpenAI-compatible local server (llama.cpp, vLLM), e.g.
+# http://127.0.0.1:8080/v1; LLM_FAKE=1 adds the in-process fake backend.
+LLM_BACKENDS = {
+    'openai': {
+        'BACKEND': 'backend.llm_backends.OpenAIBackend',
+        'MODEL': os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo'),
+        'MAX_CONCURRENCY': int(os.environ.get('OPENAI_MAX_CONCURRENCY', '64')),
+    },
+}
+if os.environ.get('LOCAL_LLM_BASE_URL'):
+    LLM_BACKENDS['local'] = {
+        'BACKEND': 'backend.llm_backends.OpenAIBackend',
+        'BASE_URL': os.environ['LOCAL_LLM_BASE_URL'],
+        'API_KEY': os.environ.get('LOCAL_LLM_API_KEY', 'local'),
+        'MODEL': os.environ.get('LOCAL_LLM_MODEL', 'local'),
+        'TIMEOUT': float(os.environ.get('LOCAL_LLM_TIMEOUT', '20')),
+        'MAX_RETRIES': 0,
+        'MAX_CONCURRENCY': int(os.environ.get('LOCAL_LLM_MAX_CONCURRENCY', '4')),
+    }
+if os.environ.get('LLM_FAKE', '0') == '1':
+    LLM_BACKENDS['fake'] = {
+        'BACKEND': 'backend.llm_backends.FakeBackend',
+        'LATENCY': float(os.environ.get('LLM_FAKE_LATENCY', '0')),
+        'TOKEN_RATE': float(os.environ.get('LLM_FAKE_TOKEN_RATE', '0')),
+        'REPLY_TOKENS': int(os.environ.get('LLM_FAKE_REPLY_TOKENS', '40')),
+        'MAX_CONCURRENCY': 1000,
+    }
+LLM_DEFAULT_ROUTE = [name for name in os.environ.get('LLM_DEFAULT_ROUTE', 'openai').split(',') if name]
+# Seconds a failed backend is only tried after the others.
+LLM_FALLBACK_COOLDOWN = float(os.environ.get('LLM_FALLBACK_COOLDOWN', '30'))
+# Seconds an attempt may wait for the response (or for each streamed chunk)
+# while the route has another backend to fall back to; such attempts are
+# not retried. The last backend keeps its own TIMEOUT and retries. 0 = off.
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get('LLM_ATTEMPT_TIMEOUT', '15'))
+
+# Prompt assembly (backend/context.py): history is packed newest-first until
+# the token budget is spent; Character.context_token_budget overrides it.
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', '3000'))
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get('CHAT_HISTORY_MAX_MESSAGES', '50'))
+# Messages rendered with the chat page; older ones load on scroll-up.
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '30'))
+# Results per page of the staff message search (/admin/search/).
+CHAT_SEARCH_PAGE_SIZE = int(os.environ.get('CHAT_SEARCH_PAGE_SIZE', '50'))
+# Dotted path to a callable(str) -> int; backend.context.tiktoken_tokens
+# gives exact counts when tiktoken is installed.
+CHAT_TOKEN_COUNTER = os.environ.get('CHAT_TOKEN_COUNTER', 'backend.context.estimate_tokens')
+
+# Rolling summaries (backend/summarization.py): once KEEP_RECENT + TRIGGER
+# messages follow the summary, all but the newest KEEP_RECENT are folded in.
+# CHAT_SUMMARY_WORKERS=0 leaves it to `manage.py summarize_conversations`.
+CHAT_SUMMARY_KEEP_RECENT = int(os.environ.get('CHAT_SUMMARY_KEEP_RECENT', '8'))
+CHAT_SUMMARY_TRIGGER_MESSAGES = int(os.environ.get('CHAT_SUMMARY_TRIGGER_MESSAGES', '12'))
+CHAT_SUMMARY_WORKERS = int(os.environ.get('CHAT_SUMMARY_WORKERS', '2'))
+CHAT_SUMMARY_CHUNK_TOKENS = int(os.environ.get('CHAT_SUMMARY_CHUNK_TOKENS', '2000'))
+CHAT_SUMMARY_MAX_WORDS = int(os.environ.get('CHAT_SUMMARY_MAX_WORDS', '200'))
+
+# Completion cache (backend/completion_cache.py). BACKEND is
+# LocMemCompletionCache (per process) or DjangoCompletionCache (cache alias
+# from ALIAS, shared across workers); empty disables caching. MAX_ENTRIES
+# (default 1000) bounds LocMemCompletionCache only; the Django backend
+# rejects it, its size is up to the alias's own cache settings.
+CHAT_COMPLETION_CACHE = {
+    'BACKEND': os.environ.get('CHAT_COMPLETION_CACHE_BACKEND', 'backend.completion_cache.LocMemCompletionCache'),
+    'TIMEOUT': int(os.environ.get('CHAT_COMPLETION_CACHE_TIMEOUT', '3600')),
+    'ALIAS': os.environ.get('CHAT_COMPLETION_CACHE_ALIAS', 'default'),
+}
+if os.environ.get('CHAT_COMPLETION_CACHE_MAX_ENTRIES'):
+    CHAT_COMPLETION_CACHE['MAX_ENTRIES'] = int(os.environ['CHAT_COMPLETION_CACHE_MAX_ENTRIES'])
+
+# Job mode (backend/jobs.py): /api/chat/ enqueues the completion and returns
+# a job id; `manage.py run_chat_worker` processes the queue.
+CHAT_JOB_MODE = os.environ.get('DJANGO_CHAT_JOBS', '0') == '1'
+CHAT_JOB_CONCURRENCY = int(os.environ.get('CHAT_JOB_CONCURRENCY', '8'))
+CHAT_JOB_CHARACTER_RATE_LIMIT = int(os.environ.get('CHAT_JOB_CHARACTER_RATE_LIMIT', '0'))  # per minute, 0 = off
+CHAT_JOB_TIMEOUT = int(os.environ.get('CHAT_JOB_TIMEOUT', '300'))
+CHAT_JOB_MAX_ATTEMPTS = int(os.environ.get('CHAT_JOB_MAX_ATTEMPTS', '3'))
+
+# Admission control of chat POSTs (backend/admission.py): token buckets
+# per client IP and per character as (requests per minute, burst), and a
+# cap on chat requests in flight; 0 turns a limit off. Over a limit the
+# request gets 429 with Retry-After before any DB write or LLM call.
+# CHAT_CLIENT_IP_HEADER is the META key of the client address set by the
+# reverse proxy, e.g. HTTP_X_REAL_IP. Without it the client is REMOTE_ADDR,
+# behind a proxy the same for every user, so the per-client limit is off
+# unless CHAT_RATE_CLIENT_PER_MINUTE is set (clients connecting directly).
+CHAT_CLIENT_IP_HEADER = os.environ.get('CHAT_CLIENT_IP_HEADER', '')
+CHAT_RATE_CLIENT = (float(os.environ.get('CHAT_RATE_CLIENT_PER_MINUTE', '20' if CHAT_CLIENT_IP_HEADER else '0')),
+                    int(os.environ.get('CHAT_RATE_CLIENT_BURST', '5')))
+CHAT_RATE_CHARACTER = (float(os.environ.get('CHAT_RATE_CHARACTER_PER_MINUTE', '0')),
+                       int(os.environ.get('CHAT_RATE_CHARACTER_BURST', '50')))
+CHAT_MAX_IN_FLIGHT = int(os.environ.get('CHAT_MAX_IN_FLIGHT', '64'))
+CHAT_IN_FLIGHT_TTL = int(os.environ.get('CHAT_IN_FLIGHT_TTL', '300'))
+CHAT_ADMISSION_CACHE = os.environ.get('CHAT_ADMISSION_CACHE', 'default')
+
+# Retention (backend/retention.py, `manage.py apply_retention` from cron):
+# greeting-only conversations are deleted after EMPTY_HOURS, conversations
+# without messages for ARCHIVE_DAYS go to gzipped JSONL in CHAT_ARCHIVE_DIR.
+# 0 turns a policy off.
+CHAT_RETENTION_EMPTY_HOURS = int(os.environ.get('CHAT_RETENTION_EMPTY_HOURS', '24'))
+CHAT_RETENTION_ARCHIVE_DAYS = int(os.environ.get('CHAT_RETENTION_ARCHIVE_DAYS', '0'))
+CHAT_RETENTION_BATCH_SIZE = int(os.environ.get('CHAT_RETENTION_BATCH_SIZE', '200'))
+CHAT_ARCHIVE_DIR = os.environ.get('CHAT_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+
+# Request metrics (backend/metrics.py): Server-Timing headers, one JSON log
+# line per request and Prometheus histograms at /admin/metrics/ (staff, or
+# "Authorization: Bearer $METRICS_TOKEN" for the scraper). Per process.
+REQUEST_METRICS = os.environ.get('DJANGO_REQUEST_METRICS', '1') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # Errors of LLM calls, jobs, summaries and avatar fetches.
+        'backend': {
+            'handlers': ['console'],
+            'level': os.environ.get('BACKEND_LOG_LEVEL', 'WARNING'),
+        },
+        'backend.metrics': {
+            'handlers': ['console'],
+            # One line per request would drown the test output.
+            'level': os.environ.get('REQUEST_METRICS_LOG_LEVEL', 'WARNING' if TESTING else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',},
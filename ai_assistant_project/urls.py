@@ -4,8 +4,10 @@ from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    # backend.urls first: its staff pages live under admin/ and would
+    # otherwise be swallowed by the admin site's catch-all view.
     path('', include('backend.urls')),
+    path('admin/', admin.site.urls),
 ]
 
 if settings.DEBUG:
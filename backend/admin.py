@@ -1,12 +1,13 @@
 from django.contrib import admin
 
-from .models import Character
+from .models import Character, Conversation
 
 
 @admin.register(Character)
 class CharacterAdmin(admin.ModelAdmin):
-    list_display = ("name",)
+    list_display = ("name", "conversation_count", "message_count", "last_message_at")
     search_fields = ("name",)
+    readonly_fields = Character.STATS_FIELDS + ("prompt_token_count", "prompt_version")
     fieldsets = (
         (None, {
             "fields": ("name", "header_description", "short_description", "greeting"),
@@ -14,4 +15,24 @@ class CharacterAdmin(admin.ModelAdmin):
         ("Treść i wygląd", {
             "fields": ("description", "avatar", "avatar_url"),
         }),
+        ("Kontekst rozmowy", {
+            "fields": ("context_token_budget", "llm_backends", "prompt_token_count", "prompt_version"),
+        }),
+        ("Statystyki", {
+            "fields": Character.STATS_FIELDS,
+        }),
     )
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    # Wszystko z liczników na Conversation, bez zliczania tabeli wiadomości.
+    list_display = ("id", "character", "created_at", "message_count", "user_message_count", "token_total", "last_message_at")
+    list_filter = ("character",)
+    list_select_related = ("character",)
+    list_per_page = 50
+    show_full_result_count = False
+    ordering = ("-id",)
+    raw_id_fields = ("character",)
+    readonly_fields = ("created_at", "summary_until", "summary_until_id", "summary_token_count") + Conversation.STATS_FIELDS
+    fields = ("character", "created_at") + Conversation.STATS_FIELDS + ("summary", "summary_until", "summary_until_id", "summary_token_count")
@@ -0,0 +1,215 @@
+"""
+Admission control in front of the chat endpoints that call the LLM.
+
+A chat POST is checked before the view touches the database:
+
+* token bucket per client IP (``CHAT_RATE_CLIENT``) and per character
+  (``CHAT_RATE_CHARACTER``), each ``(per_minute, burst)``,
+* at most ``CHAT_MAX_IN_FLIGHT`` chat requests at once across all workers
+  (a streamed answer holds its slot until the stream ends).
+
+A rejected request gets 429 with ``Retry-After`` straight away. The state
+lives in the ``CHAT_ADMISSION_CACHE`` cache alias, so workers share it
+when that cache does (Redis/Memcached); with the default per-process
+memory cache every worker has its own limits. Buckets are GCRA (one
+timestamp per key) read and written without a lock, so concurrent requests
+may exceed a limit by a few; the in-flight counter uses atomic ``incr``.
+
+The client is its IP, not the session: a session cookie costs nothing to
+drop or make up. Behind a reverse proxy set ``CHAT_CLIENT_IP_HEADER`` to
+the header it fills in (e.g. ``HTTP_X_REAL_IP``); the settings leave the
+per-client limit off by default until it is set.
+"""
+
+import json
+import math
+import time
+from functools import wraps
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+
+from . import metrics
+
+
+REJECTED_MESSAGE = 'Zbyt wiele zapytań, spróbuj ponownie za chwilę'
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _cache():
+    return caches[getattr(settings, 'CHAT_ADMISSION_CACHE', 'default')]
+
+
+def client_ip(request) -> str:
+    header = getattr(settings, 'CHAT_CLIENT_IP_HEADER', '')
+    if header and request.META.get(header):
+        # The proxy appends the address it saw: the last entry is the one to trust.
+        return request.META[header].split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def take_token(key: str, per_minute: float, burst: int) -> Optional[float]:
+    """Spend a token of the bucket ``key``; ``None`` when one was left, else
+    the seconds until the next one. ``per_minute`` 0 means no limit."""
+    if not per_minute:
+        return None
+    cache = _cache()
+    interval = 60.0 / per_minute
+    tolerance = interval * (max(burst, 1) - 1)
+    now = time.time()
+    arrival = max(cache.get(key) or now, now)
+    if arrival - now > tolerance:
+        return arrival - tolerance - now
+    cache.set(key, arrival + interval, timeout=math.ceil(arrival + interval - now))
+    return None
+
+
+class Slot:
+    """A place among the in-flight chat requests; release exactly once."""
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+
+    def release(self) -> None:
+        if self.key is None:
+            return
+        key, self.key = self.key, None
+        try:
+            if _cache().decr(key) < 0:
+                # The counter expired and restarted under running requests.
+                _cache().set(key, 0, timeout=getattr(settings, 'CHAT_IN_FLIGHT_TTL', 300))
+        except ValueError:  # expired meanwhile
+            pass
+
+
+def acquire_slot() -> Slot:
+    limit = getattr(settings, 'CHAT_MAX_IN_FLIGHT', 0)
+    if not limit:
+        return Slot(None)
+    cache = _cache()
+    key = 'admission:in_flight'
+    ttl = getattr(settings, 'CHAT_IN_FLIGHT_TTL', 300)
+    # The key expires so that slots of killed workers are not lost forever,
+    # but only after ``ttl`` seconds without a new request: incr() keeps the
+    # expiry set by add(), so each one pushes it back. Otherwise the count
+    # would restart at 0 under steady load, with requests still in flight.
+    cache.add(key, 0, timeout=ttl)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=ttl)
+        count = cache.incr(key)
+    cache.touch(key, ttl)
+    slot = Slot(key)
+    if count > limit:
+        slot.release()
+        raise Rejected('in_flight', getattr(settings, 'CHAT_IN_FLIGHT_RETRY_AFTER', 1))
+    return slot
+
+
+def admit(request, character_id) -> Slot:
+    """Check the limits for a chat request; raises ``Rejected``."""
+    client_rate, client_burst = getattr(settings, 'CHAT_RATE_CLIENT', (0, 0))
+    wait = take_token(f'admission:client:{client_ip(request)}', client_rate, client_burst)
+    if wait is not None:
+        raise Rejected('client', wait)
+    if character_id is not None:
+        character_rate, character_burst = getattr(settings, 'CHAT_RATE_CHARACTER', (0, 0))
+        wait = take_token(f'admission:character:{character_id}', character_rate, character_burst)
+        if wait is not None:
+            raise Rejected('character', wait)
+    return acquire_slot()
+
+
+def _character_id(request) -> Optional[str]:
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return None
+        character_id = data.get('character_id') if isinstance(data, dict) else None
+    else:
+        character_id = request.POST.get('character_id')
+    # Only used in a cache key: anything but digits is dropped.
+    return str(character_id) if str(character_id).isdigit() else None
+
+
+def _rejected_response(rejected: Rejected, api: bool) -> HttpResponse:
+    metrics.ADMISSION_REJECTED.inc(reason=rejected.reason)
+    if api:
+        response = JsonResponse({'error': REJECTED_MESSAGE}, status=429)
+    else:
+        response = HttpResponse(REJECTED_MESSAGE, status=429, content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(max(1, math.ceil(rejected.retry_after)))
+    return response
+
+
+def _release_after_stream(response, slot: Slot):
+    if response.is_async:
+        async def content(chunks=response.streaming_content):
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await sync_to_async(slot.release)()
+    else:
+        def content(chunks=response.streaming_content):
+            try:
+                yield from chunks
+            finally:
+                slot.release()
+    response.streaming_content = content()
+    return response
+
+
+def limit_chat(api: bool = True):
+    """View decorator: admission control for POST requests (sync or async
+    views). ``api`` picks a JSON or a plain text 429 body."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if request.method != 'POST':
+                    return await view(request, *args, **kwargs)
+                try:
+                    slot = await sync_to_async(admit)(request, _character_id(request))
+                except Rejected as e:
+                    return _rejected_response(e, api)
+                try:
+                    response = await view(request, *args, **kwargs)
+                except BaseException:
+                    await sync_to_async(slot.release)()
+                    raise
+                if response.streaming:
+                    return _release_after_stream(response, slot)
+                await sync_to_async(slot.release)()
+                return response
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if request.method != 'POST':
+                    return view(request, *args, **kwargs)
+                try:
+                    slot = admit(request, _character_id(request))
+                except Rejected as e:
+                    return _rejected_response(e, api)
+                try:
+                    response = view(request, *args, **kwargs)
+                except BaseException:
+                    slot.release()
+                    raise
+                if response.streaming:
+                    return _release_after_stream(response, slot)
+                slot.release()
+                return response
+        return wrapper
+    return decorator
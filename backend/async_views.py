@@ -0,0 +1,226 @@
+"""
+Native async counterparts of the chat views.
+
+Used instead of the sync views when ``CHAT_ASYNC_VIEWS`` is enabled and the
+project is served through ``ai_assistant_project.asgi``. An in-flight
+completion then only holds an event-loop task, not a whole worker.
+"""
+
+import logging
+from typing import AsyncIterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import aget_object_or_404, render
+from django.utils.timezone import now
+from django.views.decorators.http import require_GET, require_POST
+
+from . import admission, chat, completion_cache, history, jobs, llm_backends, metrics
+from .forms import MessageForm
+from .models import Character, CompletionJob, Conversation, Message
+from .views import (
+    ChatRequestError,
+    _authorize_conversation,
+    _chat_context,
+    _conversation_session_key,
+    _enqueue_completion,
+    _find_conversation,
+    _greeting_preview,
+    _parse_chat_api_payload,
+    _parse_history_request,
+    _parse_id,
+    _sse_event,
+    _sse_response,
+    _with_conversation,
+)
+
+
+logger = logging.getLogger(__name__)
+
+async def _session_get(request, key: str):
+    # The DB-backed session loads lazily, so the first access must not run
+    # on the event loop.
+    return await sync_to_async(request.session.get)(key)
+
+
+async def _session_set(request, key: str, value) -> None:
+    await sync_to_async(request.session.__setitem__)(key, value)
+
+
+async def _create_greeting(conversation: Conversation, character: Character) -> None:
+    greeting_text = character.greeting or character.header_description
+    if greeting_text:
+        await Message.objects.acreate(
+            conversation=conversation,
+            is_user=False,
+            content=greeting_text,
+        )
+
+
+_afind_conversation = sync_to_async(_find_conversation)
+
+
+async def _load_chat(request, character_id, conversation_id=None) -> Tuple[Character, Optional[Conversation]]:
+    character_id = _parse_id(character_id)
+    if character_id is None:
+        raise Http404
+    session_id = await _session_get(request, _conversation_session_key(character_id))
+    conversation = await _afind_conversation(character_id, conversation_id, session_id)
+    if conversation is None:
+        return await aget_object_or_404(Character, id=character_id), None
+    if conversation.id != _parse_id(session_id):
+        await _session_set(request, _conversation_session_key(character_id), conversation.id)
+    return conversation.character, conversation
+
+
+async def _start_conversation(request, character: Character) -> Conversation:
+    conversation = await Conversation.objects.acreate(character=character)
+    await _create_greeting(conversation, character)
+    await _session_set(request, _conversation_session_key(character.id), conversation.id)
+    return conversation
+
+
+async def _render_chat(request, character: Character, conversation: Optional[Conversation], **extra):
+    # The page is fetched up front; the template must not hit the ORM from
+    # the event loop.
+    if conversation is None:
+        messages, history_cursor = _greeting_preview(character), None
+    else:
+        messages, history_cursor = await sync_to_async(history.history_page)(conversation.id)
+    template_context = _chat_context(character, conversation, messages, history_cursor)
+    template_context.update(extra)
+    with metrics.rendering():
+        return render(request, 'chat.html', template_context)
+
+
+@admission.limit_chat(api=False)
+async def chat_view(request):
+    if request.method == 'POST':
+        character, conversation = await _load_chat(
+            request, request.POST.get('character_id'), request.POST.get('conversation_id'),
+        )
+
+        form = MessageForm(request.POST)
+        if form.is_valid():
+            if conversation is None:
+                conversation = await _start_conversation(request, character)
+            user_message = form.save(commit=False)
+            user_message.conversation = conversation
+            user_message.is_user = True
+
+            payload = await chat.abuild_message_payload(conversation, character, user_message)
+            ai_response = await chat.acomplete(character, payload, "Wystąpił błąd podczas komunikacji z GPT.")
+            await chat.asave_turn(user_message, ai_response)
+
+        return await _render_chat(request, character, conversation)
+
+    character, conversation = await _load_chat(request, request.GET.get('character_id'))
+    return await _render_chat(request, character, conversation, timestamp=now().timestamp())
+
+
+async def _parse_chat_api_request(request) -> Tuple[Character, Conversation, Message]:
+    character_id, conversation_id, user_text = _parse_chat_api_payload(request.body)
+
+    session_id = await _session_get(request, _conversation_session_key(character_id))
+    if conversation_id is None:
+        conversation = await _afind_conversation(character_id, session_id)
+        if conversation is None:
+            character = await aget_object_or_404(Character, id=character_id)
+            conversation = await _start_conversation(request, character)
+    else:
+        _authorize_conversation(session_id, conversation_id)
+        conversation = await _afind_conversation(character_id, conversation_id)
+        if conversation is None:
+            raise Http404
+
+    user_message = Message(conversation=conversation, is_user=True, content=user_text)
+    return conversation.character, conversation, user_message
+
+
+@require_POST
+@admission.limit_chat()
+async def chat_api_view(request):
+    try:
+        character, conversation, user_message = await _parse_chat_api_request(request)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+
+    if jobs.job_mode_enabled():
+        job = await sync_to_async(_enqueue_completion)(user_message, character)
+        return _with_conversation(JsonResponse(jobs.serialize(job), status=202), conversation)
+
+    payload = await chat.abuild_message_payload(conversation, character, user_message)
+    ai_text = await chat.acomplete(character, payload, "Wystąpił błąd po stronie serwera.")
+    await chat.asave_turn(user_message, ai_text)
+
+    return _with_conversation(JsonResponse({'response': ai_text}), conversation)
+
+
+@require_GET
+async def chat_job_api_view(request, job_id: int):
+    job = await aget_object_or_404(CompletionJob.objects.select_related('response'), id=job_id)
+    session_key = _conversation_session_key(job.character_id)
+    try:
+        _authorize_conversation(await _session_get(request, session_key), job.conversation_id)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    return JsonResponse(jobs.serialize(job))
+
+
+@require_GET
+async def chat_history_api_view(request):
+    try:
+        character_id, conversation_id, before = _parse_history_request(request)
+        session_key = _conversation_session_key(character_id)
+        _authorize_conversation(await _session_get(request, session_key), conversation_id)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+
+    messages, cursor = await sync_to_async(history.history_page)(conversation_id, before)
+    return JsonResponse({
+        'messages': [history.serialize(msg) for msg in messages],
+        'next_cursor': cursor,
+    })
+
+
+async def _stream_completion(character: Character, user_message: Message, payload: List[dict]) -> AsyncIterator[str]:
+    cached = await completion_cache.alookup(character, payload)
+    if cached is not None:
+        metrics.record_cache_hit()
+        await chat.asave_turn(user_message, cached)
+        yield _sse_event({'delta': cached})
+        yield _sse_event({'done': True, 'error': False, 'response': cached})
+        return
+
+    chunks = []
+    try:
+        with metrics.llm_call(stream=True) as call:
+            async for delta in llm_backends.astream(character, payload, call):
+                call.first_token()
+                chunks.append(delta)
+                yield _sse_event({'delta': delta})
+        if chunks:
+            await completion_cache.astore(character, payload, ''.join(chunks).strip())
+    except Exception:
+        logger.exception("Streamed completion failed for character %s, conversation %s (backend: %s)",
+                         character.id, user_message.conversation_id, call.backend)
+    finally:
+        ai_text = ''.join(chunks).strip()
+        if not ai_text:
+            ai_text = "Wystąpił błąd po stronie serwera."
+        await chat.asave_turn(user_message, ai_text)
+
+    yield _sse_event({'done': True, 'error': not chunks, 'response': ai_text})
+
+
+@require_POST
+@admission.limit_chat()
+async def chat_stream_api_view(request):
+    try:
+        character, conversation, user_message = await _parse_chat_api_request(request)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+
+    payload = await chat.abuild_message_payload(conversation, character, user_message)
+
+    return _with_conversation(_sse_response(_stream_completion(character, user_message, payload)), conversation)
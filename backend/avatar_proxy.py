@@ -0,0 +1,143 @@
+"""
+Local copies of external ``Character.avatar_url`` images.
+
+Browsers used to hotlink ``avatar_url`` on every page view. Now the first
+request to ``/avatar/<id>/`` starts a download on a background thread and
+gets the default avatar at once; the image is run through
+``avatars.render_image`` and the thumbnails are kept under
+``MEDIA_ROOT/avatars/external`` (names are content hashes). Pages link the
+hashed ``/avatar/<id>/<name>`` files, which are served as immutable. Copies
+older than ``AVATAR_PROXY_REFRESH`` are re-fetched the same way while the
+old one keeps being served. A ``cache.add`` lock per character keeps
+concurrent requests (and, with a shared cache, other workers) from
+fetching the same image twice.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+from . import avatars, catalog
+from .models import Character
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on one fetch; the lock of a killed worker expires after it.
+FETCH_LOCK_TIMEOUT = 60
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+class FetchError(Exception):
+    pass
+
+
+def _download(url: str) -> bytes:
+    if not url.startswith(('http://', 'https://')):
+        raise FetchError(f"unsupported URL: {url}")
+    max_bytes = getattr(settings, 'AVATAR_PROXY_MAX_BYTES', 5 * 1024 * 1024)
+    try:
+        with httpx.stream('GET', url, timeout=getattr(settings, 'AVATAR_PROXY_TIMEOUT', 5),
+                          follow_redirects=True) as response:
+            response.raise_for_status()
+            if not response.headers.get('content-type', '').startswith('image/'):
+                raise FetchError(f"not an image: {response.headers.get('content-type')}")
+            data = bytearray()
+            for chunk in response.iter_bytes():
+                data += chunk
+                if len(data) > max_bytes:
+                    raise FetchError("image too large")
+    except httpx.HTTPError as e:
+        raise FetchError(str(e)) from e
+    return bytes(data)
+
+
+def is_stale(variants: dict) -> bool:
+    age = time.time() - variants.get('fetched_at', 0)
+    return age > getattr(settings, 'AVATAR_PROXY_REFRESH', 86400)
+
+
+def refresh(character: Character) -> dict:
+    """Fetch ``character.avatar_url`` and store the new variants.
+
+    On failure the previous copy is kept (or the failure is recorded), so a
+    dead host is retried once per refresh period, not on every request.
+    """
+    url = character.avatar_url
+    previous = character.avatar_variants if character.avatar_variants.get('source') == url else {}
+    try:
+        variants = avatars.render_image(default_storage, _download(url), avatars.EXTERNAL_DIR)
+    except (FetchError, OSError) as e:
+        logger.warning("Fetching the avatar of character %s from %s failed: %s", character.id, url, e)
+        variants = {key: value for key, value in previous.items() if key != 'fetched_at'}
+        variants['failed'] = True
+    variants['source'] = url
+    variants['fetched_at'] = time.time()
+
+    updated = Character.objects.filter(id=character.id, avatar_url=url).update(avatar_variants=variants)
+    if updated and variants.get('jpeg') != previous.get('jpeg'):
+        catalog.invalidate()
+    character.avatar_variants = variants
+    return variants
+
+
+def _run(character_id: int) -> None:
+    close_old_connections()
+    try:
+        character = Character.objects.only('id', 'avatar', 'avatar_url', 'avatar_variants').filter(
+            id=character_id,
+        ).first()
+        if character and character.avatar_url and not character.avatar:
+            refresh(character)
+    except Exception:
+        logger.exception("Avatar refresh of character %s failed", character_id)
+    finally:
+        cache.delete(_fetch_lock_key(character_id))
+        close_old_connections()
+
+
+def _fetch_lock_key(character_id: int) -> str:
+    return f"avatar_proxy:fetch:{character_id}"
+
+
+def schedule_refresh(character_id: int) -> None:
+    """Refresh the copy on a background thread unless a fetch is under way."""
+    global _executor
+    if not cache.add(_fetch_lock_key(character_id), True, timeout=FETCH_LOCK_TIMEOUT):
+        return
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='avatar')
+    _executor.submit(_run, character_id)
+
+
+def open_variant(variants: dict, name: str):
+    """Stored file for the basename ``name`` if it is one of ``variants``."""
+    names = list(variants.get('webp', {}).values())
+    if 'jpeg' in variants:
+        names.append(variants['jpeg'])
+    for stored in names:
+        if os.path.basename(stored) == name:
+            return default_storage.open(stored, 'rb')
+    return None
+
+
+def _reset_after_fork() -> None:
+    global _executor, _lock
+    _executor = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=_reset_after_fork)
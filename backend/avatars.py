@@ -0,0 +1,132 @@
+"""
+Avatar thumbnails.
+
+Uploaded avatars are rendered at up to 90 CSS px, but used to be served at
+whatever size was uploaded. On upload (``Character.save``) the image is
+square-cropped and encoded as WebP at ``AVATAR_WIDTHS`` (for ``srcset``) plus
+one JPEG fallback. Names are content-addressed, so re-uploading the same
+image reuses the files.
+
+External ``avatar_url`` images go through the same pipeline, fetched by
+``avatar_proxy`` and served from ``/avatar/<id>/``.
+"""
+
+import hashlib
+import os
+from io import BytesIO
+from typing import Optional, Tuple
+
+from django.core.files.base import ContentFile
+from django.templatetags.static import static
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+
+# 60-90 px avatars at 1x-2x density.
+AVATAR_WIDTHS = (64, 128, 192)
+FALLBACK_WIDTH = 128
+THUMB_DIR = 'avatars/thumbs'
+EXTERNAL_DIR = 'avatars/external'
+
+DEFAULT_AVATAR = 'img/default-avatar-128.jpg'
+DEFAULT_AVATAR_VARIANT = 'img/default-avatar-{width}.webp'
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = BytesIO()
+    if fmt == 'WEBP':
+        image.save(buffer, 'WEBP', quality=80, method=6)
+    else:
+        image.save(buffer, 'JPEG', quality=82, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _store(storage, name: str, data: bytes) -> str:
+    if storage.exists(name):
+        return name
+    return storage.save(name, ContentFile(data))
+
+
+def render_variants(field_file) -> dict:
+    """Build thumbnails for an uploaded or stored avatar.
+
+    Returns the mapping kept in ``Character.avatar_variants``.
+    """
+    field_file.open('rb')
+    try:
+        field_file.seek(0)
+        data = field_file.read()
+    finally:
+        field_file.seek(0)
+    return render_image(field_file.storage, data)
+
+
+def render_image(storage, data: bytes, directory: str = THUMB_DIR) -> dict:
+    digest = hashlib.sha1(data).hexdigest()[:16]
+
+    variants = {'webp': {}}
+    with Image.open(BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert('RGB')
+        for width in AVATAR_WIDTHS:
+            thumb = ImageOps.fit(image, (width, width), Image.LANCZOS)
+            variants['webp'][str(width)] = _store(
+                storage, f'{directory}/{digest}-{width}.webp', _encode(thumb, 'WEBP'),
+            )
+            if width == FALLBACK_WIDTH:
+                variants['jpeg'] = _store(
+                    storage, f'{directory}/{digest}-{width}.jpg', _encode(thumb, 'JPEG'),
+                )
+    return variants
+
+
+def srcset(storage, variants: dict) -> str:
+    return _srcset(storage.url, variants)
+
+
+def _srcset(url, variants: dict) -> str:
+    return ', '.join(
+        f"{url(name)} {width}w" for width, name in sorted(
+            variants.get('webp', {}).items(), key=lambda item: int(item[0]),
+        )
+    )
+
+
+def default_srcset() -> str:
+    return ', '.join(
+        f"{static(DEFAULT_AVATAR_VARIANT.format(width=width))} {width}w" for width in AVATAR_WIDTHS
+    )
+
+
+def avatar_sources(character) -> Tuple[str, str]:
+    """``(src, srcset)`` for an avatar ``<img>``, falling back to the default."""
+    if character.display_avatar:
+        return character.display_avatar, character.avatar_srcset
+    return static(DEFAULT_AVATAR), default_srcset()
+
+
+def variant_url(storage, variants: dict) -> Optional[str]:
+    name = variants.get('jpeg')
+    return storage.url(name) if name else None
+
+
+def is_external_copy(variants: dict, avatar_url: str) -> bool:
+    """Whether ``variants`` hold a fetched copy of ``avatar_url``."""
+    return variants.get('source') == avatar_url and 'jpeg' in variants
+
+
+def external_file_url(character_id: int, name: str) -> str:
+    return reverse('external_avatar_file', args=[character_id, os.path.basename(name)])
+
+
+def external_url(character_id: int, avatar_url: str, variants: dict) -> str:
+    if character_id is None:
+        return avatar_url
+    if is_external_copy(variants, avatar_url):
+        return external_file_url(character_id, variants['jpeg'])
+    return reverse('external_avatar', args=[character_id])
+
+
+def external_srcset(character_id: int, avatar_url: str, variants: dict) -> str:
+    if character_id is None or not is_external_copy(variants, avatar_url):
+        return ''
+    return _srcset(lambda name: external_file_url(character_id, name), variants)
@@ -0,0 +1,67 @@
+"""
+Cached character catalog for the landing page and the staff list.
+
+Holds only what the lists render - name, short/header description and the
+resolved avatar URL - so the (potentially huge) ``description`` prompt never
+leaves the database here. ``character_list.html`` also caches its rendered
+tiles per catalog version: on a hit the landing page does no DB work at all.
+
+Both caches are dropped by the Character save/delete signals.
+"""
+
+import time
+from typing import List
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Character
+
+
+CATALOG_KEY = 'character_catalog'
+VERSION_KEY = 'character_catalog:version'
+
+
+def timeout() -> int:
+    return getattr(settings, 'CHARACTER_CATALOG_TIMEOUT', 300)
+
+
+def version() -> int:
+    """Changes on every invalidation; part of the template fragment key."""
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        # A fresh (never reused) value, so an evicted counter can't bring
+        # back fragments rendered before the last edit.
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        current = cache.get(VERSION_KEY)
+    return current
+
+
+def _build() -> List[dict]:
+    characters = Character.objects.only(
+        'id', 'name', 'short_description', 'header_description', 'avatar', 'avatar_url', 'avatar_variants',
+    ).order_by('id')
+    return [
+        {
+            'id': character.id,
+            'name': character.name,
+            'short_description': character.short_description,
+            'header_description': character.header_description,
+            'display_avatar': character.display_avatar,
+            'avatar_srcset': character.avatar_srcset,
+        }
+        for character in characters
+    ]
+
+
+def get_catalog() -> List[dict]:
+    catalog = cache.get(CATALOG_KEY)
+    if catalog is None:
+        catalog = _build()
+        cache.set(CATALOG_KEY, catalog, timeout())
+    return catalog
+
+
+def invalidate() -> None:
+    cache.delete(CATALOG_KEY)
+    cache.set(VERSION_KEY, time.time_ns(), None)
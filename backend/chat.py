@@ -0,0 +1,93 @@
+"""
+One chat turn: assemble the prompt and get the model's answer.
+
+Shared by the sync views, the async views and the job worker. The views
+keep the user's message in memory while the model answers and store it
+together with the answer (``save_turn``), so no transaction is open during
+the API call.
+"""
+
+import logging
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
+
+from . import completion_cache, context, llm_backends, metrics, prompts, summarization
+from .models import Character, Conversation, Message
+
+
+logger = logging.getLogger(__name__)
+
+
+def _with_pending(history: List[Message], user_message: Optional[Message]) -> List[Message]:
+    if user_message is None:
+        return history
+    context.fill_token_counts([user_message])
+    return [user_message] + history
+
+
+def build_message_payload(conversation: Conversation, character: Character,
+                          user_message: Optional[Message] = None) -> List[dict]:
+    """``user_message`` is the new, not yet saved message of this turn."""
+    history = list(context.history_window(conversation))
+    stale = context.fill_token_counts(history)
+    if stale:
+        Message.objects.bulk_update(stale, ['token_count'])
+    history = _with_pending(history, user_message)
+    if summarization.needs_summary(len(history)):
+        summarization.schedule_summary(conversation.id)
+    return context.build_payload(character, conversation, history, prompts.for_character(character))
+
+
+def save_turn(user_message: Message, ai_text: str) -> Message:
+    """Store the user's message and the answer in one transaction."""
+    answer = Message(conversation=user_message.conversation, is_user=False, content=ai_text)
+    Message.save_together([user_message, answer])
+    return answer
+
+
+asave_turn = sync_to_async(save_turn)
+
+
+def complete(character: Character, payload: List[dict], error_text: str) -> str:
+    cached = completion_cache.lookup(character, payload)
+    if cached is not None:
+        metrics.record_cache_hit()
+        return cached
+    with metrics.llm_call() as call:
+        try:
+            ai_text = llm_backends.complete(character, payload, call)
+        except Exception:
+            logger.exception("Completion failed for character %s (backend: %s)", character.id, call.backend)
+            call.failed()
+            return error_text
+    completion_cache.store(character, payload, ai_text)
+    return ai_text
+
+
+async def abuild_message_payload(conversation: Conversation, character: Character,
+                                 user_message: Optional[Message] = None) -> List[dict]:
+    history = [msg async for msg in context.history_window(conversation)]
+    stale = context.fill_token_counts(history)
+    if stale:
+        await Message.objects.abulk_update(stale, ['token_count'])
+    history = _with_pending(history, user_message)
+    if summarization.needs_summary(len(history)):
+        summarization.schedule_summary(conversation.id)
+    return context.build_payload(character, conversation, history, await prompts.afor_character(character))
+
+
+async def acomplete(character: Character, payload: List[dict], error_text: str) -> str:
+    cached = await completion_cache.alookup(character, payload)
+    if cached is not None:
+        metrics.record_cache_hit()
+        return cached
+    with metrics.llm_call() as call:
+        try:
+            ai_text = await llm_backends.acomplete(character, payload, call)
+        except Exception:
+            logger.exception("Completion failed for character %s (backend: %s)", character.id, call.backend)
+            call.failed()
+            return error_text
+    await completion_cache.astore(character, payload, ai_text)
+    return ai_text
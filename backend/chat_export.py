@@ -0,0 +1,209 @@
+"""
+Streaming export and import of conversations and messages (JSONL or CSV).
+
+Used by the ``export_chat_data`` and ``import_chat_data`` commands. Exports
+read rows with ``values_list().iterator()`` (a server-side cursor on
+PostgreSQL) and write them one at a time; imports ``bulk_create`` fixed-size
+batches, each in its own transaction. Memory use does not depend on the
+number of rows.
+
+Primary keys are kept, so messages still point at their conversations in
+the target database; files ending in ``.gz`` are (de)compressed on the fly.
+"""
+
+import csv
+import gzip
+import json
+import sys
+from contextlib import contextmanager
+from datetime import datetime, time
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Sequence
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import get_current_timezone, is_naive, make_aware
+
+from .context import count_tokens
+from .models import Conversation, Message
+
+
+DATASETS = {
+    'conversations': {
+        'model': Conversation,
+        'fields': ('id', 'character_id', 'created_at', 'summary', 'summary_until', 'summary_until_id',
+                   'summary_token_count'),
+        'date_field': 'created_at',
+        'character_field': 'character_id',
+        'conversation_field': 'id',
+    },
+    'messages': {
+        'model': Message,
+        'fields': ('id', 'conversation_id', 'is_user', 'content', 'timestamp', 'token_count'),
+        'date_field': 'timestamp',
+        'character_field': 'conversation__character_id',
+        'conversation_field': 'conversation_id',
+    },
+}
+
+INTEGER_FIELDS = {'id', 'character_id', 'conversation_id', 'summary_until_id', 'summary_token_count', 'token_count'}
+DATETIME_FIELDS = {'created_at', 'summary_until', 'timestamp'}
+BOOLEAN_FIELDS = {'is_user'}
+AUTO_NOW_ADD_FIELDS = {Conversation: 'created_at', Message: 'timestamp'}
+
+
+def parse_moment(value: str) -> datetime:
+    """``YYYY-MM-DD`` (midnight, local time) or an ISO datetime."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        moment = datetime.combine(day, time.min)
+    if is_naive(moment):
+        moment = make_aware(moment, get_current_timezone())
+    return moment
+
+
+def detect_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return 'csv' if path.removesuffix('.gz').endswith('.csv') else 'jsonl'
+
+
+@contextmanager
+def open_stream(path: str, mode: str):
+    if path == '-':
+        yield sys.stdout if mode == 'w' else sys.stdin
+    elif path.endswith('.gz'):
+        with gzip.open(path, mode + 't', encoding='utf-8', newline='') as f:
+            yield f
+    else:
+        with open(path, mode, encoding='utf-8', newline='') as f:
+            yield f
+
+
+def export_rows(dataset: str, character_ids: Sequence[int] = (), since: Optional[datetime] = None,
+                until: Optional[datetime] = None, chunk_size: int = 2000,
+                conversation_ids: Optional[Sequence[int]] = None) -> Iterator[tuple]:
+    spec = DATASETS[dataset]
+    rows = spec['model'].objects.all()
+    if conversation_ids is not None:
+        rows = rows.filter(**{f"{spec['conversation_field']}__in": conversation_ids})
+    if character_ids:
+        rows = rows.filter(**{f"{spec['character_field']}__in": character_ids})
+    if since:
+        rows = rows.filter(**{f"{spec['date_field']}__gte": since})
+    if until:
+        rows = rows.filter(**{f"{spec['date_field']}__lt": until})
+    return rows.order_by('pk').values_list(*spec['fields']).iterator(chunk_size=chunk_size)
+
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def write_jsonl(rows: Iterable[tuple], fields: Sequence[str], out) -> int:
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(fields, map(_jsonable, row))), ensure_ascii=False))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(rows: Iterable[tuple], fields: Sequence[str], out) -> int:
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        writer.writerow(['' if value is None else _jsonable(value) for value in row])
+        count += 1
+    return count
+
+
+def read_records(stream, fmt: str) -> Iterator[dict]:
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _convert(field: str, value):
+    if value is None or (value == '' and field not in ('summary', 'content')):
+        return None
+    if field in INTEGER_FIELDS:
+        return int(value)
+    if field in BOOLEAN_FIELDS:
+        return value if isinstance(value, bool) else value in ('1', 'True', 'true')
+    if field in DATETIME_FIELDS:
+        return parse_moment(value)
+    return value
+
+
+def _instance(dataset: str, record: dict):
+    spec = DATASETS[dataset]
+    values = {field: _convert(field, record.get(field)) for field in spec['fields'] if field in record}
+    if dataset == 'messages' and values.get('token_count') is None:
+        values['token_count'] = count_tokens(values.get('content') or '')
+    if dataset == 'conversations' and values.get('summary_token_count') is None:
+        values.pop('summary_token_count', None)
+    return spec['model'](**values)
+
+
+def _without_existing(model, batch: list) -> list:
+    ids = [obj.id for obj in batch if obj.id is not None]
+    existing = set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+    return [obj for obj in batch if obj.id not in existing]
+
+
+def _insert_batch(model, batch: list, ignore_conflicts: bool) -> int:
+    """Insert one batch in its own transaction; returns the rows inserted."""
+    field = AUTO_NOW_ADD_FIELDS[model]
+    with transaction.atomic():
+        if ignore_conflicts:
+            batch = _without_existing(model, batch)
+            if not batch:
+                return 0
+        stamps = [getattr(obj, field) for obj in batch]
+        # bulk_create stamps the auto_now_add field with the import time;
+        # the exported values are put back with one UPDATE.
+        model.objects.bulk_create(batch)
+        restored = []
+        for obj, stamp in zip(batch, stamps):
+            if stamp is not None and obj.pk is not None:
+                setattr(obj, field, stamp)
+                restored.append(obj)
+        if restored:
+            model.objects.bulk_update(restored, [field])
+    return len(batch)
+
+
+def import_records(dataset: str, records: Iterable[dict], batch_size: int = 1000,
+                   ignore_conflicts: bool = False) -> int:
+    """Insert ``records`` in batches, committing each; returns the number of
+    rows inserted. ``ignore_conflicts`` skips rows whose id already exists."""
+    model = DATASETS[dataset]['model']
+    instances = (_instance(dataset, record) for record in records)
+    count = 0
+    try:
+        while True:
+            batch = list(islice(instances, batch_size))
+            if not batch:
+                break
+            count += _insert_batch(model, batch, ignore_conflicts)
+    finally:
+        reset_sequences(model)
+    return count
+
+
+def reset_sequences(model) -> None:
+    """Move the PK sequence past the imported ids (no-op on SQLite)."""
+    statements = connection.ops.sequence_reset_sql(no_style(), [model])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
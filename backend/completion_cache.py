@@ -0,0 +1,192 @@
+"""
+Cache of LLM completions in front of the OpenAI call.
+
+The key is a hash of the character's ``prompt_version`` plus the
+normalized payload, so identical openings ("Cześć", "Opowiedz o sobie") to
+the same persona are answered once. Entries are scoped per character and
+dropped when the character is edited (see ``signals``).
+
+The backend is chosen with ``CHAT_COMPLETION_CACHE['BACKEND']``:
+
+* ``LocMemCompletionCache`` - per-process LRU with TTL,
+* ``DjangoCompletionCache`` - any Django cache alias (shared across workers;
+  eviction is left to that cache, so ``MAX_ENTRIES`` is rejected).
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(text.lower().split()).rstrip('.!?… ')
+
+
+def make_key(character, payload: List[dict]) -> str:
+    normalized = [(msg['role'], _normalize(msg['content'])) for msg in payload]
+    raw = json.dumps([character.prompt_version, normalized], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class BaseCompletionCache:
+    def __init__(self, timeout: int = 3600, **options):
+        self.timeout = timeout
+
+    def get(self, character_id: int, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, character_id: int, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def invalidate_character(self, character_id: int) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class LocMemCompletionCache(BaseCompletionCache):
+    def __init__(self, timeout: int = 3600, max_entries: int = 1000, **options):
+        super().__init__(timeout)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, character_id, key):
+        with self._lock:
+            entry = self._entries.get((character_id, key))
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[(character_id, key)]
+                self._misses += 1
+                return None
+            self._entries.move_to_end((character_id, key))
+            self._hits += 1
+            return entry[1]
+
+    def set(self, character_id, key, value):
+        with self._lock:
+            self._entries[(character_id, key)] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end((character_id, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_character(self, character_id):
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0] == character_id]:
+                del self._entries[entry_key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'entries': len(self._entries)}
+
+
+class DjangoCompletionCache(BaseCompletionCache):
+    """Per-character generation counters make invalidation O(1): bumping the
+    generation orphans the old keys, which then age out of the cache."""
+
+    def __init__(self, timeout: int = 3600, alias: str = 'default', key_prefix: str = 'completion',
+                 max_entries: Optional[int] = None, **options):
+        if max_entries is not None:
+            # Entries are spread over cache keys this class cannot count.
+            raise ImproperlyConfigured(
+                "DjangoCompletionCache does not support MAX_ENTRIES; bound the cache alias instead "
+                "(e.g. OPTIONS['MAX_ENTRIES'] or the server's memory limit)."
+            )
+        super().__init__(timeout)
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _generation_key(self, character_id):
+        return f"{self.key_prefix}:gen:{character_id}"
+
+    def _entry_key(self, character_id, key):
+        generation = self.cache.get(self._generation_key(character_id), 0)
+        return f"{self.key_prefix}:{character_id}:{generation}:{key}"
+
+    def _count(self, name):
+        counter_key = f"{self.key_prefix}:stats:{name}"
+        self.cache.add(counter_key, 0, None)
+        try:
+            self.cache.incr(counter_key)
+        except ValueError:  # evicted between add() and incr()
+            self.cache.set(counter_key, 1, None)
+
+    def get(self, character_id, key):
+        value = self.cache.get(self._entry_key(character_id, key))
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, character_id, key, value):
+        self.cache.set(self._entry_key(character_id, key), value, self.timeout)
+
+    def invalidate_character(self, character_id):
+        generation_key = self._generation_key(character_id)
+        self.cache.add(generation_key, 0, None)
+        try:
+            self.cache.incr(generation_key)
+        except ValueError:
+            self.cache.set(generation_key, 1, None)
+
+    def stats(self):
+        counters = self.cache.get_many([f"{self.key_prefix}:stats:hits", f"{self.key_prefix}:stats:misses"])
+        return {
+            'hits': counters.get(f"{self.key_prefix}:stats:hits", 0),
+            'misses': counters.get(f"{self.key_prefix}:stats:misses", 0),
+        }
+
+
+@lru_cache(maxsize=1)
+def get_completion_cache() -> Optional[BaseCompletionCache]:
+    config = dict(getattr(settings, 'CHAT_COMPLETION_CACHE', {}))
+    backend = config.pop('BACKEND', None)
+    if not backend:
+        return None
+    options = {name.lower(): value for name, value in config.items()}
+    return import_string(backend)(**options)
+
+
+def lookup(character, payload: List[dict]) -> Optional[str]:
+    cache = get_completion_cache()
+    if cache is None:
+        return None
+    return cache.get(character.id, make_key(character, payload))
+
+
+def store(character, payload: List[dict], value: str) -> None:
+    cache = get_completion_cache()
+    if cache is not None:
+        cache.set(character.id, make_key(character, payload), value)
+
+
+def invalidate_character(character_id: int) -> None:
+    cache = get_completion_cache()
+    if cache is not None:
+        cache.invalidate_character(character_id)
+
+
+def stats() -> dict:
+    cache = get_completion_cache()
+    if cache is None:
+        return {'enabled': False}
+    return {'enabled': True, 'backend': type(cache).__name__, **cache.stats()}
+
+
+alookup = sync_to_async(lookup)
+astore = sync_to_async(store)
@@ -0,0 +1,131 @@
+"""
+Token-budgeted assembly of the prompt sent to the model.
+
+Instead of a fixed number of recent messages, history is packed newest-first
+until the character's token budget is spent. The system prompt (the
+character's compiled prompt, see ``prompts``) is always included and counts
+against the budget.
+Per-message token counts are stored on ``Message.token_count``. When the
+conversation has a rolling summary (see ``summarization``), it follows the
+system prompt and only messages past its cursor (``after_summary``) are
+candidates.
+"""
+
+from functools import lru_cache
+from typing import Callable, List
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency
+    tiktoken = None
+
+
+# Chat formatting (role markers, separators) costs a few tokens per message
+# on top of its content.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokenizer-free estimate. Polish text averages ~3 characters per token
+    on OpenAI vocabularies; erring high keeps prompts inside the budget."""
+    return (len(text) + 2) // 3
+
+
+@lru_cache(maxsize=1)
+def _tiktoken_encoding():
+    if tiktoken is None:
+        raise ImproperlyConfigured("CHAT_TOKEN_COUNTER uses tiktoken, but it is not installed.")
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def tiktoken_tokens(text: str) -> int:
+    """Exact count for gpt-3.5/gpt-4 family models (requires ``tiktoken``)."""
+    return len(_tiktoken_encoding().encode(text))
+
+
+@lru_cache(maxsize=1)
+def get_token_counter() -> Callable[[str], int]:
+    return import_string(getattr(settings, 'CHAT_TOKEN_COUNTER', 'backend.context.estimate_tokens'))
+
+
+def count_tokens(text: str) -> int:
+    return get_token_counter()(text or '')
+
+
+def token_budget(character) -> int:
+    return character.context_token_budget or getattr(settings, 'CHAT_CONTEXT_TOKEN_BUDGET', 3000)
+
+
+def after_summary(messages, conversation):
+    """Messages not folded into the summary yet.
+
+    The cursor is (``summary_until``, ``summary_until_id``), matching the
+    (timestamp, id) order messages are folded in, so one sharing the
+    timestamp of the last folded message is not skipped.
+    """
+    if conversation.summary_until is None:
+        return messages
+    after = Q(timestamp__gt=conversation.summary_until)
+    if conversation.summary_until_id is not None:
+        after |= Q(timestamp=conversation.summary_until, id__gt=conversation.summary_until_id)
+    return messages.filter(after)
+
+
+def history_window(conversation):
+    """Newest-first candidates for the prompt.
+
+    The row cap only bounds the query; the token budget decides what is sent.
+    """
+    limit = getattr(settings, 'CHAT_HISTORY_MAX_MESSAGES', 50)
+    messages = after_summary(conversation.messages.all(), conversation)
+    # conversation_id stays loaded: the related manager reads it on every
+    # row to attach the parent, which would be one query per message.
+    return messages.order_by('-timestamp', '-id').only('id', 'conversation', 'is_user', 'content', 'token_count')[:limit]
+
+
+def fill_token_counts(messages) -> list:
+    """Count tokens for rows saved before counts were stored.
+
+    Returns the updated messages so the caller can persist them.
+    """
+    stale = [msg for msg in messages if msg.token_count is None]
+    for msg in stale:
+        msg.token_count = count_tokens(msg.content)
+    return stale
+
+
+def _summary_message(conversation) -> dict:
+    return {
+        "role": "system",
+        "content": f"Streszczenie wcześniejszej części rozmowy:\n{conversation.summary}",
+    }
+
+
+def build_payload(character, conversation, newest_first, prompt) -> List[dict]:
+    """``prompt`` is the character's ``prompts.CompiledPrompt``."""
+    remaining = token_budget(character) - prompt.token_count - MESSAGE_OVERHEAD_TOKENS
+    if conversation.summary:
+        remaining -= conversation.summary_token_count + MESSAGE_OVERHEAD_TOKENS
+
+    history = []
+    for msg in newest_first:
+        cost = msg.token_count + MESSAGE_OVERHEAD_TOKENS
+        # The newest message is the one being answered - always send it.
+        if history and cost > remaining:
+            break
+        history.append(msg)
+        remaining -= cost
+    history.reverse()
+
+    messages = [{"role": "system", "content": prompt.text}]
+    if conversation.summary:
+        messages.append(_summary_message(conversation))
+    for msg in history:
+        role = "user" if msg.is_user else "assistant"
+        messages.append({"role": role, "content": msg.content})
+    return messages
@@ -4,7 +4,7 @@ from .models import Character, Message
 class CharacterForm(forms.ModelForm):
     class Meta:
         model = Character
-        fields = ['name', 'header_description', 'short_description', 'greeting', 'description', 'avatar', 'avatar_url']
+        fields = ['name', 'header_description', 'short_description', 'greeting', 'description', 'avatar', 'avatar_url', 'context_token_budget', 'llm_backends']
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'header_description': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
@@ -13,6 +13,8 @@ class CharacterForm(forms.ModelForm):
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 5}),
             'avatar': forms.ClearableFileInput(attrs={'class': 'form-control'}),
             'avatar_url': forms.URLInput(attrs={'class': 'form-control'}),
+            'context_token_budget': forms.NumberInput(attrs={'class': 'form-control'}),
+            'llm_backends': forms.TextInput(attrs={'class': 'form-control'}),
         }
 
 class MessageForm(forms.ModelForm):
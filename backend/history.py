@@ -0,0 +1,57 @@
+"""
+Keyset pagination over a conversation's messages.
+
+The chat page renders only the newest page; older pages are fetched by
+cursor as the user scrolls up. The cursor is the (timestamp, id) of the
+oldest message already shown, so every page is one index range scan on
+``message_conv_ts_idx`` no matter how deep into the history it is.
+"""
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Message
+
+
+def page_size() -> int:
+    return getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 30)
+
+
+def encode_cursor(message: Message) -> str:
+    return f"{message.timestamp.isoformat()}_{message.id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Raises ValueError for malformed cursors."""
+    timestamp, _, message_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+
+def history_page(conversation_id: int, before: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+    """Oldest-first page of messages preceding ``before`` and the cursor for
+    the page before it (``None`` when this is the start of the chat)."""
+    limit = page_size()
+    messages = Message.objects.filter(conversation_id=conversation_id)
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+    rows = list(
+        messages.order_by('-timestamp', '-id').only('id', 'is_user', 'content', 'timestamp')[:limit + 1]
+    )
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, encode_cursor(rows[0]) if has_more else None
+
+
+def serialize(message: Message) -> dict:
+    return {
+        'id': message.id,
+        'is_user': message.is_user,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
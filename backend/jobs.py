@@ -0,0 +1,131 @@
+"""
+DB-backed queue of chat completions.
+
+In job mode (``CHAT_JOB_MODE``) ``/api/chat/`` only stores the user message,
+enqueues a ``CompletionJob`` and answers immediately with its id; the
+browser polls ``/api/chat/jobs/<id>/``. ``manage.py run_chat_worker`` runs
+the completions with bounded concurrency and per-character rate limits, so
+traffic spikes and a slow upstream queue up instead of timing out requests.
+
+Jobs are claimed with a conditional UPDATE (status pending -> running), which
+is safe for any number of worker processes on any database backend.
+"""
+
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, Iterable, Optional, Set
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils.timezone import now
+
+from . import admission, chat
+from .models import CompletionJob, Message
+
+
+logger = logging.getLogger(__name__)
+
+ERROR_TEXT = "Wystąpił błąd po stronie serwera."
+
+
+def job_mode_enabled() -> bool:
+    return getattr(settings, 'CHAT_JOB_MODE', False)
+
+
+def serialize(job: CompletionJob) -> dict:
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'response': job.response.content if job.response_id else None,
+    }
+
+
+def claim_next(exclude_character_ids: Iterable[int] = ()) -> Optional[CompletionJob]:
+    candidates = (
+        CompletionJob.objects
+        .filter(status=CompletionJob.Status.PENDING)
+        .exclude(character_id__in=list(exclude_character_ids))
+        .order_by('created_at')
+        .values_list('id', flat=True)[:10]
+    )
+    for job_id in candidates:
+        claimed = CompletionJob.objects.filter(id=job_id, status=CompletionJob.Status.PENDING).update(
+            status=CompletionJob.Status.RUNNING,
+            started_at=now(),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return CompletionJob.objects.select_related('conversation', 'character').get(id=job_id)
+    return None
+
+
+def unclaim(job: CompletionJob) -> None:
+    """Hand a claimed job back to the queue without counting the attempt."""
+    CompletionJob.objects.filter(id=job.id, status=CompletionJob.Status.RUNNING).update(
+        status=CompletionJob.Status.PENDING, started_at=None, attempts=F('attempts') - 1,
+    )
+
+
+def run_job(job: CompletionJob) -> None:
+    try:
+        payload = chat.build_message_payload(job.conversation, job.character)
+        ai_text = chat.complete(job.character, payload, ERROR_TEXT)
+        response = Message.objects.create(conversation=job.conversation, is_user=False, content=ai_text)
+        CompletionJob.objects.filter(id=job.id).update(
+            status=CompletionJob.Status.DONE, response=response, finished_at=now(),
+        )
+    except Exception as e:
+        logger.exception("Completion job %s failed (character %s, conversation %s)",
+                         job.id, job.character_id, job.conversation_id)
+        CompletionJob.objects.filter(id=job.id).update(
+            status=CompletionJob.Status.FAILED, error=str(e), finished_at=now(),
+        )
+
+
+def run_job_in_thread(job: CompletionJob) -> None:
+    close_old_connections()
+    try:
+        run_job(job)
+    finally:
+        close_old_connections()
+
+
+def requeue_stale() -> int:
+    """Hand jobs of a crashed worker back to the queue (or give up on them)."""
+    cutoff = now() - timedelta(seconds=getattr(settings, 'CHAT_JOB_TIMEOUT', 300))
+    stale = CompletionJob.objects.filter(status=CompletionJob.Status.RUNNING, started_at__lt=cutoff)
+    max_attempts = getattr(settings, 'CHAT_JOB_MAX_ATTEMPTS', 3)
+    stale.filter(attempts__gte=max_attempts).update(
+        status=CompletionJob.Status.FAILED, error='timeout', finished_at=now(),
+    )
+    return stale.filter(attempts__lt=max_attempts).update(status=CompletionJob.Status.PENDING)
+
+
+class CharacterRateLimiter:
+    """Completions started per character per minute (a token bucket with a
+    burst of one minute's worth). The buckets live in the
+    ``CHAT_ADMISSION_CACHE`` cache, so with a shared cache (Redis/Memcached)
+    the limit holds across all workers; with the default per-process memory
+    cache it applies to each worker separately."""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._blocked_until: Dict[int, float] = {}
+
+    def allow(self, character_id: int) -> bool:
+        """Spend a start of the character's budget. When it is used up the
+        character is skipped by ``blocked()`` until the next start frees up."""
+        wait = admission.take_token(f'jobs:character:{character_id}', self.per_minute, self.per_minute)
+        if wait is None:
+            return True
+        self._blocked_until[character_id] = time.monotonic() + wait
+        return False
+
+    def blocked(self) -> Set[int]:
+        current = time.monotonic()
+        for character_id, until in list(self._blocked_until.items()):
+            if until <= current:
+                del self._blocked_until[character_id]
+        return set(self._blocked_until)
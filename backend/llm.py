@@ -0,0 +1,121 @@
+"""
+Process-wide OpenAI clients.
+
+Building ``OpenAI(...)`` per chat turn meant a fresh connection pool - new DNS
+lookup, TCP connect and TLS handshake - on every message. Here each worker
+process keeps one client with a keep-alive pool and reuses it.
+
+There is one pool per endpoint configuration (base URL, key, timeout,
+retries), so every OpenAI-compatible backend in ``LLM_BACKENDS`` gets its
+own.
+
+Pools are never shared across ``fork()``: a child (e.g. a gunicorn worker
+forked from a ``--preload`` master) drops the inherited clients and lazily
+builds its own on first use.
+"""
+
+import asyncio
+import atexit
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from django.conf import settings
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+
+
+load_dotenv()
+
+_lock = threading.Lock()
+_clients: Dict[Tuple, OpenAI] = {}
+# AsyncOpenAI connections are bound to the event loop they were opened on,
+# so there are separate async clients for every running loop.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _timeout(timeout: Optional[float] = None) -> httpx.Timeout:
+    return httpx.Timeout(
+        timeout if timeout is not None else getattr(settings, 'OPENAI_TIMEOUT', 60.0),
+        connect=getattr(settings, 'OPENAI_CONNECT_TIMEOUT', 5.0),
+    )
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=getattr(settings, 'OPENAI_MAX_CONNECTIONS', 100),
+        max_keepalive_connections=getattr(settings, 'OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20),
+        keepalive_expiry=getattr(settings, 'OPENAI_KEEPALIVE_EXPIRY', 30.0),
+    )
+
+
+def _client_kwargs(base_url: Optional[str], api_key: Optional[str], timeout: Optional[float],
+                   max_retries: Optional[int]) -> dict:
+    # Retries use the SDK's exponential backoff with jitter; we only decide
+    # how many attempts a chat turn may spend on them.
+    return {
+        'api_key': api_key or os.getenv("OPENAI_API_KEY"),
+        'base_url': base_url or getattr(settings, 'OPENAI_BASE_URL', None),
+        'timeout': _timeout(timeout),
+        'max_retries': max_retries if max_retries is not None else getattr(settings, 'OPENAI_MAX_RETRIES', 2),
+    }
+
+
+def get_openai_client(base_url: Optional[str] = None, api_key: Optional[str] = None,
+                      timeout: Optional[float] = None, max_retries: Optional[int] = None) -> OpenAI:
+    """Shared client for an endpoint; unset arguments come from OPENAI_* settings."""
+    key = (base_url, api_key, timeout, max_retries)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = OpenAI(
+                    http_client=httpx.Client(limits=_limits(), timeout=_timeout(timeout)),
+                    **_client_kwargs(base_url, api_key, timeout, max_retries),
+                )
+    return client
+
+
+def get_async_openai_client(base_url: Optional[str] = None, api_key: Optional[str] = None,
+                            timeout: Optional[float] = None, max_retries: Optional[int] = None) -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    key = (base_url, api_key, timeout, max_retries)
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = AsyncOpenAI(
+            http_client=httpx.AsyncClient(limits=_limits(), timeout=_timeout(timeout)),
+            **_client_kwargs(base_url, api_key, timeout, max_retries),
+        )
+    return client
+
+
+def close_clients() -> None:
+    """Close the sync pools; registered as an exit hook for every process."""
+    global _clients
+    with _lock:
+        clients, _clients = _clients, {}
+    for client in clients.values():
+        client.close()
+    # Async pools die with their event loop; closing them here would need
+    # that loop, which is usually gone at interpreter exit.
+    _async_clients.clear()
+
+
+def _forget_clients() -> None:
+    # Sockets inherited from the parent belong to the parent - don't close
+    # them, just make the child build its own pool.
+    global _clients, _lock
+    _clients = {}
+    _lock = threading.Lock()
+    _async_clients.clear()
+
+
+atexit.register(close_clients)
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=_forget_clients)
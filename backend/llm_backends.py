@@ -0,0 +1,413 @@
+"""
+LLM backends and the routing between them.
+
+``LLM_BACKENDS`` names the available backends, configured like
+``CHAT_COMPLETION_CACHE`` (``BACKEND`` plus upper-case options):
+
+* ``OpenAIBackend`` - any OpenAI-compatible endpoint: OpenAI itself or a
+  local llama.cpp / vLLM server (``BASE_URL``, ``MODEL``, ``API_KEY``,
+  ``TIMEOUT``, ``MAX_RETRIES``),
+* ``FakeBackend`` - deterministic in-process answers for tests and
+  benchmarks (``LATENCY``, ``TOKEN_RATE``, ``REPLY_TOKENS``).
+
+Every backend takes ``MAX_CONCURRENCY``: a backend with that many calls in
+flight is skipped. A character's route (``Character.llm_backends``, else
+``LLM_DEFAULT_ROUTE``) is tried fastest first, weighted by load: streams by
+the moving average of the time to the first token, whole completions by
+that of the completion time (kept apart, they measure different things). A
+backend that times out, fails or ends a stream without a token is tried
+last for ``LLM_FALLBACK_COOLDOWN`` seconds and the turn moves on to the
+next one; a stream only falls back before its first token. While another
+backend is left to fall back to, an attempt gets ``LLM_ATTEMPT_TIMEOUT``
+seconds (to the response, or to each streamed chunk) and no retries, so a
+hung provider costs a turn seconds, not its full timeout times its retries.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from itertools import cycle, islice
+from typing import AsyncIterator, Callable, Iterator, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .context import count_tokens
+from .llm import get_async_openai_client, get_openai_client
+
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the latency moving average.
+LATENCY_SMOOTHING = 0.2
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class BackendUnavailable(Exception):
+    """No backend of the route could answer."""
+
+
+class EmptyStream(Exception):
+    """The backend ended a stream without a single token."""
+
+
+def _smoothed(average: Optional[float], sample: float) -> float:
+    return sample if average is None else average + LATENCY_SMOOTHING * (sample - average)
+
+
+class BaseLLMBackend:
+    def __init__(self, name: str, max_concurrency: int = 16, **options):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completion_latency: Optional[float] = None
+        self._ttft: Optional[float] = None
+        self._cooldown_until = 0.0
+
+    # Completions. ``call`` is the metrics.LLMCall of the chat turn.
+
+    def complete(self, messages: List[dict], call) -> str:
+        raise NotImplementedError
+
+    async def acomplete(self, messages: List[dict], call) -> str:
+        raise NotImplementedError
+
+    def stream(self, messages: List[dict], call) -> Iterator[str]:
+        raise NotImplementedError
+
+    def astream(self, messages: List[dict], call) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    # Routing state, shared by the sync and async paths of a process.
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.max_concurrency:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def record_completion(self, seconds: float) -> None:
+        with self._lock:
+            self._completion_latency = _smoothed(self._completion_latency, seconds)
+
+    def record_ttft(self, seconds: float) -> None:
+        with self._lock:
+            self._ttft = _smoothed(self._ttft, seconds)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._cooldown_until = time.monotonic() + getattr(settings, 'LLM_FALLBACK_COOLDOWN', 30.0)
+
+    def rank(self, stream: bool = False) -> tuple:
+        """Sort key: healthy before cooling down, then expected latency of
+        the first token (``stream``) or of the whole completion. Unmeasured
+        backends rank first so they get measured."""
+        with self._lock:
+            cooling = time.monotonic() < self._cooldown_until
+            load = 1 + self._in_flight / max(self.max_concurrency, 1)
+            latency = self._ttft if stream else self._completion_latency
+            return cooling, (latency or 0.0) * load
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': self._in_flight,
+                'max_concurrency': self.max_concurrency,
+                'completion_ms': _milliseconds(self._completion_latency),
+                'ttft_ms': _milliseconds(self._ttft),
+                'cooling_down': time.monotonic() < self._cooldown_until,
+            }
+
+
+def _milliseconds(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+class OpenAIBackend(BaseLLMBackend):
+    def __init__(self, name: str, model: str = 'gpt-3.5-turbo', base_url: Optional[str] = None,
+                 api_key: Optional[str] = None, timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None, **options):
+        super().__init__(name, **options)
+        self.model = model
+        self.client_options = {
+            'base_url': base_url, 'api_key': api_key, 'timeout': timeout, 'max_retries': max_retries,
+        }
+
+    def _options(self, call) -> dict:
+        if call.attempt_timeout is None:
+            return self.client_options
+        return {**self.client_options, 'timeout': call.attempt_timeout, 'max_retries': 0}
+
+    def complete(self, messages, call):
+        response = get_openai_client(**self._options(call)).chat.completions.create(
+            model=self.model,
+            messages=messages,
+        )
+        call.usage(response.usage)
+        return response.choices[0].message.content.strip()
+
+    async def acomplete(self, messages, call):
+        response = await get_async_openai_client(**self._options(call)).chat.completions.create(
+            model=self.model,
+            messages=messages,
+        )
+        call.usage(response.usage)
+        return response.choices[0].message.content.strip()
+
+    def stream(self, messages, call):
+        stream = get_openai_client(**self._options(call)).chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={'include_usage': True},
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                call.usage(chunk.usage)  # final chunk
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+    async def astream(self, messages, call):
+        stream = await get_async_openai_client(**self._options(call)).chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={'include_usage': True},
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                call.usage(chunk.usage)
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+class FakeBackend(BaseLLMBackend):
+    """Answers without a network: the same conversation always gets the same
+    reply. ``LATENCY`` is the wait before the first token, ``TOKEN_RATE``
+    the tokens per second after it (0 sends them all at once)."""
+
+    WORDS = "Dzień dobry, w czym mogę pomóc? To dobry pomysł, ale sprawdź najpierw rynek i koszty.".split()
+
+    def __init__(self, name: str, latency: float = 0.0, token_rate: float = 0.0,
+                 reply_tokens: int = 40, **options):
+        super().__init__(name, **options)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+
+    def _tokens(self, messages) -> List[str]:
+        digest = hashlib.sha256(messages[-1]['content'].encode()).digest()
+        start = digest[0] % len(self.WORDS)
+        words = list(islice(cycle(self.WORDS), start, start + self.reply_tokens))
+        return [word if i == 0 else ' ' + word for i, word in enumerate(words)]
+
+    def _usage(self, messages, tokens) -> Usage:
+        return Usage(sum(count_tokens(msg['content']) for msg in messages), len(tokens))
+
+    def complete(self, messages, call):
+        tokens = self._tokens(messages)
+        time.sleep(self.latency + (len(tokens) / self.token_rate if self.token_rate else 0))
+        call.usage(self._usage(messages, tokens))
+        return ''.join(tokens)
+
+    async def acomplete(self, messages, call):
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency + (len(tokens) / self.token_rate if self.token_rate else 0))
+        call.usage(self._usage(messages, tokens))
+        return ''.join(tokens)
+
+    def stream(self, messages, call):
+        tokens = self._tokens(messages)
+        time.sleep(self.latency)
+        for i, token in enumerate(tokens):
+            if i and self.token_rate:
+                time.sleep(1 / self.token_rate)
+            yield token
+        call.usage(self._usage(messages, tokens))
+
+    async def astream(self, messages, call):
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency)
+        for i, token in enumerate(tokens):
+            if i and self.token_rate:
+                await asyncio.sleep(1 / self.token_rate)
+            yield token
+        call.usage(self._usage(messages, tokens))
+
+
+@lru_cache(maxsize=None)
+def get_backend(name: str) -> BaseLLMBackend:
+    config = dict(getattr(settings, 'LLM_BACKENDS', {})[name])
+    backend = config.pop('BACKEND', 'backend.llm_backends.OpenAIBackend')
+    options = {key.lower(): value for key, value in config.items()}
+    return import_string(backend)(name, **options)
+
+
+def parse_route(value: str) -> List[str]:
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def route_for(character, stream: bool = False) -> List[BaseLLMBackend]:
+    configured = getattr(settings, 'LLM_BACKENDS', {})
+    names = [name for name in parse_route(getattr(character, 'llm_backends', '')) if name in configured]
+    if not names:
+        names = [name for name in getattr(settings, 'LLM_DEFAULT_ROUTE', ['openai']) if name in configured]
+    backends = [get_backend(name) for name in names]
+    # sorted() is stable: equally ranked backends keep the configured order.
+    return sorted(backends, key=lambda backend: backend.rank(stream))
+
+
+def _attempts(character, call) -> Iterator[BaseLLMBackend]:
+    """Backends of the route that have capacity, each already acquired and
+    recorded as ``call.backend``, with ``call.attempt_timeout`` set while
+    another backend is left to fall back to."""
+    backends = route_for(character, call.stream)
+    if not backends:
+        raise BackendUnavailable("No LLM backend configured")
+    timeout = getattr(settings, 'LLM_ATTEMPT_TIMEOUT', 15.0) or None
+    acquired = False
+    for i, backend in enumerate(backends):
+        if not backend.try_acquire():
+            metrics.LLM_BACKEND_CALLS.inc(backend=backend.name, outcome='busy')
+            continue
+        acquired = True
+        call.backend = backend.name
+        call.attempt_timeout = timeout if i < len(backends) - 1 else None
+        yield backend
+    if not acquired:
+        raise BackendUnavailable("All LLM backends are busy")
+
+
+def _failed(backend: BaseLLMBackend, character, error: Exception) -> None:
+    logger.warning("LLM backend %s failed for character %s, trying the next one: %s",
+                   backend.name, character.id, error, exc_info=error)
+    backend.record_failure()
+    metrics.LLM_BACKEND_CALLS.inc(backend=backend.name, outcome='error')
+
+
+def _succeeded(backend: BaseLLMBackend) -> None:
+    metrics.LLM_BACKEND_CALLS.inc(backend=backend.name, outcome='ok')
+
+
+def _run(character, call, attempt: Callable[[BaseLLMBackend], str]) -> str:
+    error: Exception = BackendUnavailable("No LLM backend answered")
+    for backend in _attempts(character, call):
+        started = time.perf_counter()
+        try:
+            text = attempt(backend)
+        except Exception as e:
+            _failed(backend, character, e)
+            error = e
+            continue
+        finally:
+            backend.release()
+        backend.record_completion(time.perf_counter() - started)
+        _succeeded(backend)
+        return text
+    raise error
+
+
+def complete(character, messages: List[dict], call) -> str:
+    """Answer from the first backend of the character's route that manages to."""
+    return _run(character, call, lambda backend: backend.complete(messages, call))
+
+
+async def acomplete(character, messages: List[dict], call) -> str:
+    error: Exception = BackendUnavailable("No LLM backend answered")
+    for backend in _attempts(character, call):
+        started = time.perf_counter()
+        try:
+            text = await backend.acomplete(messages, call)
+        except Exception as e:
+            _failed(backend, character, e)
+            error = e
+            continue
+        finally:
+            backend.release()
+        backend.record_completion(time.perf_counter() - started)
+        _succeeded(backend)
+        return text
+    raise error
+
+
+def stream(character, messages: List[dict], call) -> Iterator[str]:
+    """Text deltas from the first backend that produces a token."""
+    error: Exception = BackendUnavailable("No LLM backend answered")
+    for backend in _attempts(character, call):
+        started = time.perf_counter()
+        streamed = False
+        try:
+            for delta in backend.stream(messages, call):
+                if not streamed:
+                    streamed = True
+                    backend.record_ttft(time.perf_counter() - started)
+                    _succeeded(backend)
+                yield delta
+        except Exception as e:
+            if streamed:
+                raise
+            _failed(backend, character, e)
+            error = e
+            continue
+        finally:
+            backend.release()
+        if streamed:
+            return
+        error = EmptyStream(f"{backend.name} sent no tokens")
+        _failed(backend, character, error)
+    raise error
+
+
+async def astream(character, messages: List[dict], call) -> AsyncIterator[str]:
+    error: Exception = BackendUnavailable("No LLM backend answered")
+    for backend in _attempts(character, call):
+        started = time.perf_counter()
+        streamed = False
+        try:
+            async for delta in backend.astream(messages, call):
+                if not streamed:
+                    streamed = True
+                    backend.record_ttft(time.perf_counter() - started)
+                    _succeeded(backend)
+                yield delta
+        except Exception as e:
+            if streamed:
+                raise
+            _failed(backend, character, e)
+            error = e
+            continue
+        finally:
+            backend.release()
+        if streamed:
+            return
+        error = EmptyStream(f"{backend.name} sent no tokens")
+        _failed(backend, character, error)
+    raise error
+
+
+def stats() -> dict:
+    return {name: get_backend(name).stats() for name in getattr(settings, 'LLM_BACKENDS', {})}
+
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    # In-flight counts and locks of the parent mean nothing in a child.
+    os.register_at_fork(after_in_child=get_backend.cache_clear)
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backend import retention
+
+
+class Command(BaseCommand):
+    help = "Delete greeting-only conversations and archive inactive ones (CHAT_RETENTION_* settings)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empty-hours', type=int, default=getattr(settings, 'CHAT_RETENTION_EMPTY_HOURS', 24),
+                            help="Delete conversations without user messages after this many hours (0 = off).")
+        parser.add_argument('--archive-days', type=int, default=getattr(settings, 'CHAT_RETENTION_ARCHIVE_DAYS', 0),
+                            help="Archive and delete conversations inactive this many days (0 = off).")
+        parser.add_argument('--archive-dir', default=getattr(settings, 'CHAT_ARCHIVE_DIR', 'archive'))
+        parser.add_argument('--batch-size', type=int, default=retention.batch_size())
+        parser.add_argument('--pause', type=float, default=0.1, help="Seconds to sleep between batches.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be removed.")
+
+    def handle(self, *args, **options):
+        empty_hours, archive_days = options['empty_hours'], options['archive_days']
+        if options['dry_run']:
+            if empty_hours:
+                count = retention.empty_conversations(empty_hours).count()
+                self.stdout.write(f"{count} greeting-only conversations would be deleted.")
+            if archive_days:
+                inactive = retention.inactive_conversations(archive_days)
+                if empty_hours:  # those go first
+                    inactive = inactive.exclude(id__in=retention.empty_conversations(empty_hours).values('id'))
+                count = inactive.count()
+                self.stdout.write(f"{count} inactive conversations would be archived.")
+            return
+
+        if empty_hours:
+            removed = retention.purge_empty(empty_hours, options['batch_size'], options['pause'])
+            self.stdout.write(f"Deleted {removed} greeting-only conversations.")
+        if archive_days:
+            archived = retention.archive_inactive(
+                archive_days, options['batch_size'], options['archive_dir'], options['pause'],
+            )
+            self.stdout.write(f"Archived {archived} conversations to {options['archive_dir']}.")
+        self.stdout.write(self.style.SUCCESS("Done."))
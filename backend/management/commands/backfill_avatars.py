@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from backend import avatars, catalog
+from backend.models import Character
+
+
+class Command(BaseCommand):
+    help = "Render resized avatar variants for characters uploaded before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Re-render characters that already have variants.")
+
+    def handle(self, *args, **options):
+        characters = Character.objects.exclude(avatar='').exclude(avatar__isnull=True).only('id', 'avatar', 'avatar_variants')
+        rendered = 0
+        for character in characters.iterator():
+            if character.avatar_variants and not options['force']:
+                continue
+            try:
+                variants = avatars.render_variants(character.avatar)
+            except Exception as e:
+                self.stderr.write(f"Character {character.id}: {e}")
+                continue
+            Character.objects.filter(id=character.id).update(avatar_variants=variants)
+            rendered += 1
+
+        if rendered:
+            catalog.invalidate()
+        self.stdout.write(f"Rendered avatars for {rendered} characters.")
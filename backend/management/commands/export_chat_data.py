@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend import chat_export
+
+
+class Command(BaseCommand):
+    help = "Stream conversations or messages to JSONL/CSV (constant memory)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(chat_export.DATASETS))
+        parser.add_argument('--output', '-o', default='-', help="File path (.gz compresses), '-' for stdout.")
+        parser.add_argument('--format', choices=('jsonl', 'csv'), help="Default: from the file extension, else jsonl.")
+        parser.add_argument('--character', type=int, action='append', dest='characters',
+                            help="Only this character id (repeatable).")
+        parser.add_argument('--since', help="From this date/datetime (inclusive).")
+        parser.add_argument('--until', help="Up to this date/datetime (exclusive).")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            since = chat_export.parse_moment(options['since']) if options['since'] else None
+            until = chat_export.parse_moment(options['until']) if options['until'] else None
+        except ValueError as e:
+            raise CommandError(e)
+
+        dataset = options['dataset']
+        fmt = chat_export.detect_format(options['output'], options['format'])
+        rows = chat_export.export_rows(
+            dataset, options['characters'] or (), since, until, options['chunk_size'],
+        )
+        fields = chat_export.DATASETS[dataset]['fields']
+        write = chat_export.write_csv if fmt == 'csv' else chat_export.write_jsonl
+        with chat_export.open_stream(options['output'], 'w') as out:
+            count = write(rows, fields, out)
+        self.stderr.write(f"Exported {count} {dataset}.")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from backend import chat_export
+
+
+class Command(BaseCommand):
+    help = ("Load conversations or messages exported by export_chat_data (bulk inserts, "
+            "one transaction per batch).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(chat_export.DATASETS))
+        parser.add_argument('input', help="File path (.gz decompresses), '-' for stdin.")
+        parser.add_argument('--format', choices=('jsonl', 'csv'), help="Default: from the file extension, else jsonl.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--ignore-conflicts', action='store_true',
+                            help="Skip rows whose id already exists (for resuming or re-running an import).")
+
+    def handle(self, *args, **options):
+        dataset = options['dataset']
+        fmt = chat_export.detect_format(options['input'], options['format'])
+        with chat_export.open_stream(options['input'], 'r') as stream:
+            count = chat_export.import_records(
+                dataset, chat_export.read_records(stream, fmt),
+                batch_size=options['batch_size'], ignore_conflicts=options['ignore_conflicts'],
+            )
+        self.stdout.write(self.style.SUCCESS(f"Imported {count} {dataset}."))
+        self.stdout.write("Run recount_conversation_stats to update the conversation counters.")
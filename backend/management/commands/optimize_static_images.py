@@ -0,0 +1,74 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+# Images shown scaled down: WebP copies at their 1x/2x display widths,
+# named like the default avatar variants (``<name>-<width>.webp``).
+RESPONSIVE_IMAGES = {
+    'img/startup-lab-logo.png': (600, 1200),
+}
+
+
+def _recompress(image: Image.Image, fmt: str) -> bytes:
+    buffer = BytesIO()
+    if fmt == 'PNG':
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        # quality='keep' reuses the original quantization: no new loss.
+        image.save(buffer, 'JPEG', quality='keep', optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _webp(image: Image.Image, width: int) -> bytes:
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, 'WEBP', quality=85, method=6)
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = ("Losslessly recompress PNG/JPEG files in STATICFILES_DIRS and write the WebP sizes "
+            "of RESPONSIVE_IMAGES. Run after adding images, before collectstatic.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report the savings.")
+
+    def handle(self, *args, **options):
+        saved = 0
+        for root in settings.STATICFILES_DIRS:
+            for directory, _, files in os.walk(root):
+                for filename in sorted(files):
+                    path = os.path.join(directory, filename)
+                    name = os.path.relpath(path, root).replace(os.sep, '/')
+                    if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                        saved += self._optimize(path, name, options['dry_run'])
+                    if name in RESPONSIVE_IMAGES and not options['dry_run']:
+                        self._responsive(path, RESPONSIVE_IMAGES[name])
+        self.stdout.write(self.style.SUCCESS(f"Saved {saved // 1024} KiB."))
+
+    def _optimize(self, path: str, name: str, dry_run: bool) -> int:
+        with Image.open(path) as image:
+            image.load()
+            data = _recompress(image, 'PNG' if image.format == 'PNG' else 'JPEG')
+        before = os.path.getsize(path)
+        if len(data) >= before:
+            return 0
+        self.stdout.write(f"{name}: {before // 1024} -> {len(data) // 1024} KiB")
+        if not dry_run:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return before - len(data)
+
+    def _responsive(self, path: str, widths) -> None:
+        stem = os.path.splitext(path)[0]
+        with Image.open(path) as image:
+            image.load()
+            for width in widths:
+                target = f"{stem}-{width}.webp"
+                with open(target, 'wb') as f:
+                    f.write(_webp(image, width))
+                self.stdout.write(f"{os.path.basename(target)}: {os.path.getsize(target) // 1024} KiB")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from backend import search
+
+
+class Command(BaseCommand):
+    help = ("Recreate the full-text index of messages (e.g. after a migration rebuilt the message "
+            "table on SQLite, which drops its triggers).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drop', action='store_true', help="Drop the index first and build it from scratch.")
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            self.stdout.write(f"No full-text index on {connection.vendor}; search scans the table.")
+            return
+        if options['drop']:
+            search.uninstall()
+        search.install()
+        self.stdout.write(self.style.SUCCESS("Search index ready."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from backend import stats
+
+
+class Command(BaseCommand):
+    help = ("Recompute the message counters of conversations and the usage counters of characters "
+            "from the stored messages (after imports, bulk loads or upgrades).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Conversations updated per statement.")
+        parser.add_argument('--skip-characters', action='store_true',
+                            help="Leave character counters alone (they also count conversations removed by retention).")
+
+    def handle(self, *args, **options):
+        updated = stats.recount_conversations(batch_size=options['batch_size'])
+        self.stdout.write(f"Recounted {updated} conversations.")
+
+        if options['skip_characters']:
+            return
+        stats.recount_characters()
+        self.stdout.write(self.style.SUCCESS("Recounted character usage."))
@@ -0,0 +1,52 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backend import jobs
+
+
+class Command(BaseCommand):
+    help = "Run chat completions queued by /api/chat/ in job mode (CHAT_JOB_MODE)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'CHAT_JOB_CONCURRENCY', 8),
+                            help="Completions running at the same time.")
+        parser.add_argument('--rate-limit', type=int, default=getattr(settings, 'CHAT_JOB_CHARACTER_RATE_LIMIT', 0),
+                            help="Max completions started per character per minute (0 = no limit), "
+                                 "shared by all workers when CHAT_ADMISSION_CACHE is a shared cache.")
+        parser.add_argument('--poll-interval', type=float, default=0.5)
+        parser.add_argument('--once', action='store_true', help="Drain the queue and exit.")
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        limiter = jobs.CharacterRateLimiter(options['rate_limit'])
+        running = set()
+        last_requeue = 0.0
+
+        self.stdout.write(f"Chat worker started (concurrency {concurrency}).")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='chat-job') as executor:
+            while True:
+                if time.monotonic() - last_requeue > 30:
+                    requeued = jobs.requeue_stale()
+                    if requeued:
+                        self.stdout.write(f"Requeued {requeued} stale jobs.")
+                    last_requeue = time.monotonic()
+
+                running = {future for future in running if not future.done()}
+                claimed = False
+                while len(running) < concurrency:
+                    job = jobs.claim_next(exclude_character_ids=limiter.blocked())
+                    if job is None:
+                        break
+                    if not limiter.allow(job.character_id):
+                        jobs.unclaim(job)
+                        continue
+                    running.add(executor.submit(jobs.run_job_in_thread, job))
+                    claimed = True
+
+                if options['once'] and not claimed and not running:
+                    break
+                if not claimed:
+                    time.sleep(options['poll_interval'])
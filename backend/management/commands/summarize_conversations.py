@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Q
+
+from backend.models import Conversation
+from backend.summarization import keep_recent, needs_summary, summarize_conversation
+
+
+class Command(BaseCommand):
+    help = "Fold old messages of long conversations into their rolling summaries."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversation', type=int, action='append', dest='conversations',
+                            help="Only this conversation id (repeatable).")
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.all()
+        if options['conversations']:
+            conversations = conversations.filter(id__in=options['conversations'])
+        conversations = conversations.annotate(
+            pending=Count('messages', filter=(
+                Q(summary_until__isnull=True)
+                | Q(messages__timestamp__gt=F('summary_until'))
+                | Q(messages__timestamp=F('summary_until'), messages__id__gt=F('summary_until_id'))
+            )),
+        ).filter(pending__gte=keep_recent())
+
+        total = 0
+        for conversation_id, pending in conversations.values_list('id', 'pending').iterator():
+            if not needs_summary(pending):
+                continue
+            folded = summarize_conversation(conversation_id)
+            total += folded
+            self.stdout.write(f"Conversation {conversation_id}: folded {folded} messages")
+        self.stdout.write(self.style.SUCCESS(f"Done, {total} messages summarized."))
@@ -0,0 +1,372 @@
+"""
+Per-request performance metrics.
+
+``RequestMetricsMiddleware`` times every request and collects what happened
+inside it: DB queries (count and time, via an execute wrapper installed on
+every connection), LLM calls (latency, time to first streamed token,
+prompt/completion tokens) and template rendering. Each request gets a
+``Server-Timing`` header and one JSON line on the ``backend.metrics``
+logger, and the numbers feed per-process histograms served in the
+Prometheus text format by ``/admin/metrics/``.
+
+Streaming responses send their headers before the completion runs, so
+their ``Server-Timing`` only covers the work up to that point; the log line
+and the histograms are recorded when the stream ends.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+logger = logging.getLogger('backend.metrics')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in sorted(series):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key, le=bound)} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(key, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(key)} {value}" for key, value in values)
+        return lines
+
+
+def _escape(value) -> str:
+    # The exposition format escapes backslash, double quote and line feed
+    # in label values (backend names come from settings, free-form).
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(key: Tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+REQUEST_SECONDS = Histogram('chat_request_duration_seconds', "Request handling time.", SECONDS_BUCKETS)
+REQUEST_DB_QUERIES = Histogram('chat_request_db_queries', "DB queries per request.", QUERY_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('chat_request_db_seconds', "DB time per request.", SECONDS_BUCKETS)
+REQUEST_RENDER_SECONDS = Histogram('chat_request_render_seconds', "Template rendering time per request.",
+                                   SECONDS_BUCKETS)
+LLM_SECONDS = Histogram('chat_llm_duration_seconds', "LLM call time, until the last token.", SECONDS_BUCKETS)
+LLM_TTFT_SECONDS = Histogram('chat_llm_time_to_first_token_seconds', "Time to the first streamed token.",
+                             SECONDS_BUCKETS)
+LLM_CALLS = Counter('chat_llm_calls_total', "LLM calls by outcome (ok, error, cached).")
+LLM_TOKENS = Counter('chat_llm_tokens_total', "Tokens reported by the LLM API.")
+LLM_BACKEND_CALLS = Counter('chat_llm_backend_calls_total',
+                            "Attempts per LLM backend by outcome (ok, error, busy).")
+ADMISSION_REJECTED = Counter('chat_admission_rejected_total',
+                             "Chat requests answered 429 by limit (client, character, in_flight).")
+
+REGISTRY = (
+    REQUEST_SECONDS, REQUEST_DB_QUERIES, REQUEST_DB_SECONDS, REQUEST_RENDER_SECONDS,
+    LLM_SECONDS, LLM_TTFT_SECONDS, LLM_CALLS, LLM_TOKENS, LLM_BACKEND_CALLS, ADMISSION_REJECTED,
+)
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.llm_calls = 0
+        self.llm_time = 0.0
+        self.llm_ttft: Optional[float] = None
+        self.llm_cached = False
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.render_time = 0.0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        parts = [f'db;dur={self.db_time * 1000:.1f};desc="{self.db_queries} queries"']
+        if self.llm_calls:
+            parts.append(f'llm;dur={self.llm_time * 1000:.1f}')
+        if self.llm_ttft is not None:
+            parts.append(f'ttft;dur={self.llm_ttft * 1000:.1f}')
+        if self.llm_cached:
+            parts.append('llm-cache;desc="hit"')
+        if self.render_time:
+            parts.append(f'render;dur={self.render_time * 1000:.1f}')
+        parts.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(parts)
+
+    def as_dict(self) -> dict:
+        return {
+            'duration_ms': round(self.elapsed() * 1000, 1),
+            'db_queries': self.db_queries,
+            'db_ms': round(self.db_time * 1000, 1),
+            'llm_calls': self.llm_calls,
+            'llm_ms': round(self.llm_time * 1000, 1),
+            'llm_ttft_ms': round(self.llm_ttft * 1000, 1) if self.llm_ttft is not None else None,
+            'llm_cached': self.llm_cached,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'render_ms': round(self.render_time * 1000, 1),
+        }
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_queries += 1
+        metrics.db_time += time.perf_counter() - started
+
+
+def instrument_connection(connection) -> None:
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+@contextmanager
+def rendering():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.render_time += time.perf_counter() - started
+
+
+class LLMCall:
+    """Timing of one completion; see ``llm_call``."""
+
+    def __init__(self, stream: bool):
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.outcome = 'ok'
+        self.backend: Optional[str] = None  # the LLM backend tried last
+        # Deadline of the current attempt when another backend is left to
+        # fall back to (LLM_ATTEMPT_TIMEOUT); None leaves the backend's own.
+        self.attempt_timeout: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def usage(self, usage) -> None:
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_tokens or 0
+            self.completion_tokens = usage.completion_tokens or 0
+
+    def failed(self) -> None:
+        self.outcome = 'error'
+
+    def _finish(self) -> None:
+        duration = time.perf_counter() - self.started
+        stream = 'true' if self.stream else 'false'
+        LLM_SECONDS.observe(duration, stream=stream)
+        if self.ttft is not None:
+            LLM_TTFT_SECONDS.observe(self.ttft)
+        LLM_CALLS.inc(outcome=self.outcome)
+        if self.prompt_tokens:
+            LLM_TOKENS.inc(self.prompt_tokens, kind='prompt')
+        if self.completion_tokens:
+            LLM_TOKENS.inc(self.completion_tokens, kind='completion')
+
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.llm_calls += 1
+            metrics.llm_time += duration
+            if self.ttft is not None and metrics.llm_ttft is None:
+                metrics.llm_ttft = self.ttft
+            metrics.prompt_tokens += self.prompt_tokens
+            metrics.completion_tokens += self.completion_tokens
+
+
+@contextmanager
+def llm_call(stream: bool = False):
+    call = LLMCall(stream)
+    try:
+        yield call
+    except Exception:
+        call.failed()
+        raise
+    finally:
+        call._finish()
+
+
+def record_cache_hit() -> None:
+    LLM_CALLS.inc(outcome='cached')
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.llm_cached = True
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, metrics)
+
+    def _finish(self, request, response, metrics: RequestMetrics):
+        response['Server-Timing'] = metrics.server_timing()
+        view = request.resolver_match.url_name if request.resolver_match else 'unmatched'
+        if response.streaming:
+            wrap = self._wrap_async if response.is_async else self._wrap_sync
+            response.streaming_content = wrap(response.streaming_content, request, response.status_code, view, metrics)
+        else:
+            _record(request, response.status_code, view, metrics)
+        return response
+
+    def _wrap_sync(self, content, request, status, view, metrics):
+        # Streamed bodies run after the middleware returned; put the
+        # request's metrics back in place around every chunk.
+        iterator = iter(content)
+        try:
+            while True:
+                token = _current.set(metrics)
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    _current.reset(token)
+                yield chunk
+        finally:
+            token = _current.set(metrics)
+            try:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+            finally:
+                _current.reset(token)
+            _record(request, status, view, metrics)
+
+    async def _wrap_async(self, content, request, status, view, metrics):
+        iterator = content.__aiter__()
+        try:
+            while True:
+                token = _current.set(metrics)
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    _current.reset(token)
+                yield chunk
+        finally:
+            token = _current.set(metrics)
+            try:
+                if hasattr(iterator, 'aclose'):
+                    await iterator.aclose()
+            finally:
+                _current.reset(token)
+            _record(request, status, view, metrics)
+
+
+def _record(request, status: int, view: str, metrics: RequestMetrics) -> None:
+    duration = metrics.elapsed()
+    REQUEST_SECONDS.observe(duration, view=view, method=request.method)
+    REQUEST_DB_QUERIES.observe(metrics.db_queries, view=view)
+    REQUEST_DB_SECONDS.observe(metrics.db_time, view=view)
+    if metrics.render_time:
+        REQUEST_RENDER_SECONDS.observe(metrics.render_time, view=view)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': status,
+            **metrics.as_dict(),
+        }))
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0005_character_short_description'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='context_token_budget',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(migrations.AddIndex):
+    """Build the index without blocking writes to the (large) table on
+    Postgres; other backends get a plain CREATE INDEX."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('backend', '0007_conversation_summary_and_more'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name='conversation',
+            index=models.Index(fields=['character', 'created_at'], name='conversation_char_created_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp'], name='message_conv_ts_idx'),
+        ),
+        # The composite index leads with conversation_id, so the FK's own
+        # index only costs writes. Dropped after the replacement exists.
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='backend.conversation'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0009_completionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='avatar_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
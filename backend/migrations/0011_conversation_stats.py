@@ -0,0 +1,108 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:46
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+# A frozen copy of backend.stats as of this migration: later changes to the
+# live module must not change what the migration does.
+
+def _aggregate(messages, expression, output_field=None):
+    rows = (messages.filter(conversation=OuterRef('pk'))
+            .order_by().values('conversation').annotate(value=expression).values('value'))
+    return Subquery(rows, output_field=output_field)
+
+
+def recount_conversations(apps, batch_size=500):
+    Conversation = apps.get_model('backend', 'Conversation')
+    messages = apps.get_model('backend', 'Message').objects.all()
+    last_id = 0
+    while True:
+        ids = list(Conversation.objects.filter(pk__gt=last_id).order_by('pk').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        Conversation.objects.filter(id__in=ids).update(
+            message_count=Coalesce(_aggregate(messages, Count('id'), IntegerField()), Value(0)),
+            user_message_count=Coalesce(
+                _aggregate(messages, Count('id', filter=Q(is_user=True)), IntegerField()), Value(0),
+            ),
+            token_total=Coalesce(_aggregate(messages, Sum('token_count'), IntegerField()), Value(0)),
+            last_message_at=_aggregate(messages, Max('timestamp')),
+        )
+        last_id = ids[-1]
+
+
+def recount_characters(apps):
+    Character = apps.get_model('backend', 'Character')
+    Conversation = apps.get_model('backend', 'Conversation')
+    for character in Character.objects.only('id').iterator():
+        stats = Conversation.objects.filter(character=character).aggregate(
+            conversations=Count('id'),
+            messages=Sum('message_count', default=0),
+            tokens=Sum('token_total', default=0),
+            last=Max('last_message_at'),
+        )
+        Character.objects.filter(id=character.id).update(
+            conversation_count=stats['conversations'],
+            message_count=stats['messages'],
+            token_total=stats['tokens'],
+            last_message_at=stats['last'],
+        )
+
+
+def recount_stats(apps, schema_editor):
+    # Existing rows start at 0; count their messages once.
+    recount_conversations(apps)
+    recount_characters(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0010_character_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='conversation_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='token_total',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='token_total',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(recount_stats, migrations.RunPython.noop),
+    ]
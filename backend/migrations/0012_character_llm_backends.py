@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0011_conversation_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='llm_backends',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from backend import search
+    search.install(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from backend import search
+    search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('backend', '0012_character_llm_backends'),
+    ]
+
+    operations = [
+        # Full-text index of Message.content (backend/search.py): GIN on
+        # Postgres, an FTS5 table with triggers on SQLite.
+        migrations.RunPython(install, uninstall, elidable=False),
+    ]
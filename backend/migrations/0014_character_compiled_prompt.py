@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:07
+
+import hashlib
+import unicodedata
+
+from django.db import migrations, models
+
+
+# A frozen copy of backend.prompts as of this migration: a later layout
+# change ships its own recompiling migration instead of altering this one.
+
+def _normalize(text):
+    text = unicodedata.normalize('NFC', text or '').replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).strip()
+
+
+def compile_prompt(character):
+    parts = [_normalize(character.description)]
+    persona = [
+        ('Imię postaci', character.name),
+        ('Kim jest postać', character.header_description),
+        ('Powitanie, od którego postać zaczyna rozmowę', character.greeting),
+    ]
+    lines = [f"{label}: {_normalize(value)}" for label, value in persona if _normalize(value)]
+    if lines:
+        parts.append('\n'.join(lines))
+    return '\n\n'.join(part for part in parts if part)
+
+
+def estimate_tokens(text):
+    # The default CHAT_TOKEN_COUNTER (backend.context.estimate_tokens).
+    return (len(text) + 2) // 3
+
+
+def compile_prompts(apps, schema_editor):
+    Character = apps.get_model('backend', 'Character')
+    for character in Character.objects.all():
+        text = compile_prompt(character)
+        character.compiled_prompt = text
+        character.prompt_token_count = estimate_tokens(text)
+        character.prompt_version = hashlib.sha256(text.encode()).hexdigest()[:16]
+        character.save(update_fields=['compiled_prompt', 'prompt_token_count', 'prompt_version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0013_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='compiled_prompt',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='prompt_token_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='prompt_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+        migrations.RunPython(compile_prompts, migrations.RunPython.noop),
+    ]
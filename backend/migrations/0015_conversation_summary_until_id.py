@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+def fill_summary_until_id(apps, schema_editor):
+    # The fold used to stop at a timestamp; the newest message stamped with
+    # it is the last one the summary covers.
+    Conversation = apps.get_model('backend', 'Conversation')
+    Message = apps.get_model('backend', 'Message')
+    last_folded = Message.objects.filter(
+        conversation=models.OuterRef('pk'), timestamp=models.OuterRef('summary_until'),
+    ).order_by('-id').values('id')[:1]
+    Conversation.objects.filter(summary_until__isnull=False).update(summary_until_id=models.Subquery(last_folded))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0014_character_compiled_prompt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_until_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_summary_until_id, migrations.RunPython.noop),
+    ]
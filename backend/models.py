@@ -1,4 +1,27 @@
-from django.db import models
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from . import avatars, prompts
+from .context import count_tokens
+from .llm_backends import parse_route
+
+
+logger = logging.getLogger(__name__)
+
+
+def _update_fields_without(instance, counters):
+    """Fields for a full save() that leaves the F()-maintained counters
+    alone, so a stale instance can't write back old values."""
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in counters
+    ]
+
 
 class Character(models.Model):
     name = models.CharField(max_length=200)
@@ -8,6 +31,20 @@ class Character(models.Model):
     description = models.TextField()  # opis i instrukcje dla GPT
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)  # wgrywany avatar
     avatar_url = models.URLField(blank=True, null=True)  # zewnętrzny avatar (opcjonalnie)
+    avatar_variants = models.JSONField(blank=True, default=dict, editable=False)  # miniatury avatara (backend/avatars.py)
+    context_token_budget = models.PositiveIntegerField(blank=True, null=True)  # limit tokenów promptu (domyślnie CHAT_CONTEXT_TOKEN_BUDGET)
+    llm_backends = models.CharField(max_length=200, blank=True, default='')  # nazwy z LLM_BACKENDS po przecinku, np. "local,openai" (domyślnie LLM_DEFAULT_ROUTE)
+    # Prompt systemowy skompilowany przy zapisie (backend/prompts.py)
+    compiled_prompt = models.TextField(blank=True, default='', editable=False)
+    prompt_token_count = models.PositiveIntegerField(default=0, editable=False)
+    prompt_version = models.CharField(max_length=16, blank=True, default='', editable=False)
+    # Liczniki użycia od początku istnienia postaci (nie maleją przy retencji)
+    conversation_count = models.PositiveIntegerField(default=0, editable=False)
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    token_total = models.PositiveBigIntegerField(default=0, editable=False)
+    last_message_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    STATS_FIELDS = ('conversation_count', 'message_count', 'token_total', 'last_message_at')
 
     class Meta:
         verbose_name = "Postać AI"
@@ -16,37 +53,166 @@ class Character(models.Model):
     def __str__(self):
         return self.name
 
+    def clean(self):
+        configured = getattr(settings, 'LLM_BACKENDS', {})
+        unknown = [name for name in parse_route(self.llm_backends) if name not in configured]
+        if unknown:
+            raise ValidationError({'llm_backends': (
+                f"Nieznane backendy: {', '.join(unknown)}. Dostępne: {', '.join(configured)}."
+            )})
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = _update_fields_without(self, self.STATS_FIELDS)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & set(prompts.SOURCE_FIELDS):
+            if prompts.compile_into(self) and update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(prompts.COMPILED_FIELDS)
+        if not self.avatar:
+            if not (self.avatar_url and self.avatar_variants.get('source') == self.avatar_url):
+                self.avatar_variants = {}  # kopię zewnętrznego avatara pobierze /avatar/<id>/
+        elif not self.avatar._committed:  # świeżo wgrany plik
+            try:
+                self.avatar_variants = avatars.render_variants(self.avatar)
+            except OSError as e:
+                logger.warning("Could not render avatar variants of character %s (%s): %s",
+                               self.pk, self.avatar.name, e)
+                self.avatar_variants = {}
+        super().save(*args, **kwargs)
+
     @property
     def display_avatar(self):
-        """Prefer local upload, then external URL."""
+        """Prefer local upload (resized variant), then the local copy of the external URL."""
         if self.avatar:
-            return self.avatar.url
+            return avatars.variant_url(self.avatar.storage, self.avatar_variants) or self.avatar.url
         if self.avatar_url:
-            return self.avatar_url
+            return avatars.external_url(self.id, self.avatar_url, self.avatar_variants)
         return None
 
+    @property
+    def avatar_srcset(self):
+        if self.avatar:
+            return avatars.srcset(self.avatar.storage, self.avatar_variants)
+        if self.avatar_url:
+            return avatars.external_srcset(self.id, self.avatar_url, self.avatar_variants)
+        return ''
+
 class Conversation(models.Model):
     character = models.ForeignKey(Character, on_delete=models.CASCADE, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
+    summary = models.TextField(blank=True, default='')  # streszczenie starszej części rozmowy
+    summary_until = models.DateTimeField(blank=True, null=True)  # timestamp ostatniej wiadomości ujętej w streszczeniu
+    summary_until_id = models.BigIntegerField(blank=True, null=True)  # jej id - rozstrzyga wiadomości o tym samym timestampie
+    summary_token_count = models.PositiveIntegerField(default=0)
+    # Liczniki aktualizowane przy każdej nowej wiadomości (Message.save)
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    user_message_count = models.PositiveIntegerField(default=0, editable=False)
+    token_total = models.PositiveIntegerField(default=0, editable=False)
+    last_message_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    STATS_FIELDS = ('message_count', 'user_message_count', 'token_total', 'last_message_at')
     
     class Meta:
         verbose_name = "Konwersacja"
         verbose_name_plural = "Konwersacje"
+        indexes = [
+            models.Index(fields=['character', 'created_at'], name='conversation_char_created_idx'),
+        ]
     
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = _update_fields_without(self, self.STATS_FIELDS)
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Character.objects.filter(pk=self.character_id).update(conversation_count=F('conversation_count') + 1)
+
     def __str__(self):
         return f"Rozmowa z {self.character.name} ({self.created_at.strftime('%d-%m-%Y, %H:%M')})"
 
 class Message(models.Model):
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    # Indeks (conversation, timestamp) z Meta obsługuje też zapytania po samym
+    # conversation_id, więc osobny indeks klucza obcego byłby zbędny.
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', db_index=False)
     is_user = models.BooleanField(default=True)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    token_count = models.PositiveIntegerField(blank=True, null=True)  # liczba tokenów treści, liczona przy zapisie
     
     class Meta:
         verbose_name = "Wiadomość"
         verbose_name_plural = "Wiadomości"
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation', 'timestamp'], name='message_conv_ts_idx'),
+        ]
     
+    def save(self, *args, **kwargs):
+        self.token_count = count_tokens(self.content)
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._count_in_stats([self])
+
+    @classmethod
+    def save_together(cls, messages):
+        """Insert new messages of one conversation in a single transaction,
+        with one counter update for all of them."""
+        with transaction.atomic():
+            for message in messages:
+                message.token_count = count_tokens(message.content)
+                # One INSERT each: auto_now_add keeps their timestamps in order.
+                super(Message, message).save()
+            cls._count_in_stats(messages)
+
+    @staticmethod
+    def _count_in_stats(messages):
+        tokens = sum(message.token_count or 0 for message in messages)
+        newest = max(message.timestamp for message in messages)
+        last = Greatest(Coalesce('last_message_at', Value(newest)), Value(newest))
+        Conversation.objects.filter(pk=messages[0].conversation_id).update(
+            message_count=F('message_count') + len(messages),
+            user_message_count=F('user_message_count') + sum(message.is_user for message in messages),
+            token_total=F('token_total') + tokens,
+            last_message_at=last,
+        )
+        Character.objects.filter(conversations=messages[0].conversation_id).update(
+            message_count=F('message_count') + len(messages),
+            token_total=F('token_total') + tokens,
+            last_message_at=last,
+        )
+
     def __str__(self):
         sender = "Użytkownik" if self.is_user else self.conversation.character.name
         return f"{sender}: {self.content[:30]}..."
+
+class CompletionJob(models.Model):
+    """Odpowiedź GPT zlecona w trybie kolejki (CHAT_JOB_MODE), liczona przez run_chat_worker."""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Oczekuje'
+        RUNNING = 'running', 'W trakcie'
+        DONE = 'done', 'Gotowe'
+        FAILED = 'failed', 'Błąd'
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='completion_jobs')
+    character = models.ForeignKey(Character, on_delete=models.CASCADE, related_name='completion_jobs')
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    response = models.ForeignKey(Message, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')  # wiadomość z odpowiedzią
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Zadanie GPT"
+        verbose_name_plural = "Zadania GPT"
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='job_status_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Zadanie #{self.id} ({self.status})"
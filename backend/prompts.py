@@ -0,0 +1,121 @@
+"""
+Compiled system prompts of characters.
+
+``Character.save()`` (so both ``CharacterForm`` and ``CharacterAdmin``)
+compiles the persona into one system prompt with a fixed layout: the
+instructions (``description``), then the name, header description and
+greeting. Text is normalized (NFC, ``\\n`` line ends, no trailing spaces),
+so the same character always sends byte-identical prompt bytes and the
+provider's prompt-prefix cache can hit. The row stores the text, its token
+count and ``prompt_version`` - a hash of the text.
+
+The chat path loads characters without the prompt text (it can be long);
+``for_character`` serves it from a per-process cache keyed by
+``(id, prompt_version)``, so an edit is picked up by every worker on its
+next turn and only that turn reads the text from the database.
+
+Changing ``compile_prompt`` needs a data migration recompiling existing
+characters (see ``0014_character_compiled_prompt``).
+"""
+
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+
+from .context import count_tokens
+
+
+# Fields the prompt is compiled from; saving any of them recompiles it.
+SOURCE_FIELDS = ('name', 'header_description', 'greeting', 'description')
+COMPILED_FIELDS = ('compiled_prompt', 'prompt_token_count', 'prompt_version')
+
+MAX_CACHED = 256
+
+
+class CompiledPrompt(NamedTuple):
+    text: str
+    token_count: int
+
+
+def _normalize(text) -> str:
+    text = unicodedata.normalize('NFC', text or '').replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).strip()
+
+
+def compile_prompt(character) -> str:
+    parts = [_normalize(character.description)]
+    persona = [
+        ('Imię postaci', character.name),
+        ('Kim jest postać', character.header_description),
+        ('Powitanie, od którego postać zaczyna rozmowę', character.greeting),
+    ]
+    lines = [f"{label}: {_normalize(value)}" for label, value in persona if _normalize(value)]
+    if lines:
+        parts.append('\n'.join(lines))
+    return '\n\n'.join(part for part in parts if part)
+
+
+def prompt_version(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def compile_into(character) -> bool:
+    """Recompile the character's prompt fields; True when they changed."""
+    text = compile_prompt(character)
+    if character.prompt_version and text == character.compiled_prompt:
+        return False
+    character.compiled_prompt = text
+    character.prompt_token_count = count_tokens(text)
+    character.prompt_version = prompt_version(text)
+    return True
+
+
+_cache: 'OrderedDict[tuple, CompiledPrompt]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cached(key: tuple):
+    with _lock:
+        prompt = _cache.get(key)
+        if prompt is not None:
+            _cache.move_to_end(key)
+        return prompt
+
+
+def _remember(key: tuple, prompt: CompiledPrompt) -> CompiledPrompt:
+    with _lock:
+        _cache[key] = prompt
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return prompt
+
+
+def for_character(character) -> CompiledPrompt:
+    key = (character.id, character.prompt_version)
+    prompt = _cached(key)
+    if prompt is not None:
+        return prompt
+    if not character.prompt_version:  # never compiled (e.g. created with bulk_create)
+        text = compile_prompt(character)
+        return CompiledPrompt(text, count_tokens(text))
+    if 'compiled_prompt' in character.get_deferred_fields():
+        row = (
+            type(character).objects.filter(id=character.id, prompt_version=character.prompt_version)
+            .values_list('compiled_prompt', 'prompt_token_count').first()
+        )
+        if row is None:  # edited since the character was loaded
+            character.refresh_from_db(fields=COMPILED_FIELDS)
+            return for_character(character)
+        return _remember(key, CompiledPrompt(*row))
+    return _remember(key, CompiledPrompt(character.compiled_prompt, character.prompt_token_count))
+
+
+async def afor_character(character) -> CompiledPrompt:
+    prompt = _cached((character.id, character.prompt_version))
+    if prompt is not None:
+        return prompt
+    return await sync_to_async(for_character)(character)
@@ -0,0 +1,106 @@
+"""
+Retention of old conversations, run by ``manage.py apply_retention`` (cron).
+
+* ``CHAT_RETENTION_EMPTY_HOURS``: conversations without a single user
+  message (just the greeting) are deleted this long after creation. New
+  chats are only written with their first message, so these are left over
+  from before that or from failed first requests.
+* ``CHAT_RETENTION_ARCHIVE_DAYS``: conversations without a message for this
+  many days are written to gzipped JSONL under ``CHAT_ARCHIVE_DIR``
+  (restorable with ``import_chat_data``) and deleted.
+
+0 disables a policy. Work goes in batches of ``CHAT_RETENTION_BATCH_SIZE``
+conversations and every delete statement commits on its own, so the
+message table is never locked for long.
+"""
+
+import os
+import time
+from datetime import timedelta
+from typing import Iterator, List
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils.timezone import now
+
+from . import chat_export
+from .models import CompletionJob, Conversation, Message
+
+
+def batch_size() -> int:
+    return getattr(settings, 'CHAT_RETENTION_BATCH_SIZE', 200)
+
+
+def empty_conversations(hours: int):
+    cutoff = now() - timedelta(hours=hours)
+    user_messages = Message.objects.filter(conversation=OuterRef('pk'), is_user=True)
+    return Conversation.objects.filter(created_at__lt=cutoff).exclude(Exists(user_messages))
+
+
+def inactive_conversations(days: int):
+    cutoff = now() - timedelta(days=days)
+    recent_messages = Message.objects.filter(conversation=OuterRef('pk'), timestamp__gte=cutoff)
+    return Conversation.objects.filter(created_at__lt=cutoff).exclude(Exists(recent_messages))
+
+
+def batches(conversations, size: int) -> Iterator[List[int]]:
+    """Ids of ``conversations``, ``size`` at a time, re-queried after each
+    batch (the caller deletes them)."""
+    while True:
+        ids = list(conversations.order_by('pk').values_list('id', flat=True)[:size])
+        if not ids:
+            return
+        yield ids
+
+
+def delete_conversations(conversation_ids: List[int], chunk: int = 1000) -> int:
+    """Delete conversations with their messages; returns messages deleted."""
+    CompletionJob.objects.filter(conversation_id__in=conversation_ids).delete()
+    deleted = 0
+    while True:
+        message_ids = list(
+            Message.objects.filter(conversation_id__in=conversation_ids).values_list('id', flat=True)[:chunk]
+        )
+        if not message_ids:
+            break
+        # only('id'): the collector must not pull message contents.
+        Message.objects.filter(id__in=message_ids).only('id').delete()
+        deleted += len(message_ids)
+    Conversation.objects.filter(id__in=conversation_ids).delete()
+    return deleted
+
+
+def archive_conversations(conversation_ids: List[int], directory: str) -> str:
+    """Write the conversations and their messages as ``import_chat_data``
+    files; returns the common file name prefix."""
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, f"{now():%Y%m%d-%H%M%S}-{conversation_ids[0]}")
+    for dataset in ('conversations', 'messages'):
+        path = f"{prefix}-{dataset}.jsonl.gz"
+        partial = path.removesuffix('.gz') + '.partial.gz'
+        with chat_export.open_stream(partial, 'w') as out:
+            chat_export.write_jsonl(
+                chat_export.export_rows(dataset, conversation_ids=conversation_ids),
+                chat_export.DATASETS[dataset]['fields'], out,
+            )
+        os.replace(partial, path)
+    return prefix
+
+
+def purge_empty(hours: int, size: int, pause: float = 0.0) -> int:
+    removed = 0
+    for ids in batches(empty_conversations(hours), size):
+        delete_conversations(ids)
+        removed += len(ids)
+        time.sleep(pause)
+    return removed
+
+
+def archive_inactive(days: int, size: int, directory: str, pause: float = 0.0) -> int:
+    archived = 0
+    for ids in batches(inactive_conversations(days), size):
+        archive_conversations(ids, directory)
+        delete_conversations(ids)
+        archived += len(ids)
+        time.sleep(pause)
+    return archived
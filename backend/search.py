@@ -0,0 +1,141 @@
+"""
+Full-text search over message contents, for staff.
+
+* PostgreSQL: a GIN expression index on ``to_tsvector('simple', content)``
+  (the ``simple`` configuration: Postgres ships no Polish stemmer); queries
+  use ``websearch_to_tsquery``, so quotes, ``OR`` and ``-word`` work.
+* SQLite: an external-content FTS5 table ``backend_message_fts`` kept in
+  sync by triggers; every word of the query must match.
+* Anything else falls back to ``icontains`` per word (a table scan).
+
+SQLite drops triggers when Django rebuilds ``backend_message`` during a
+migration that alters it; ``manage.py rebuild_search_index`` puts the
+index back (it is idempotent).
+
+Results are newest first and paginated by message id (keyset), so a page
+never needs a count of all matches.
+"""
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .models import Message
+
+
+POSTGRES_INDEX = 'message_content_search_idx'
+SQLITE_TABLE = 'backend_message_fts'
+
+POSTGRES_INSTALL = [
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {POSTGRES_INDEX} ON backend_message "
+    f"USING gin (to_tsvector('simple', content))",
+]
+POSTGRES_UNINSTALL = [f"DROP INDEX CONCURRENTLY IF EXISTS {POSTGRES_INDEX}"]
+
+SQLITE_INSTALL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} USING fts5("
+    f"content, content='backend_message', content_rowid='id')",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_ai AFTER INSERT ON backend_message BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}(rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_ad AFTER DELETE ON backend_message BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_au AFTER UPDATE OF content ON backend_message BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+    f"INSERT INTO {SQLITE_TABLE}(rowid, content) VALUES (new.id, new.content); END",
+    f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('rebuild')",
+]
+SQLITE_UNINSTALL = [
+    f"DROP TRIGGER IF EXISTS {SQLITE_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {SQLITE_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {SQLITE_TABLE}_au",
+    f"DROP TABLE IF EXISTS {SQLITE_TABLE}",
+]
+
+
+def _run(db, statements: List[str]) -> None:
+    with db.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def install(db=connection) -> None:
+    """Create the index for this database (no-op where unsupported)."""
+    if db.vendor == 'postgresql':
+        _run(db, POSTGRES_INSTALL)
+    elif db.vendor == 'sqlite':
+        _run(db, SQLITE_INSTALL)
+
+
+def uninstall(db=connection) -> None:
+    if db.vendor == 'postgresql':
+        _run(db, POSTGRES_UNINSTALL)
+    elif db.vendor == 'sqlite':
+        _run(db, SQLITE_UNINSTALL)
+
+
+def page_size() -> int:
+    return getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 50)
+
+
+def _fts5_query(query: str) -> str:
+    # Every word as a quoted phrase: user input can't produce FTS5 syntax.
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+
+def _matching(messages, query: str):
+    if connection.vendor == 'postgresql':
+        return messages.filter(RawSQL(
+            "to_tsvector('simple', backend_message.content) @@ websearch_to_tsquery('simple', %s)",
+            (query,), output_field=BooleanField(),
+        ))
+    if connection.vendor == 'sqlite':
+        return messages.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s", (_fts5_query(query),),
+        ))
+    for word in query.split():
+        messages = messages.filter(content__icontains=word)
+    return messages
+
+
+def search(query: str, character_id: Optional[int] = None, since: Optional[datetime] = None,
+           until: Optional[datetime] = None, is_user: Optional[bool] = None,
+           before: Optional[int] = None) -> Tuple[List[Message], Optional[int]]:
+    """Newest-first page of messages matching ``query`` and the cursor
+    (``before``) of the next page, ``None`` on the last one."""
+    limit = page_size()
+    messages = _matching(Message.objects.all(), query)
+    if character_id is not None:
+        messages = messages.filter(conversation__character_id=character_id)
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+    if until is not None:
+        messages = messages.filter(timestamp__lt=until)
+    if is_user is not None:
+        messages = messages.filter(is_user=is_user)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    rows = list(
+        messages.select_related('conversation__character')
+        .only('id', 'is_user', 'content', 'timestamp', 'conversation__id',
+              'conversation__character__id', 'conversation__character__name')
+        .order_by('-id')[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, rows[-1].id if has_more else None
+
+
+def serialize(message: Message) -> dict:
+    return {
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'character_id': message.conversation.character_id,
+        'character': message.conversation.character.name,
+        'is_user': message.is_user,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
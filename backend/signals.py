@@ -0,0 +1,19 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog, completion_cache, metrics
+from .models import Character
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+def invalidate_character_caches(sender, instance, **kwargs):
+    # Covers both CharacterForm (admin_character_form) and CharacterAdmin.
+    completion_cache.invalidate_character(instance.id)
+    catalog.invalidate()
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    metrics.instrument_connection(connection)
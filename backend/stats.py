@@ -0,0 +1,59 @@
+"""
+Recount of the denormalized usage counters (``Conversation.STATS_FIELDS``,
+``Character.STATS_FIELDS``) from the stored messages.
+
+Message saves keep the counters current; a recount is only needed after
+bulk loads, imports or manual changes (``recount_conversation_stats``). The
+``0011_conversation_stats`` migration backfilled the counters with a frozen
+copy of these functions.
+"""
+
+from django.apps import apps as global_apps
+from django.db.models import Count, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def _aggregate(messages, expression, output_field=None):
+    rows = (messages.filter(conversation=OuterRef('pk'))
+            .order_by().values('conversation').annotate(value=expression).values('value'))
+    return Subquery(rows, output_field=output_field)
+
+
+def recount_conversations(apps=global_apps, batch_size: int = 500) -> int:
+    """Recount every conversation, ``batch_size`` per UPDATE; returns how many."""
+    Conversation = apps.get_model('backend', 'Conversation')
+    messages = apps.get_model('backend', 'Message').objects.all()
+    last_id, updated = 0, 0
+    while True:
+        ids = list(Conversation.objects.filter(pk__gt=last_id).order_by('pk').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return updated
+        Conversation.objects.filter(id__in=ids).update(
+            message_count=Coalesce(_aggregate(messages, Count('id'), IntegerField()), Value(0)),
+            user_message_count=Coalesce(
+                _aggregate(messages, Count('id', filter=Q(is_user=True)), IntegerField()), Value(0),
+            ),
+            token_total=Coalesce(_aggregate(messages, Sum('token_count'), IntegerField()), Value(0)),
+            last_message_at=_aggregate(messages, Max('timestamp')),
+        )
+        last_id, updated = ids[-1], updated + len(ids)
+
+
+def recount_characters(apps=global_apps) -> None:
+    """Character counters from their conversations' (recounted) counters.
+    Usage of conversations deleted by retention is lost."""
+    Character = apps.get_model('backend', 'Character')
+    Conversation = apps.get_model('backend', 'Conversation')
+    for character in Character.objects.only('id').iterator():
+        stats = Conversation.objects.filter(character=character).aggregate(
+            conversations=Count('id'),
+            messages=Sum('message_count', default=0),
+            tokens=Sum('token_total', default=0),
+            last=Max('last_message_at'),
+        )
+        Character.objects.filter(id=character.id).update(
+            conversation_count=stats['conversations'],
+            message_count=stats['messages'],
+            token_total=stats['tokens'],
+            last_message_at=stats['last'],
+        )
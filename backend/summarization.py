@@ -0,0 +1,165 @@
+"""
+Rolling conversation summaries.
+
+Once enough messages pile up past the stored summary, everything except
+the newest ``CHAT_SUMMARY_KEEP_RECENT`` messages is folded into
+``Conversation.summary``. The fold is incremental: the model sees the
+previous summary and the new messages only. ``context.build_payload`` then
+sends system prompt + summary + messages past the summary cursor, so the
+prompt size stays flat however long the chat runs.
+
+The work runs on a small per-process thread pool, off the request path.
+With ``CHAT_SUMMARY_WORKERS=0`` nothing runs in-process and the
+``summarize_conversations`` management command (cron) does the work.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+
+from . import llm_backends, metrics
+from .context import MESSAGE_OVERHEAD_TOKENS, after_summary, count_tokens
+from .models import Conversation, Message
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Streszczasz rozmowę użytkownika z postacią {name}. Zaktualizuj dotychczasowe "
+    "streszczenie o nowe wiadomości. Zachowaj fakty o użytkowniku i jego pomyśle, "
+    "ustalenia, liczby oraz otwarte pytania; pomiń powitania i uprzejmości. "
+    "Odpowiedz samym streszczeniem, maksymalnie {words} słów."
+)
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_scheduled = set()
+
+
+def keep_recent() -> int:
+    return getattr(settings, 'CHAT_SUMMARY_KEEP_RECENT', 8)
+
+
+def needs_summary(unsummarized_count: int) -> bool:
+    trigger = getattr(settings, 'CHAT_SUMMARY_TRIGGER_MESSAGES', 12)
+    return unsummarized_count >= keep_recent() + trigger
+
+
+def _format_transcript(conversation: Conversation, messages: List[Message]) -> str:
+    name = conversation.character.name
+    return "\n".join(
+        f"{'Użytkownik' if msg.is_user else name}: {msg.content}" for msg in messages
+    )
+
+
+def _fold(conversation: Conversation, summary: str, messages: List[Message]) -> str:
+    prompt = [
+        {"role": "system", "content": SUMMARY_PROMPT.format(
+            name=conversation.character.name,
+            words=getattr(settings, 'CHAT_SUMMARY_MAX_WORDS', 200),
+        )},
+        {"role": "user", "content": (
+            f"Dotychczasowe streszczenie:\n{summary or '(brak)'}\n\n"
+            f"Nowe wiadomości:\n{_format_transcript(conversation, messages)}"
+        )},
+    ]
+    with metrics.llm_call() as call:
+        return llm_backends.complete(conversation.character, prompt, call)
+
+
+def summarize_conversation(conversation_id: int) -> int:
+    """Fold pending messages into the summary; returns how many were folded."""
+    conversation = Conversation.objects.select_related('character').get(id=conversation_id)
+
+    # Everything older than the newest keep_recent() messages is foldable.
+    kept = list(
+        conversation.messages.order_by('-timestamp', '-id')
+        .values_list('timestamp', 'id')[:keep_recent()]
+    )
+    if len(kept) < keep_recent():
+        return 0
+    cutoff_timestamp, cutoff_id = kept[-1]
+
+    chunk_tokens = getattr(settings, 'CHAT_SUMMARY_CHUNK_TOKENS', 2000)
+    folded = 0
+    while True:
+        pending = conversation.messages.filter(
+            Q(timestamp__lt=cutoff_timestamp) | Q(timestamp=cutoff_timestamp, id__lt=cutoff_id),
+        )
+        pending = after_summary(pending, conversation).order_by('timestamp', 'id').only(
+            'id', 'conversation', 'is_user', 'content', 'timestamp', 'token_count',
+        )[:200]
+
+        chunk, used = [], 0
+        for msg in pending:
+            cost = (msg.token_count or count_tokens(msg.content)) + MESSAGE_OVERHEAD_TOKENS
+            if chunk and used + cost > chunk_tokens:
+                break
+            chunk.append(msg)
+            used += cost
+        if not chunk:
+            return folded
+
+        summary = _fold(conversation, conversation.summary, chunk)
+        last = chunk[-1]
+        # Another worker may have folded the same range meanwhile; only the
+        # first write wins.
+        updated = Conversation.objects.filter(
+            id=conversation.id,
+            summary_until=conversation.summary_until,
+            summary_until_id=conversation.summary_until_id,
+        ).update(
+            summary=summary, summary_until=last.timestamp, summary_until_id=last.id,
+            summary_token_count=count_tokens(summary),
+        )
+        if not updated:
+            return folded
+
+        conversation.summary = summary
+        conversation.summary_until = last.timestamp
+        conversation.summary_until_id = last.id
+        folded += len(chunk)
+
+
+def _run(conversation_id: int) -> None:
+    close_old_connections()
+    try:
+        summarize_conversation(conversation_id)
+    except Exception:
+        logger.exception("Summary of conversation %s failed", conversation_id)
+    finally:
+        with _lock:
+            _scheduled.discard(conversation_id)
+        close_old_connections()
+
+
+def schedule_summary(conversation_id: int) -> None:
+    """Queue a background summary run; no-op if one is already queued."""
+    global _executor
+    workers = getattr(settings, 'CHAT_SUMMARY_WORKERS', 2)
+    if workers <= 0:
+        return
+    with _lock:
+        if conversation_id in _scheduled:
+            return
+        _scheduled.add(conversation_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='summary')
+    _executor.submit(_run, conversation_id)
+
+
+def _reset_after_fork() -> None:
+    global _executor, _lock
+    _executor = None
+    _lock = threading.Lock()
+    _scheduled.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,1267 @@
+import glob
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.templatetags.static import static
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path, resolve, reverse
+from django.utils.timezone import now
+from PIL import Image
+
+from . import (
+    admission, async_views, avatar_proxy, avatars, chat, chat_export, completion_cache, context, history, jobs,
+    llm_backends, metrics, prompts, search, summarization,
+)
+from . import urls as backend_urls
+from .models import Character, CompletionJob, Conversation, Message
+
+
+def make_chat(messages=0, **character_fields):
+    character = Character.objects.create(
+        name="Doradca", description="Jesteś doradcą biznesowym.", **character_fields,
+    )
+    conversation = Conversation.objects.create(character=character)
+    for i in range(messages):
+        Message.objects.create(conversation=conversation, is_user=i % 2 == 0, content=f"Wiadomość {i}")
+    return character, conversation
+
+
+class FailingBackend(llm_backends.BaseLLMBackend):
+    def complete(self, messages, call):
+        raise ConnectionError("upstream down")
+
+
+class EmptyBackend(llm_backends.BaseLLMBackend):
+    def stream(self, messages, call):
+        return iter(())
+
+    async def astream(self, messages, call):
+        return
+        yield
+
+
+def fake_backends(**backends):
+    """``override_settings`` for LLM_BACKENDS (name -> options), with the
+    backend instances of the previous settings dropped."""
+    llm_backends.get_backend.cache_clear()
+    return override_settings(LLM_BACKENDS=backends, LLM_DEFAULT_ROUTE=list(backends))
+
+
+class AtomicCheckingBackend(llm_backends.FakeBackend):
+    """Records for every call whether a transaction was open around it."""
+
+    in_atomic_block = []
+
+    def complete(self, messages, call):
+        self.in_atomic_block.append(connection.in_atomic_block)
+        return super().complete(messages, call)
+
+    def stream(self, messages, call):
+        self.in_atomic_block.append(connection.in_atomic_block)
+        yield from super().stream(messages, call)
+
+
+# TransactionTestCase: TestCase wraps each test in a transaction, so every
+# atomic() in the code under test would add SAVEPOINT queries to the counts.
+class MessageQueryTests(TransactionTestCase):
+    def setUp(self):
+        prompts._cache.clear()
+        self.character, self.conversation = make_chat(messages=6)
+
+    def assertUsesIndex(self, queryset, index):
+        if connection.vendor != 'sqlite':
+            self.skipTest("query plans are checked on SQLite")
+        self.assertIn(index, queryset.explain())
+
+    def test_history_window_uses_conversation_index(self):
+        self.assertUsesIndex(context.history_window(self.conversation), 'message_conv_ts_idx')
+
+    def test_history_page_uses_conversation_index(self):
+        messages = Message.objects.filter(conversation_id=self.conversation.id)
+        self.assertUsesIndex(messages.order_by('-timestamp', '-id'), 'message_conv_ts_idx')
+        page, cursor = history.history_page(self.conversation.id)
+        self.assertEqual([msg.content for msg in page], [f"Wiadomość {i}" for i in range(6)])
+        self.assertIsNone(cursor)
+
+    def test_conversation_lookup_uses_character_index(self):
+        conversations = Conversation.objects.filter(character=self.character).order_by('-created_at')
+        self.assertUsesIndex(conversations, 'conversation_char_created_idx')
+
+    def test_chat_turn_queries(self):
+        prompts.for_character(self.character)  # warm the compiled prompt cache
+        user_message = Message(conversation=self.conversation, is_user=True, content="Jak zacząć?")
+        # The history window, then BEGIN, the two INSERTs, the two counter
+        # UPDATEs and COMMIT.
+        with self.assertNumQueries(7):
+            payload = chat.build_message_payload(self.conversation, self.character, user_message)
+            chat.save_turn(user_message, "Od planu.")
+        self.assertEqual(payload[-1], {'role': 'user', 'content': "Jak zacząć?"})
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 8)
+
+    def test_history_window_loads_no_parent_per_row(self):
+        with self.assertNumQueries(1):
+            rows = list(context.history_window(self.conversation))
+            self.assertEqual({msg.conversation_id for msg in rows}, {self.conversation.id})
+
+    def test_summary_loads_no_parent_per_row(self):
+        self.addCleanup(llm_backends.get_backend.cache_clear)
+        _, conversation = make_chat(messages=30)
+        with fake_backends(fake={'BACKEND': 'backend.llm_backends.FakeBackend'}), \
+                self.settings(CHAT_SUMMARY_KEEP_RECENT=8, CHAT_SUMMARY_CHUNK_TOKENS=2000):
+            # The conversation, the kept timestamps, one chunk of 22 messages
+            # and its UPDATE, then the empty next chunk.
+            with self.assertNumQueries(5):
+                self.assertEqual(summarization.summarize_conversation(conversation.id), 22)
+
+
+class PayloadTests(SimpleTestCase):
+    prompt = prompts.CompiledPrompt("Jesteś doradcą.", 20)
+
+    def build(self, budget, token_counts, **conversation_fields):
+        character = Character(context_token_budget=budget)
+        conversation = Conversation(character=character, **conversation_fields)
+        # Newest first, as history_window returns them.
+        newest_first = [
+            Message(is_user=i % 2 == 0, content=f"Wiadomość {i}", token_count=tokens)
+            for i, tokens in reversed(list(enumerate(token_counts)))
+        ]
+        return context.build_payload(character, conversation, newest_first, self.prompt)
+
+    def test_packs_newest_messages_within_budget(self):
+        # 100 - 20 - 4 leaves room for five messages of 10 + 4 tokens.
+        payload = self.build(100, [10] * 8)
+        self.assertEqual(payload[0], {'role': 'system', 'content': "Jesteś doradcą."})
+        self.assertEqual([msg['content'] for msg in payload[1:]], [f"Wiadomość {i}" for i in range(3, 8)])
+        self.assertEqual([msg['role'] for msg in payload[1:3]], ['assistant', 'user'])
+
+    def test_newest_message_is_sent_over_budget(self):
+        payload = self.build(30, [10, 500])
+        self.assertEqual([msg['content'] for msg in payload[1:]], ["Wiadomość 1"])
+
+    def test_stops_at_first_message_that_does_not_fit(self):
+        # An older, smaller message must not be sent without the one between.
+        payload = self.build(50, [1, 40, 10])
+        self.assertEqual([msg['content'] for msg in payload[1:]], ["Wiadomość 2"])
+
+    def test_summary_counts_against_budget(self):
+        payload = self.build(100, [10] * 8, summary="Klient pyta o plan.", summary_token_count=28)
+        self.assertEqual(payload[1], {
+            'role': 'system', 'content': "Streszczenie wcześniejszej części rozmowy:\nKlient pyta o plan.",
+        })
+        # 76 - 28 - 4 leaves room for three messages.
+        self.assertEqual([msg['content'] for msg in payload[2:]], [f"Wiadomość {i}" for i in range(5, 8)])
+
+    def test_default_budget(self):
+        with self.settings(CHAT_CONTEXT_TOKEN_BUDGET=66):
+            payload = self.build(None, [10] * 8)
+        self.assertEqual(len(payload), 1 + 3)
+
+
+class CompiledPromptTests(TestCase):
+    def setUp(self):
+        prompts._cache.clear()
+        self.character = Character.objects.create(
+            name="Doradca", header_description="Ekspert od finansów  ", greeting="Cześć!\r\nW czym pomóc?",
+            description="  Jesteś doradcą.\r\nOdpowiadaj krótko.   \n",
+        )
+
+    def lazy(self):
+        return Character.objects.defer('compiled_prompt').get(id=self.character.id)
+
+    def test_layout(self):
+        self.assertEqual(self.character.compiled_prompt, (
+            "Jesteś doradcą.\nOdpowiadaj krótko.\n\n"
+            "Imię postaci: Doradca\n"
+            "Kim jest postać: Ekspert od finansów\n"
+            "Powitanie, od którego postać zaczyna rozmowę: Cześć!\nW czym pomóc?"
+        ))
+        self.assertEqual(self.character.prompt_version, prompts.prompt_version(self.character.compiled_prompt))
+        self.assertEqual(self.character.prompt_token_count, context.count_tokens(self.character.compiled_prompt))
+
+    def test_empty_persona_fields_are_left_out(self):
+        character = Character.objects.create(name="", description="Jesteś doradcą.")
+        self.assertEqual(character.compiled_prompt, "Jesteś doradcą.")
+
+    def test_version_follows_the_prompt_text(self):
+        version = self.character.prompt_version
+        self.character.llm_backends = 'fake'
+        self.character.description += "  "
+        self.character.save()
+        self.assertEqual(self.character.prompt_version, version)
+
+        self.character.greeting = "Dzień dobry!"
+        self.character.save()
+        self.assertNotEqual(self.character.prompt_version, version)
+        self.assertEqual(Character.objects.get(id=self.character.id).prompt_version, self.character.prompt_version)
+
+    def test_cache_misses_after_edit(self):
+        self.assertEqual(prompts.for_character(self.lazy()).text, self.character.compiled_prompt)
+        character = self.lazy()
+        with self.assertNumQueries(0):
+            self.assertEqual(prompts.for_character(character).text, self.character.compiled_prompt)
+
+        self.character.name = "Mentor"
+        self.character.save()
+        character = self.lazy()
+        with self.assertNumQueries(1):
+            prompt = prompts.for_character(character)
+        self.assertIn("Imię postaci: Mentor", prompt.text)
+
+    def test_stale_instance_reloads_prompt(self):
+        stale = self.lazy()
+        self.character.name = "Mentor"
+        self.character.save()
+        # The versioned lookup finds no row, so the fields are refreshed.
+        with self.assertNumQueries(2):
+            prompt = prompts.for_character(stale)
+        self.assertIn("Imię postaci: Mentor", prompt.text)
+        self.assertEqual(stale.prompt_version, self.character.prompt_version)
+
+
+class SummaryCursorTests(TestCase):
+    def setUp(self):
+        overrides = fake_backends(fake={'BACKEND': 'backend.llm_backends.FakeBackend'})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(llm_backends.get_backend.cache_clear)
+
+    def test_messages_sharing_a_timestamp_are_folded_once(self):
+        _, conversation = make_chat(messages=6)
+        conversation.messages.update(timestamp=now())
+        ids = list(conversation.messages.order_by('id').values_list('id', flat=True))
+        # One message per chunk, so the cursor stops inside the group.
+        with self.settings(CHAT_SUMMARY_KEEP_RECENT=2, CHAT_SUMMARY_CHUNK_TOKENS=1):
+            self.assertEqual(summarization.summarize_conversation(conversation.id), 4)
+            self.assertEqual(summarization.summarize_conversation(conversation.id), 0)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.summary_until_id, ids[3])
+        self.assertEqual([msg.id for msg in context.history_window(conversation)], [ids[5], ids[4]])
+
+
+class CompletionJobTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.character, self.conversation = make_chat()
+
+    def enqueue(self):
+        return CompletionJob.objects.create(conversation=self.conversation, character=self.character)
+
+    def test_rate_limit_is_shared_through_the_cache(self):
+        # Two workers, each with its own limiter.
+        first, second = jobs.CharacterRateLimiter(2), jobs.CharacterRateLimiter(2)
+        self.assertTrue(first.allow(self.character.id))
+        self.assertTrue(second.allow(self.character.id))
+        self.assertFalse(first.allow(self.character.id))
+        self.assertEqual(first.blocked(), {self.character.id})
+        self.assertEqual(second.blocked(), set())
+
+    def test_unclaimed_job_goes_back_to_the_queue(self):
+        job = self.enqueue()
+        claimed = jobs.claim_next()
+        self.assertEqual(claimed.id, job.id)
+        jobs.unclaim(claimed)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.started_at), (CompletionJob.Status.PENDING, 0, None))
+        self.assertIsNone(jobs.claim_next(exclude_character_ids=[self.character.id]))
+        self.assertEqual(jobs.claim_next().id, job.id)
+
+
+def png_bytes(size=(300, 200)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class AvatarHost(BaseHTTPRequestHandler):
+    """Stand-in for an external image host: ``routes`` maps a path to
+    ``(status, headers, body)``."""
+
+    routes = {}
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        status, headers, body = self.routes.get(self.path, (404, {}, b''))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Transactional: the fetch runs on the proxy's thread, which only sees
+# committed rows.
+class AvatarVariantTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.character, _ = make_chat(avatar=SimpleUploadedFile('avatar.png', png_bytes(), content_type='image/png'))
+
+    def chat_page(self, character):
+        return self.client.get(reverse('chat'), {'character_id': character.id})
+
+    def test_upload_is_saved_as_square_webp_and_jpeg(self):
+        variants = self.character.avatar_variants
+        storage = self.character.avatar.storage
+        self.assertEqual(sorted(variants['webp'], key=int), ['64', '128', '192'])
+        for width, name in variants['webp'].items():
+            with storage.open(name) as f, Image.open(f) as image:
+                self.assertEqual((image.format, image.size), ('WEBP', (int(width), int(width))))
+        with storage.open(variants['jpeg']) as f, Image.open(f) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (128, 128)))
+        self.assertEqual(self.character.display_avatar, storage.url(variants['jpeg']))
+
+    def test_pages_offer_webp_with_jpeg_fallback(self):
+        source = f'<source type="image/webp" srcset="{self.character.avatar_srcset}"'
+        img = f'<img src="{self.character.display_avatar}"'
+        for response in (self.client.get(reverse('character_list')), self.chat_page(self.character)):
+            with self.subTest(response.request['PATH_INFO']):
+                self.assertContains(response, '<picture class="avatar-picture">')
+                self.assertContains(response, source)
+                self.assertContains(response, img)
+
+    def test_default_avatar_uses_static_variants(self):
+        character, _ = make_chat()
+        response = self.chat_page(character)
+        self.assertContains(response, f'<source type="image/webp" srcset="{avatars.default_srcset()}" sizes="90px">')
+        self.assertContains(response, f'<img src="{static(avatars.DEFAULT_AVATAR)}"')
+
+
+class AvatarProxyTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), AvatarHost)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        AvatarHost.hits.clear()
+        AvatarHost.routes = {
+            '/avatar.png': (200, {'Content-Type': 'image/png'}, png_bytes()),
+            '/moved.png': (302, {'Location': '/avatar.png'}, b''),
+            '/page.html': (200, {'Content-Type': 'text/html'}, b'<html></html>'),
+        }
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def wait_for_copy(self, character):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            character.refresh_from_db(fields=['avatar_variants'])
+            if character.avatar_variants.get('source') == character.avatar_url:
+                return character.avatar_variants
+            time.sleep(0.02)
+        self.fail("the avatar was not fetched in the background")
+
+    def test_download_follows_redirects(self):
+        self.assertEqual(avatar_proxy._download(self.url('/moved.png')), png_bytes())
+
+    def test_download_caps_size(self):
+        with self.settings(AVATAR_PROXY_MAX_BYTES=100):
+            with self.assertRaisesMessage(avatar_proxy.FetchError, "too large"):
+                avatar_proxy._download(self.url('/avatar.png'))
+
+    def test_download_rejects_other_content_types(self):
+        with self.assertRaisesMessage(avatar_proxy.FetchError, "not an image"):
+            avatar_proxy._download(self.url('/page.html'))
+
+    def test_first_request_gets_fallback_while_fetching_in_background(self):
+        character = Character.objects.create(name="A", description="d", avatar_url=self.url('/avatar.png'))
+        response = self.client.get(reverse('external_avatar', args=[character.id]))
+        self.assertRedirects(response, static(avatars.DEFAULT_AVATAR), fetch_redirect_response=False)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        variants = self.wait_for_copy(character)
+        response = self.client.get(reverse('external_avatar', args=[character.id]))
+        file_url = avatars.external_file_url(character.id, variants['jpeg'])
+        self.assertRedirects(response, file_url, fetch_redirect_response=False)
+
+        response = self.client.get(file_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        response.close()
+
+    def test_concurrent_first_requests_fetch_once(self):
+        character = Character.objects.create(name="A", description="d", avatar_url=self.url('/avatar.png'))
+        for _ in range(3):
+            self.client.get(reverse('external_avatar', args=[character.id]))
+        self.wait_for_copy(character)
+        self.assertEqual(AvatarHost.hits, ['/avatar.png'])
+
+    def test_failed_fetch_keeps_serving_the_fallback(self):
+        character = Character.objects.create(name="A", description="d", avatar_url=self.url('/page.html'))
+        with self.assertLogs('backend.avatar_proxy', 'WARNING'):
+            self.client.get(reverse('external_avatar', args=[character.id]))
+            self.assertTrue(self.wait_for_copy(character)['failed'])
+        response = self.client.get(reverse('external_avatar', args=[character.id]))
+        self.assertRedirects(response, static(avatars.DEFAULT_AVATAR), fetch_redirect_response=False)
+        self.assertIn('max-age=300', response['Cache-Control'])
+        self.assertEqual(AvatarHost.hits, ['/page.html'])
+
+
+class ErrorLoggingTests(TestCase):
+    def setUp(self):
+        self.character, _ = make_chat()
+        self.addCleanup(llm_backends.get_backend.cache_clear)
+
+    def test_failed_completion_is_logged_with_backend_and_character(self):
+        with fake_backends(down={'BACKEND': 'backend.tests.FailingBackend'}):
+            with self.assertLogs('backend', 'WARNING') as logs:
+                answer = chat.complete(self.character, [{'role': 'user', 'content': "Hej"}], "Błąd")
+        self.assertEqual(answer, "Błąd")
+        self.assertIn(f"LLM backend down failed for character {self.character.id}", logs.output[0])
+        self.assertIn(f"Completion failed for character {self.character.id} (backend: down)", logs.output[1])
+        self.assertIn("ConnectionError: upstream down", logs.output[1])
+
+
+class ImportTests(TransactionTestCase):
+    def setUp(self):
+        self.character, self.conversation = make_chat()
+
+    def records(self, *ids):
+        return [
+            {'id': i, 'conversation_id': self.conversation.id, 'is_user': True,
+             'content': f"Wiadomość {i}", 'timestamp': f"2024-01-0{i}T12:00:00+00:00"}
+            for i in ids
+        ]
+
+    def timestamps(self):
+        return {msg.id: msg.timestamp.date().isoformat() for msg in Message.objects.all()}
+
+    def test_keeps_exported_timestamps(self):
+        count = chat_export.import_records('messages', self.records(1, 2, 3), batch_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(self.timestamps(), {1: '2024-01-01', 2: '2024-01-02', 3: '2024-01-03'})
+        self.assertTrue(Message._meta.get_field('timestamp').auto_now_add)
+
+    def test_ignore_conflicts_leaves_existing_rows_alone(self):
+        chat_export.import_records('messages', self.records(1))
+        Message.objects.filter(id=1).update(content="Bez zmian")
+        records = self.records(1, 2)
+        records[0]['timestamp'] = "2024-01-09T12:00:00+00:00"
+        self.assertEqual(chat_export.import_records('messages', records, ignore_conflicts=True), 1)
+        self.assertEqual(self.timestamps(), {1: '2024-01-01', 2: '2024-01-02'})
+        self.assertEqual(Message.objects.get(id=1).content, "Bez zmian")
+
+    def test_commits_each_batch(self):
+        records = self.records(1, 2, 3) + [dict(self.records(4)[0], conversation_id=999)]
+        with self.assertRaises(IntegrityError):
+            chat_export.import_records('messages', records, batch_size=2)
+        self.assertEqual(set(self.timestamps()), {1, 2})
+
+
+class MigrationTestCase(TransactionTestCase):
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+
+class StatsMigrationTests(MigrationTestCase):
+    before = [('backend', '0010_character_avatar_variants')]
+    after = [('backend', '0011_conversation_stats')]
+
+    def test_backfills_existing_conversations(self):
+        apps = self.migrate(self.before)
+        character = apps.get_model('backend', 'Character').objects.create(name="A", description="d")
+        conversation = apps.get_model('backend', 'Conversation').objects.create(character_id=character.id)
+        apps.get_model('backend', 'Conversation').objects.create(character_id=character.id)
+        Message = apps.get_model('backend', 'Message')
+        for is_user, tokens in ((True, 3), (False, 5), (True, 4)):
+            Message.objects.create(conversation_id=conversation.id, is_user=is_user, content="x", token_count=tokens)
+
+        apps = self.migrate(self.after)
+        conversation = apps.get_model('backend', 'Conversation').objects.get(id=conversation.id)
+        self.assertEqual((conversation.message_count, conversation.user_message_count, conversation.token_total),
+                         (3, 2, 12))
+        self.assertIsNotNone(conversation.last_message_at)
+        character = apps.get_model('backend', 'Character').objects.get(id=character.id)
+        self.assertEqual((character.conversation_count, character.message_count, character.token_total),
+                         (2, 3, 12))
+        self.assertEqual(character.last_message_at, conversation.last_message_at)
+
+
+class PromptMigrationTests(MigrationTestCase):
+    def test_compiles_existing_characters(self):
+        apps = self.migrate([('backend', '0013_message_search')])
+        Character = apps.get_model('backend', 'Character')
+        character = Character.objects.create(
+            name="Doradca", header_description="Ekspert", greeting="Cześć!\r\n", description=" Jesteś doradcą. ",
+        )
+
+        apps = self.migrate([('backend', '0014_character_compiled_prompt')])
+        migrated = apps.get_model('backend', 'Character').objects.get(id=character.id)
+        # The migration's frozen copy matches the current layout.
+        text = prompts.compile_prompt(migrated)
+        self.assertEqual(migrated.compiled_prompt, text)
+        self.assertEqual(migrated.prompt_version, prompts.prompt_version(text))
+        self.assertEqual(migrated.prompt_token_count, context.estimate_tokens(text))
+
+
+class ChatTestMixin:
+    """Chat endpoints answered by the fake backend, without completion
+    cache, rate limits or request logs."""
+
+    backend = 'backend.tests.AtomicCheckingBackend'
+    chat_settings = {
+        'CHAT_RATE_CLIENT': (0, 0),
+        'CHAT_RATE_CHARACTER': (0, 0),
+        'CHAT_COMPLETION_CACHE': {},
+        'CHAT_JOB_MODE': False,
+        'REQUEST_METRICS': False,
+    }
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        prompts._cache.clear()
+        for overrides in (fake_backends(fake={'BACKEND': self.backend}), self.settings(**self.chat_settings)):
+            overrides.enable()
+            self.addCleanup(overrides.disable)
+        completion_cache.get_completion_cache.cache_clear()
+        self.addCleanup(completion_cache.get_completion_cache.cache_clear)
+        self.addCleanup(llm_backends.get_backend.cache_clear)
+        self.character, _ = make_chat()
+
+    def post_json(self, name, **data):
+        return self.client.post(reverse(name), json.dumps(data), content_type='application/json')
+
+    def start_chat(self) -> int:
+        """First turn of a new conversation; returns its id."""
+        response = self.post_json('chat_api', character_id=self.character.id, message="Dzień dobry")
+        self.assertEqual(response.status_code, 200)
+        return int(response['X-Conversation-Id'])
+
+
+# Transactional, so the counts include BEGIN/COMMIT and in_atomic_block
+# shows the view's own transactions.
+class ChatTurnTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation_id = self.start_chat()
+        AtomicCheckingBackend.in_atomic_block.clear()
+
+    def turn(self, name):
+        response = self.post_json(name, character_id=self.character.id, conversation_id=self.conversation_id,
+                                  message="Jak zacząć?")
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+    # Session, conversation with its character, history window; then BEGIN,
+    # two INSERTs, two counter UPDATEs and COMMIT.
+
+    def test_api_turn_queries(self):
+        with self.assertNumQueries(9):
+            self.turn('chat_api')
+
+    def test_stream_turn_queries(self):
+        with self.assertNumQueries(9):
+            body = self.turn('chat_stream_api')
+        self.assertIn(b'"done": true', body)
+
+    def test_page_turn_queries(self):
+        # One more for the history page rendered with the answer.
+        with self.assertNumQueries(10):
+            response = self.client.post(reverse('chat'), {
+                'character_id': self.character.id, 'conversation_id': self.conversation_id, 'content': "Jak zacząć?",
+            })
+        self.assertEqual(response.status_code, 200)
+
+    def test_page_view_queries(self):
+        # Session, conversation with its character, history page.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('chat'), {'character_id': self.character.id})
+        self.assertContains(response, "Dzień dobry")
+
+    def test_no_transaction_open_during_llm_call(self):
+        # Also with ATOMIC_REQUESTS, which would wrap a plain view.
+        atomic_requests = connection.settings_dict['ATOMIC_REQUESTS']
+        connection.settings_dict['ATOMIC_REQUESTS'] = True
+        self.addCleanup(connection.settings_dict.__setitem__, 'ATOMIC_REQUESTS', atomic_requests)
+        self.turn('chat_api')
+        self.turn('chat_stream_api')
+        self.client.post(reverse('chat'), {
+            'character_id': self.character.id, 'conversation_id': self.conversation_id, 'content': "Jak zacząć?",
+        })
+        self.assertEqual(AtomicCheckingBackend.in_atomic_block, [False, False, False])
+        self.assertEqual(Message.objects.filter(conversation_id=self.conversation_id).count(), 2 + 3 * 2)
+
+
+class AsyncChatUrls:
+    """backend.urls as served with CHAT_ASYNC_VIEWS on."""
+
+    urlpatterns = [
+        path(str(pattern.pattern), getattr(async_views, pattern.callback.__name__), name=pattern.name)
+        if hasattr(async_views, pattern.callback.__name__) else pattern
+        for pattern in backend_urls.urlpatterns
+    ]
+
+
+class ChatViewTests(ChatTestMixin, TestCase):
+    """Runs against the sync views; AsyncChatViewTests repeats every test
+    against the async ones, which must answer the same."""
+
+    def request(self, method, name, **data):
+        if name in ('chat_api', 'chat_stream_api'):
+            return getattr(self.client, method)(reverse(name), json.dumps(data), content_type='application/json')
+        return getattr(self.client, method)(reverse(name), data)
+
+    def content(self, response) -> bytes:
+        return b''.join(response.streaming_content)
+
+    def conversations(self):
+        return Conversation.objects.filter(character=self.character)
+
+    def test_conversation_is_created_with_the_first_message(self):
+        self.character.greeting = "Witaj!"
+        self.character.save()
+        self.conversations().delete()
+        response = self.request('get', 'chat', character_id=self.character.id)
+        self.assertContains(response, "Witaj!")
+        self.assertFalse(self.conversations().exists())
+
+        response = self.request('post', 'chat', character_id=self.character.id, content="Jak zacząć?")
+        self.assertEqual(response.status_code, 200)
+        conversation = self.conversations().get()
+        self.assertEqual(list(conversation.messages.values_list('is_user', 'content')), [
+            (False, "Witaj!"), (True, "Jak zacząć?"), (False, mock.ANY),
+        ])
+
+    def test_api_turn(self):
+        response = self.request('post', 'chat_api', character_id=self.character.id, message="Jak zacząć?")
+        self.assertEqual(response.status_code, 200)
+        conversation = Conversation.objects.get(id=response['X-Conversation-Id'])
+        self.assertEqual(list(conversation.messages.values_list('is_user', 'content')), [
+            (True, "Jak zacząć?"), (False, response.json()['response']),
+        ])
+        # The session now points at it, so the next turn continues it.
+        response = self.request('post', 'chat_api', character_id=self.character.id, message="A potem?")
+        self.assertEqual(response['X-Conversation-Id'], str(conversation.id))
+        self.assertEqual(conversation.messages.count(), 4)
+
+    def test_stream_is_sse_ending_with_the_answer(self):
+        response = self.request('post', 'chat_stream_api', character_id=self.character.id, message="Jak zacząć?")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        frames = self.content(response).decode().split('\n\n')
+        self.assertEqual(frames.pop(), '')
+        self.assertTrue(all(frame.startswith('data: ') for frame in frames))
+        events = [json.loads(frame[len('data: '):]) for frame in frames]
+        *deltas, done = events
+        self.assertTrue(deltas)
+        self.assertEqual(done, {'done': True, 'error': False, 'response': ''.join(e['delta'] for e in deltas)})
+        conversation = Conversation.objects.get(id=response['X-Conversation-Id'])
+        self.assertEqual(conversation.messages.last().content, done['response'])
+
+    def test_history(self):
+        conversation_id = int(self.request('post', 'chat_api', character_id=self.character.id,
+                                           message="Jak zacząć?")['X-Conversation-Id'])
+        response = self.request('get', 'chat_history_api', character_id=self.character.id,
+                                conversation_id=conversation_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([msg['content'] for msg in response.json()['messages']][0], "Jak zacząć?")
+
+    def test_other_conversation_is_forbidden(self):
+        _, other = make_chat()
+        other.character = self.character
+        other.save()
+        for method, name, data in (
+            ('post', 'chat_api', {'message': "Hej"}),
+            ('post', 'chat_stream_api', {'message': "Hej"}),
+            ('get', 'chat_history_api', {}),
+        ):
+            with self.subTest(name):
+                response = self.request(method, name, character_id=self.character.id, conversation_id=other.id, **data)
+                self.assertEqual(response.status_code, 403)
+                self.assertEqual(response.json(), {'error': 'Nieautoryzowany dostęp do konwersacji'})
+        self.assertFalse(other.messages.exists())
+
+    def test_unknown_character(self):
+        missing = self.character.id + 1
+        self.assertEqual(self.request('get', 'chat', character_id=missing).status_code, 404)
+        self.assertEqual(self.request('post', 'chat_api', character_id=missing, message="Hej").status_code, 404)
+
+
+@override_settings(ROOT_URLCONF=AsyncChatUrls)
+class AsyncChatViewTests(ChatViewTests):
+    def request(self, method, name, **data):
+        client = self.async_client
+        if name in ('chat_api', 'chat_stream_api'):
+            call = getattr(client, method)(reverse(name), json.dumps(data), content_type='application/json')
+        else:
+            call = getattr(client, method)(reverse(name), data)
+
+        async def send():
+            return await call
+
+        return async_to_sync(send)()
+
+    def content(self, response) -> bytes:
+        async def consume():
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        return async_to_sync(consume)()
+
+    def test_urls_use_async_views(self):
+        self.assertIs(resolve(reverse('chat_api')).func, async_views.chat_api_view)
+
+
+class CompletionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def backends(self, **options):
+        return (
+            completion_cache.LocMemCompletionCache(**options),
+            completion_cache.DjangoCompletionCache(key_prefix='test-completion', **options),
+        )
+
+    def test_entries_expire(self):
+        for completions in self.backends(timeout=60):
+            with self.subTest(type(completions).__name__):
+                # LocMemCompletionCache reads the monotonic clock, the
+                # Django cache the wall clock.
+                with mock.patch('time.monotonic', return_value=1000.0), mock.patch('time.time', return_value=1000.0):
+                    completions.set(1, 'k', "Odpowiedź")
+                with mock.patch('time.monotonic', return_value=1059.0), mock.patch('time.time', return_value=1059.0):
+                    self.assertEqual(completions.get(1, 'k'), "Odpowiedź")
+                with mock.patch('time.monotonic', return_value=1061.0), mock.patch('time.time', return_value=1061.0):
+                    self.assertIsNone(completions.get(1, 'k'))
+                self.assertEqual({name: completions.stats()[name] for name in ('hits', 'misses')},
+                                 {'hits': 1, 'misses': 1})
+
+    def test_locmem_evicts_least_recently_used(self):
+        completions = completion_cache.LocMemCompletionCache(max_entries=2)
+        completions.set(1, 'a', "A")
+        completions.set(1, 'b', "B")
+        completions.get(1, 'a')
+        completions.set(1, 'c', "C")
+        self.assertIsNone(completions.get(1, 'b'))
+        self.assertEqual((completions.get(1, 'a'), completions.get(1, 'c')), ("A", "C"))
+        self.assertEqual(completions.stats(), {'hits': 3, 'misses': 1, 'entries': 2})
+
+    def test_invalidation_is_per_character(self):
+        for completions in self.backends():
+            with self.subTest(type(completions).__name__):
+                completions.set(1, 'k', "A")
+                completions.set(2, 'k', "B")
+                completions.invalidate_character(1)
+                self.assertIsNone(completions.get(1, 'k'))
+                self.assertEqual(completions.get(2, 'k'), "B")
+
+    def test_django_backend_rejects_max_entries(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "MAX_ENTRIES"):
+            completion_cache.DjangoCompletionCache(max_entries=10)
+
+
+class CompletionCacheInvalidationTests(ChatTestMixin, TestCase):
+    chat_settings = {
+        **ChatTestMixin.chat_settings,
+        'CHAT_COMPLETION_CACHE': {'BACKEND': 'backend.completion_cache.LocMemCompletionCache'},
+    }
+
+    def ask(self):
+        """The same opening from a new visitor; returns the cache stats."""
+        self.client.logout()
+        response = self.post_json('chat_api', character_id=self.character.id, message="Cześć")
+        self.assertEqual(response.status_code, 200)
+        return completion_cache.stats()
+
+    def test_saving_the_character_drops_its_answers(self):
+        staff = User.objects.create_superuser('staff', password='x')
+        # Unchanged fields keep prompt_version, so only the invalidation can
+        # make the next lookup miss.
+        data = {'name': self.character.name, 'description': self.character.description}
+        for url in (
+            reverse('edit_character', args=[self.character.id]),
+            reverse('admin:backend_character_change', args=[self.character.id]),
+        ):
+            with self.subTest(url):
+                stats = self.ask()
+                self.assertEqual(self.ask()['hits'], stats['hits'] + 1)
+                self.client.force_login(staff)
+                self.assertEqual(self.client.post(url, data).status_code, 302)
+                self.assertEqual(self.ask()['misses'], stats['misses'] + 1)
+
+
+class LandingPageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.character, _ = make_chat(short_description="Plany i finanse")
+
+    def page(self):
+        response = self.client.get(reverse('character_list'))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_warm_page_does_no_queries(self):
+        self.page()
+        with self.assertNumQueries(0):
+            response = self.page()
+        self.assertContains(response, "Plany i finanse")
+
+    def test_edits_show_up_on_the_next_request(self):
+        self.page()
+        self.character.name = "Mentor"
+        self.character.save()
+        added, _ = make_chat(short_description="Marketing")
+        response = self.page()
+        self.assertContains(response, "Mentor")
+        self.assertContains(response, "Marketing")
+        added.delete()
+        self.assertNotContains(self.page(), "Marketing")
+
+
+class RequestMetricsTests(ChatTestMixin, TestCase):
+    chat_settings = {**ChatTestMixin.chat_settings, 'REQUEST_METRICS': True, 'METRICS_TOKEN': 's3cret'}
+
+    def turn(self, name):
+        """Returns the response, its body and the request's log line."""
+        with self.assertLogs('backend.metrics', 'INFO') as logs:
+            response = self.post_json(name, character_id=self.character.id, message="Hej")
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertEqual(len(logs.records), 1)
+        return response, body, json.loads(logs.records[0].getMessage())
+
+    def test_server_timing_and_log_line(self):
+        response, _, line = self.turn('chat_api')
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", llm;dur=[\d.]+, total;dur=[\d.]+$')
+        self.assertEqual({key: line[key] for key in ('event', 'view', 'status', 'llm_calls')},
+                         {'event': 'request', 'view': 'chat_api', 'status': 200, 'llm_calls': 1})
+
+    def test_streamed_response_is_recorded_when_it_ends(self):
+        response, body, line = self.turn('chat_stream_api')
+        self.assertIn(b'"done": true', body)
+        # The header leaves before the completion runs.
+        self.assertNotIn('llm;', response['Server-Timing'])
+        self.assertEqual((line['view'], line['llm_calls']), ('chat_stream_api', 1))
+        self.assertIsNotNone(line['llm_ttft_ms'])
+        self.assertGreaterEqual(line['duration_ms'], line['llm_ms'])
+
+    def test_prometheus_endpoint_needs_staff_or_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer wrong'}).status_code, 302)
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer '}).status_code, 302)
+
+        self.post_json('chat_api', character_id=self.character.id, message="Hej")
+        response = self.client.get(url, headers={'Authorization': 'Bearer s3cret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertIn('# TYPE chat_request_duration_seconds histogram\n', text)
+        self.assertRegex(text, r'\nchat_request_duration_seconds_count\{method="POST",view="chat_api"\} \d+\n')
+        self.assertRegex(text, r'\nchat_llm_calls_total\{outcome="ok"\} [\d.]+\n')
+
+        self.client.force_login(User.objects.create_user('staff', password='x', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter('test_total', "Test.")
+        counter.inc(backend='a"b\\c\nd')
+        self.assertEqual(counter.render()[-1], 'test_total{backend="a\\"b\\\\c\\nd"} 1.0')
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        self.character, _ = make_chat()
+        Conversation.objects.all().delete()
+
+    def conversation(self, age, last_message=None):
+        """A conversation created ``age`` ago with a greeting, plus a user
+        message ``last_message`` ago unless that is None."""
+        conversation = Conversation.objects.create(character=self.character)
+        Conversation.objects.filter(id=conversation.id).update(created_at=now() - age)
+        greeting = Message.objects.create(conversation=conversation, is_user=False, content="Witaj!")
+        Message.objects.filter(id=greeting.id).update(timestamp=now() - age)
+        if last_message is not None:
+            message = Message.objects.create(conversation=conversation, is_user=True, content="Pytanie")
+            Message.objects.filter(id=message.id).update(timestamp=now() - last_message)
+        return conversation.id
+
+    def apply(self, **options):
+        out = io.StringIO()
+        options = {'empty_hours': 24, 'archive_days': 30, **options}
+        call_command('apply_retention', archive_dir=self.archive_dir, pause=0, stdout=out, **options)
+        return out.getvalue()
+
+    def archived(self, dataset):
+        """Rows of every archive file of ``dataset``, per file."""
+        files = sorted(glob.glob(os.path.join(self.archive_dir, f'*-{dataset}.jsonl.gz')))
+        result = []
+        for path in files:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                result.append([json.loads(line) for line in f])
+        return result
+
+    def test_deletes_empty_archives_inactive_keeps_the_rest(self):
+        day = timedelta(days=1)
+        fresh_empty = self.conversation(timedelta(hours=23))
+        old_empty = self.conversation(timedelta(hours=25))
+        active = self.conversation(100 * day, last_message=29 * day)
+        inactive = [self.conversation(100 * day, last_message=31 * day) for _ in range(3)]
+        # Inactive by messages, but created inside the window.
+        new_inactive = self.conversation(29 * day, last_message=29 * day)
+        CompletionJob.objects.create(conversation_id=inactive[0], character=self.character)
+
+        output = self.apply(batch_size=2)
+        self.assertIn("Deleted 1 greeting-only conversations.", output)
+        self.assertIn("Archived 3 conversations", output)
+
+        self.assertEqual(set(Conversation.objects.values_list('id', flat=True)), {fresh_empty, active, new_inactive})
+        self.assertEqual(set(Message.objects.values_list('conversation_id', flat=True)),
+                         {fresh_empty, active, new_inactive})
+        self.assertFalse(CompletionJob.objects.exists())
+
+        # Two batches of at most two conversations, one file pair each.
+        conversations = self.archived('conversations')
+        messages = self.archived('messages')
+        self.assertEqual([[row['id'] for row in batch] for batch in conversations], [inactive[:2], inactive[2:]])
+        self.assertEqual([sorted({row['conversation_id'] for row in batch}) for batch in messages],
+                         [inactive[:2], inactive[2:]])
+        self.assertEqual(sum(len(batch) for batch in messages), 2 * len(inactive))
+        self.assertNotIn(old_empty, [row['id'] for batch in conversations for row in batch])
+        self.assertEqual(glob.glob(os.path.join(self.archive_dir, '*.partial*')), [])
+
+    def test_archive_can_be_imported_back(self):
+        conversation_id = self.conversation(timedelta(days=40), last_message=timedelta(days=40))
+        messages = Message.objects.filter(conversation_id=conversation_id).values_list('id', 'content', 'timestamp')
+        original = list(messages)
+        self.apply()
+        self.assertFalse(Conversation.objects.exists())
+        for dataset in ('conversations', 'messages'):
+            path, = glob.glob(os.path.join(self.archive_dir, f'*-{dataset}.jsonl.gz'))
+            call_command('import_chat_data', dataset, path, stdout=io.StringIO())
+        self.assertEqual(list(messages.all()), original)
+
+    def test_dry_run_only_counts(self):
+        self.conversation(timedelta(hours=25))
+        self.conversation(timedelta(days=40), last_message=timedelta(days=40))
+        output = self.apply(dry_run=True)
+        self.assertIn("1 greeting-only conversations would be deleted.", output)
+        self.assertIn("1 inactive conversations would be archived.", output)
+        self.assertEqual(Conversation.objects.count(), 2)
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_zero_turns_a_policy_off(self):
+        self.conversation(timedelta(hours=25))
+        self.conversation(timedelta(days=40), last_message=timedelta(days=40))
+        self.apply(empty_hours=0, archive_days=0)
+        self.assertEqual(Conversation.objects.count(), 2)
+
+
+class StaticFilesTests(SimpleTestCase):
+    """The manifest storage used in production (tests default to plain
+    StaticFilesStorage, which needs no collectstatic)."""
+
+    def setUp(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        storage = self.settings(STATIC_ROOT=static_root, STORAGES={
+            **settings.STORAGES,
+            'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+        })
+        storage.enable()
+        self.addCleanup(storage.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_hashed_files_are_served_compressed_and_immutable(self):
+        url = static('style.css')
+        self.assertRegex(url, r'^/static/style\.[0-9a-f]{12}\.css$')
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        # url() references in the stylesheet point at hashed names too.
+        body = gzip.decompress(b''.join(response.streaming_content))
+        self.assertIn(static('img/rocket-opacity.png').encode(), body)
+        self.assertRegex(static('img/rocket-opacity.png'), r'\.[0-9a-f]{12}\.png$')
+
+
+class HungProvider(BaseHTTPRequestHandler):
+    """An OpenAI-compatible endpoint that accepts requests and never answers."""
+
+    hits = []
+
+    def do_POST(self):
+        self.hits.append(self.path)
+        time.sleep(3)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LLMRoutingTests(TestCase):
+    backends = {
+        'down': {'BACKEND': 'backend.tests.FailingBackend'},
+        'empty': {'BACKEND': 'backend.tests.EmptyBackend'},
+        'busy': {'BACKEND': 'backend.llm_backends.FakeBackend', 'MAX_CONCURRENCY': 1},
+        'fake': {'BACKEND': 'backend.llm_backends.FakeBackend'},
+    }
+    messages = [{'role': 'user', 'content': "Hej"}]
+
+    def setUp(self):
+        overrides = fake_backends(**self.backends)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(llm_backends.get_backend.cache_clear)
+        self.character, _ = make_chat()
+
+    def complete(self, route):
+        self.character.llm_backends = route
+        with metrics.llm_call() as call:
+            return llm_backends.complete(self.character, self.messages, call), call.backend
+
+    def stream(self, route):
+        self.character.llm_backends = route
+        with metrics.llm_call(stream=True) as call:
+            return ''.join(llm_backends.stream(self.character, self.messages, call)), call.backend
+
+    def route(self, stream=False):
+        return [backend.name for backend in llm_backends.route_for(self.character, stream)]
+
+    def test_falls_back_and_cools_down_failed_backend(self):
+        with self.assertLogs('backend.llm_backends', 'WARNING'):
+            text, backend = self.complete('down,fake')
+        self.assertEqual(backend, 'fake')
+        self.assertTrue(text)
+        self.assertTrue(llm_backends.get_backend('down').stats()['cooling_down'])
+        self.assertEqual(self.route(), ['fake', 'down'])
+
+    def test_cooldown_expires(self):
+        with self.settings(LLM_FALLBACK_COOLDOWN=0), self.assertLogs('backend.llm_backends', 'WARNING'):
+            self.complete('down,fake')
+        self.assertFalse(llm_backends.get_backend('down').stats()['cooling_down'])
+        self.assertEqual(self.route(), ['down', 'fake'])
+
+    def test_skips_busy_backend(self):
+        busy = llm_backends.get_backend('busy')
+        self.assertTrue(busy.try_acquire())
+        self.addCleanup(busy.release)
+        self.assertEqual(self.complete('busy,fake')[1], 'fake')
+        self.assertEqual(busy.stats()['in_flight'], 1)
+        self.assertFalse(busy.stats()['cooling_down'])
+        with self.assertRaisesMessage(llm_backends.BackendUnavailable, "busy"):
+            self.complete('busy')
+
+    def test_stream_without_tokens_is_a_failure(self):
+        with self.assertLogs('backend.llm_backends', 'WARNING') as logs:
+            text, backend = self.stream('empty,fake')
+        self.assertEqual(backend, 'fake')
+        self.assertTrue(text)
+        self.assertIn("empty sent no tokens", logs.output[0])
+        self.assertTrue(llm_backends.get_backend('empty').stats()['cooling_down'])
+        with self.assertLogs('backend.llm_backends', 'WARNING'), \
+                self.assertRaises(llm_backends.EmptyStream):
+            self.stream('empty')
+
+    def test_async_stream_without_tokens_falls_back(self):
+        self.character.llm_backends = 'empty,fake'
+
+        async def stream():
+            with metrics.llm_call(stream=True) as call:
+                return [delta async for delta in llm_backends.astream(self.character, self.messages, call)], call
+
+        with self.assertLogs('backend.llm_backends', 'WARNING'):
+            deltas, call = async_to_sync(stream)()
+        self.assertTrue(deltas)
+        self.assertEqual(call.backend, 'fake')
+
+    def test_hung_backend_gets_attempt_timeout_without_retries(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), HungProvider)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        hung = {
+            'BACKEND': 'backend.llm_backends.OpenAIBackend',
+            'BASE_URL': f"http://127.0.0.1:{server.server_port}/v1",
+            'API_KEY': 'test',
+        }
+        for send in (self.complete, self.stream):
+            with self.subTest(send.__name__), fake_backends(hung=hung, fake=self.backends['fake']), \
+                    self.settings(LLM_ATTEMPT_TIMEOUT=0.2, OPENAI_TIMEOUT=60, OPENAI_MAX_RETRIES=2), \
+                    self.assertLogs('backend.llm_backends', 'WARNING'):
+                HungProvider.hits.clear()
+                started = time.monotonic()
+                text, backend = send('hung,fake')
+                self.assertLess(time.monotonic() - started, 2)
+                self.assertEqual((backend, bool(text)), ('fake', True))
+                self.assertEqual(HungProvider.hits, ['/v1/chat/completions'])
+                self.assertEqual(self.route(), ['fake', 'hung'])
+
+    def test_completion_time_and_ttft_are_tracked_apart(self):
+        fake = llm_backends.get_backend('fake')
+        self.complete('fake')
+        self.assertIsNotNone(fake.stats()['completion_ms'])
+        self.assertIsNone(fake.stats()['ttft_ms'])
+        self.stream('fake')
+        self.assertIsNotNone(fake.stats()['ttft_ms'])
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.character, self.conversation = make_chat()
+        self.other, other_conversation = make_chat()
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, is_user=True, content="Plan marketingowy sklepu"),
+            Message.objects.create(conversation=self.conversation, is_user=False, content="Plan finansowy na rok"),
+            Message.objects.create(conversation=other_conversation, is_user=True, content="Plan podróży"),
+        ]
+
+    def found(self, query, **filters):
+        return [msg.id for msg in search.search(query, **filters)[0]]
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        marketing, finance, _ = self.messages
+        self.assertEqual(self.found("marketingowy"), [marketing.id])
+        finance.content = "Budżet marketingowy"
+        finance.save()
+        self.assertEqual(self.found("marketingowy"), [finance.id, marketing.id])
+        self.assertEqual(self.found("finansowy"), [])
+        marketing.delete()
+        self.assertEqual(self.found("marketingowy"), [finance.id])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.found("plan finansowy"), [self.messages[1].id])
+        # Query syntax in user input is matched as plain words, not an error.
+        self.assertEqual(self.found('plan "OR'), [])
+
+    def test_filters(self):
+        marketing, finance, travel = self.messages
+        self.assertEqual(self.found("plan", character_id=self.character.id), [finance.id, marketing.id])
+        self.assertEqual(self.found("plan", is_user=True), [travel.id, marketing.id])
+        Message.objects.filter(id=marketing.id).update(timestamp=marketing.timestamp - timedelta(days=2))
+        day_ago = now() - timedelta(days=1)
+        self.assertEqual(self.found("plan", since=day_ago), [travel.id, finance.id])
+        self.assertEqual(self.found("plan", until=day_ago), [marketing.id])
+
+    def test_keyset_pagination(self):
+        with self.settings(CHAT_SEARCH_PAGE_SIZE=2):
+            first, cursor = search.search("plan")
+            self.assertEqual([msg.id for msg in first], [self.messages[2].id, self.messages[1].id])
+            self.assertEqual(cursor, first[-1].id)
+            last, cursor = search.search("plan", before=cursor)
+        self.assertEqual([msg.id for msg in last], [self.messages[0].id])
+        self.assertIsNone(cursor)
+
+    def test_api_is_staff_only(self):
+        self.assertEqual(self.client.get(reverse('message_search_api'), {'q': "plan"}).status_code, 302)
+        staff = User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('message_search_api'), {'q': "plan", 'who': 'ai'})
+        self.assertEqual([msg['id'] for msg in response.json()['messages']], [self.messages[1].id])
+        self.assertEqual(self.client.get(reverse('message_search_api'), {'q': ""}).status_code, 400)
+
+
+class AdmissionTests(ChatTestMixin, TestCase):
+    def send(self, name='chat_api'):
+        return self.post_json(name, character_id=self.character.id, message="Hej")
+
+    def in_flight(self):
+        return cache.get('admission:in_flight')
+
+    def test_client_over_rate_gets_429_with_retry_after(self):
+        with self.settings(CHAT_RATE_CLIENT=(60, 2)):
+            self.assertEqual(self.send().status_code, 200)
+            self.assertEqual(self.send().status_code, 200)
+            with self.assertNumQueries(0):
+                response = self.send()
+            page = self.client.post(reverse('chat'), {'character_id': self.character.id, 'content': "Hej"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json(), {'error': admission.REJECTED_MESSAGE})
+        self.assertEqual(page.status_code, 429)
+        self.assertEqual(page['Content-Type'], 'text/plain; charset=utf-8')
+
+    def test_clients_have_separate_buckets(self):
+        def send(**meta):
+            body = json.dumps({'character_id': self.character.id, 'message': "Hej"})
+            return self.client.post(reverse('chat_api'), body, content_type='application/json', **meta).status_code
+
+        with self.settings(CHAT_RATE_CLIENT=(60, 1), CHAT_CLIENT_IP_HEADER='HTTP_X_REAL_IP'):
+            self.assertEqual(send(HTTP_X_REAL_IP='10.0.0.1'), 200)
+            self.assertEqual(send(HTTP_X_REAL_IP='10.0.0.1'), 429)
+            self.assertEqual(send(HTTP_X_REAL_IP='10.0.0.2'), 200)
+            # Only the address appended by the proxy counts.
+            self.assertEqual(send(HTTP_X_REAL_IP='10.0.0.3, 10.0.0.1'), 429)
+        with self.settings(CHAT_RATE_CLIENT=(60, 1)):
+            self.assertEqual(send(REMOTE_ADDR='10.0.1.1'), 200)
+            self.assertEqual(send(REMOTE_ADDR='10.0.1.2'), 200)
+            self.assertEqual(send(REMOTE_ADDR='10.0.1.1'), 429)
+
+    def test_stream_holds_its_slot_until_it_ends(self):
+        with self.settings(CHAT_MAX_IN_FLIGHT=1):
+            stream = self.send('chat_stream_api')
+            self.assertEqual(self.in_flight(), 1)
+            rejected = self.send()
+            self.assertEqual(rejected.status_code, 429)
+            self.assertEqual(rejected['Retry-After'], '1')
+            self.assertIn(b'"done": true', b''.join(stream.streaming_content))
+            self.assertEqual(self.in_flight(), 0)
+            self.assertEqual(self.send().status_code, 200)
+        self.assertEqual(self.in_flight(), 0)
+
+    def test_each_request_extends_the_in_flight_counter(self):
+        ttl = 300
+        with self.settings(CHAT_MAX_IN_FLIGHT=10, CHAT_IN_FLIGHT_TTL=ttl):
+            with mock.patch('time.time', return_value=1000.0):
+                admission.acquire_slot()
+            with mock.patch('time.time', return_value=1000.0 + ttl - 1):
+                admission.acquire_slot()
+            with mock.patch('time.time', return_value=1000.0 + ttl + 1):
+                self.assertEqual(self.in_flight(), 2)
+            with mock.patch('time.time', return_value=1000.0 + 2 * ttl):
+                self.assertIsNone(self.in_flight())
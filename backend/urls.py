@@ -1,13 +1,28 @@
+from django.conf import settings
 from django.urls import path
 from . import views
-from .views import chat_api_view
+
+if settings.CHAT_ASYNC_VIEWS:
+    from . import async_views as chat_views
+else:
+    chat_views = views
 
 
 urlpatterns = [
     path('', views.character_list, name='character_list'),
-    path('chat/', views.chat_view, name='chat'),
+    path('chat/', chat_views.chat_view, name='chat'),
+    path('avatar/<int:character_id>/', views.external_avatar_view, name='external_avatar'),
+    path('avatar/<int:character_id>/<str:name>', views.external_avatar_file_view, name='external_avatar_file'),
     path('admin/characters/', views.admin_character_list, name='admin_character_list'),
     path('admin/characters/add/', views.admin_character_form, name='add_character'),
     path('admin/characters/<int:id>/edit/', views.admin_character_form, name='edit_character'),
-    path('api/chat/', chat_api_view, name='chat_api'),
+    path('admin/completion-cache/', views.admin_completion_cache_stats, name='completion_cache_stats'),
+    path('admin/llm-backends/', views.admin_llm_backends_stats, name='llm_backends_stats'),
+    path('admin/metrics/', views.admin_metrics, name='metrics'),
+    path('admin/search/', views.admin_message_search, name='message_search'),
+    path('api/admin/search/', views.admin_message_search_api, name='message_search_api'),
+    path('api/chat/', chat_views.chat_api_view, name='chat_api'),
+    path('api/chat/stream/', chat_views.chat_stream_api_view, name='chat_stream_api'),
+    path('api/chat/history/', chat_views.chat_history_api_view, name='chat_history_api'),
+    path('api/chat/jobs/<int:job_id>/', chat_views.chat_job_api_view, name='chat_job_api'),
 ]
@@ -1,25 +1,25 @@
-import os
 import json
-from typing import List
+import logging
+from typing import Iterator, List, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import JsonResponse
+from django.contrib.auth.views import redirect_to_login
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.templatetags.static import static
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
 from django.utils.timezone import now
-from django.views.decorators.http import require_POST
-from dotenv import load_dotenv
-from openai import OpenAI
+from django.views.decorators.http import require_GET, require_POST
 
+from . import admission, avatar_proxy, avatars, catalog, chat, chat_export, completion_cache, history, jobs, llm_backends, metrics, search
 from .forms import CharacterForm, MessageForm
-from .models import Character, Conversation, Message
+from .models import Character, CompletionJob, Conversation, Message
 
 
-load_dotenv()
-
-
-def get_openai_client():
-    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
+logger = logging.getLogger(__name__)
 
 def staff_required(view):
     return login_required(user_passes_test(lambda u: u.is_active and u.is_staff)(view))
@@ -39,21 +39,52 @@ def _create_greeting(conversation: Conversation, character: Character) -> None:
         )
 
 
-def _get_or_create_conversation(request, character: Character) -> Conversation:
-    session_key = _conversation_session_key(character.id)
-    conversation_id = request.session.get(session_key)
-    conversation = None
-    if conversation_id:
-        try:
-            conversation = Conversation.objects.get(id=conversation_id, character=character)
-        except Conversation.DoesNotExist:
-            conversation = None
-
+def _parse_id(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Served by prompts.for_character from its per-process cache instead.
+CHARACTER_PROMPT_TEXT = ('character__description', 'character__compiled_prompt')
+
+
+def _find_conversation(character_id: int, *conversation_ids) -> Optional[Conversation]:
+    """The first of ``conversation_ids`` that belongs to the character,
+    loaded together with it in a single query."""
+    ids = [conversation_id for conversation_id in map(_parse_id, conversation_ids) if conversation_id]
+    if not ids:
+        return None
+    conversations = Conversation.objects.select_related('character').defer(*CHARACTER_PROMPT_TEXT)
+    found = {
+        conversation.id: conversation
+        for conversation in conversations.filter(id__in=ids, character_id=character_id)
+    }
+    return next((found[conversation_id] for conversation_id in ids if conversation_id in found), None)
+
+
+def _load_chat(request, character_id, conversation_id=None) -> Tuple[Character, Optional[Conversation]]:
+    """Character and its conversation: the requested one, else the one in
+    the session. One query when a conversation is found."""
+    character_id = _parse_id(character_id)
+    if character_id is None:
+        raise Http404
+    session_id = request.session.get(_conversation_session_key(character_id))
+    conversation = _find_conversation(character_id, conversation_id, session_id)
     if conversation is None:
-        conversation = Conversation.objects.create(character=character)
-        _create_greeting(conversation, character)
-        request.session[session_key] = conversation.id
-
+        return get_object_or_404(Character, id=character_id), None
+    if conversation.id != _parse_id(session_id):
+        _ensure_conversation_in_session(request, conversation)
+    return conversation.character, conversation
+
+
+def _start_conversation(request, character: Character) -> Conversation:
+    # Conversations are only written with the first user message, so page
+    # views that never turn into a chat leave nothing behind.
+    conversation = Conversation.objects.create(character=character)
+    _create_greeting(conversation, character)
+    request.session[_conversation_session_key(character.id)] = conversation.id
     return conversation
 
 
@@ -62,88 +93,77 @@ def _ensure_conversation_in_session(request, conversation: Conversation) -> None
     request.session[session_key] = conversation.id
 
 
-MAX_HISTORY_LENGTH = 12
+def character_list(request):
+    # The catalog is passed uncalled: the template only resolves it when the
+    # cached tiles fragment has to be re-rendered.
+    with metrics.rendering():
+        return render(request, 'character_list.html', {
+            'characters': catalog.get_catalog,
+            'catalog_version': catalog.version(),
+            'catalog_timeout': catalog.timeout(),
+        })
 
 
-def _build_message_payload(conversation: Conversation, character: Character) -> List[dict]:
-    history = list(
-        conversation.messages.order_by('-timestamp')[:MAX_HISTORY_LENGTH]
-    )
-    history.reverse()
+def _chat_context(character: Character, conversation: Optional[Conversation], messages, history_cursor) -> dict:
+    avatar_src, avatar_srcset = avatars.avatar_sources(character)
+    return {
+        'character': character,
+        'avatar_src': avatar_src,
+        'avatar_srcset': avatar_srcset,
+        'messages': messages,
+        'history_cursor': history_cursor,
+        'form': MessageForm(),
+        'conversation_id': conversation.id if conversation else '',
+        'job_mode': jobs.job_mode_enabled(),
+        'hide_navbar': True,
+    }
 
-    messages = [{"role": "system", "content": character.description}]
-    for msg in history:
-        role = "user" if msg.is_user else "assistant"
-        messages.append({"role": role, "content": msg.content})
-    return messages
 
+def _greeting_preview(character: Character) -> List[Message]:
+    """The greeting of a conversation that doesn't exist yet (unsaved)."""
+    greeting_text = character.greeting or character.header_description
+    return [Message(is_user=False, content=greeting_text)] if greeting_text else []
 
-def character_list(request):
-    characters = Character.objects.all()
-    return render(request, 'character_list.html', {'characters': characters})
+
+def _render_chat(request, character: Character, conversation: Optional[Conversation], **extra):
+    # Only the newest page; older ones come from chat_history_api_view.
+    if conversation is None:
+        messages, history_cursor = _greeting_preview(character), None
+    else:
+        messages, history_cursor = history.history_page(conversation.id)
+    template_context = _chat_context(character, conversation, messages, history_cursor)
+    template_context.update(extra)
+    with metrics.rendering():
+        return render(request, 'chat.html', template_context)
 
 
+# The chat views must never wrap the model call in a transaction, even
+# with ATOMIC_REQUESTS.
+@transaction.non_atomic_requests
+@admission.limit_chat(api=False)
 def chat_view(request):
     if request.method == 'POST':
-        conv_id = request.POST.get('conversation_id')
-        character_id = request.POST.get('character_id')
-        character = get_object_or_404(Character, id=character_id)
-        
-        conversation = None
-        if conv_id:
-            conversation = Conversation.objects.filter(id=conv_id, character=character).first()
-        if conversation is None:
-            conversation = _get_or_create_conversation(request, character)
-        else:
-            _ensure_conversation_in_session(request, conversation)
-        
+        character, conversation = _load_chat(
+            request, request.POST.get('character_id'), request.POST.get('conversation_id'),
+        )
+
         form = MessageForm(request.POST)
         if form.is_valid():
+            if conversation is None:
+                conversation = _start_conversation(request, character)
             user_message = form.save(commit=False)
             user_message.conversation = conversation
             user_message.is_user = True
-            user_message.save()
 
-            try:
-                client = get_openai_client()
-                payload = _build_message_payload(conversation, character)
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=payload,
-                )
-                ai_response = response.choices[0].message.content.strip()
-            except Exception as e:
-                print("GPT ERROR:", e)
-                ai_response = "Wystąpił błąd podczas komunikacji z GPT."
-
-            Message.objects.create(
-                conversation=conversation,
-                is_user=False,
-                content=ai_response
-            )
-
-        messages = conversation.messages.all()
-        return render(request, 'chat.html', {
-            'character': character,
-            'messages': messages,
-            'form': MessageForm(),
-            'conversation_id': conversation.id,
-            'hide_navbar': True
-        })
+            payload = chat.build_message_payload(conversation, character, user_message)
+            ai_response = chat.complete(character, payload, "Wystąpił błąd podczas komunikacji z GPT.")
+            chat.save_turn(user_message, ai_response)
+
+        return _render_chat(request, character, conversation)
 
     else:
-        character_id = request.GET.get('character_id')
-        character = get_object_or_404(Character, id=character_id)
-        conversation = _get_or_create_conversation(request, character)
-        messages = conversation.messages.all()
-        return render(request, 'chat.html', {
-            'character': character,
-            'messages': messages,
-            'form': MessageForm(),
-            'conversation_id': conversation.id,
-            'timestamp': now().timestamp(),
-            'hide_navbar': True
-        })
+        character, conversation = _load_chat(request, request.GET.get('character_id'))
+        return _render_chat(request, character, conversation, timestamp=now().timestamp())
 
 @staff_required
 def admin_character_form(request, id=None):
@@ -166,59 +186,331 @@ def admin_character_form(request, id=None):
 
 @staff_required
 def admin_character_list(request):
-    characters = Character.objects.all()
+    characters = catalog.get_catalog()
     return render(request, 'admin_character_list.html', {'characters': characters})
 
-@require_POST
-def chat_api_view(request):
+@staff_required
+def admin_completion_cache_stats(request):
+    return JsonResponse(completion_cache.stats())
+
+@staff_required
+def admin_llm_backends_stats(request):
+    return JsonResponse(llm_backends.stats())
+
+def _external_avatar(character_id: int) -> Character:
+    character = get_object_or_404(
+        Character.objects.only('id', 'avatar', 'avatar_url', 'avatar_variants'), id=character_id,
+    )
+    if character.avatar or not character.avatar_url:
+        raise Http404
+    return character
+
+
+@require_GET
+def admin_metrics(request):
+    """Prometheus scrape endpoint: staff session or ``Bearer METRICS_TOKEN``."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    scraper = token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not (scraper or (request.user.is_active and request.user.is_staff)):
+        return redirect_to_login(request.get_full_path())
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_GET
+def external_avatar_view(request, character_id: int):
+    """Redirect to the local copy of ``avatar_url``. Until the first fetch
+    (started in the background) finishes, redirect to the default avatar."""
+    character = _external_avatar(character_id)
+    variants = character.avatar_variants
+    fetched = variants.get('source') == character.avatar_url
+    if not fetched or avatar_proxy.is_stale(variants):
+        avatar_proxy.schedule_refresh(character.id)
+
+    if avatars.is_external_copy(variants, character.avatar_url):
+        response = redirect(avatars.external_file_url(character.id, variants['jpeg']))
+    else:
+        response = redirect(static(avatars.DEFAULT_AVATAR))
+    if fetched:
+        patch_cache_control(response, public=True, max_age=300)
+    else:
+        # The copy is on its way: don't let the browser keep the placeholder.
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
+@require_GET
+def external_avatar_file_view(request, character_id: int, name: str):
+    character = _external_avatar(character_id)
+    variants = character.avatar_variants
+    stored = None
+    if avatars.is_external_copy(variants, character.avatar_url):
+        stored = avatar_proxy.open_variant(variants, name)
+    if stored is None:
+        # Superseded by a refresh (or never fetched): go through the redirect.
+        return redirect('external_avatar', character_id=character.id)
+
+    if avatar_proxy.is_stale(variants):
+        avatar_proxy.schedule_refresh(character.id)
+    response = FileResponse(stored, content_type='image/webp' if name.endswith('.webp') else 'image/jpeg')
+    patch_cache_control(response, public=True, max_age=31536000, immutable=True)
+    return response
+
+
+class ChatRequestError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _parse_chat_api_payload(body: bytes) -> Tuple[int, Optional[int], str]:
+    """``conversation_id`` is None for the first message of a new chat."""
     try:
-        data = json.loads(request.body)
+        data = json.loads(body)
     except json.JSONDecodeError:
-        return JsonResponse({'error': 'Nieprawidłowe dane'}, status=400)
+        raise ChatRequestError('Nieprawidłowe dane')
 
     character_id = data.get('character_id')
     conversation_id = data.get('conversation_id')
     user_text = (data.get('message') or '').strip()
 
-    if not character_id or not conversation_id or not user_text:
-        return JsonResponse({'error': 'Brak wymaganych danych'}, status=400)
+    if not character_id or not user_text:
+        raise ChatRequestError('Brak wymaganych danych')
 
     if len(user_text) > 2000:
-        return JsonResponse({'error': 'Wiadomość jest za długa'}, status=400)
+        raise ChatRequestError('Wiadomość jest za długa')
 
     try:
         character_id = int(character_id)
     except (TypeError, ValueError):
-        return JsonResponse({'error': 'Nieprawidłowe ID postaci'}, status=400)
+        raise ChatRequestError('Nieprawidłowe ID postaci')
+
+    if conversation_id in (None, ''):
+        conversation_id = None
+    else:
+        try:
+            conversation_id = int(conversation_id)
+        except (TypeError, ValueError):
+            raise ChatRequestError('Nieprawidłowe ID konwersacji')
+
+    return character_id, conversation_id, user_text
+
+
+def _authorize_conversation(session_conversation_id, conversation_id: int) -> None:
+    if session_conversation_id is None or conversation_id != int(session_conversation_id):
+        raise ChatRequestError('Nieautoryzowany dostęp do konwersacji', status=403)
+
 
-    character = get_object_or_404(Character, id=character_id)
-    session_key = _conversation_session_key(character.id)
-    session_conversation_id = request.session.get(session_key)
+def _parse_chat_api_request(request) -> Tuple[Character, Conversation, Message]:
+    """Returns the turn's user message unsaved; ``chat.save_turn`` stores it
+    with the answer."""
+    character_id, conversation_id, user_text = _parse_chat_api_payload(request.body)
 
+    session_id = request.session.get(_conversation_session_key(character_id))
+    if conversation_id is None:
+        conversation = _find_conversation(character_id, session_id)
+        if conversation is None:
+            character = get_object_or_404(Character, id=character_id)
+            conversation = _start_conversation(request, character)
+    else:
+        _authorize_conversation(session_id, conversation_id)
+        conversation = _find_conversation(character_id, conversation_id)
+        if conversation is None:
+            raise Http404
+
+    user_message = Message(conversation=conversation, is_user=True, content=user_text)
+    return conversation.character, conversation, user_message
+
+
+def _with_conversation(response, conversation: Conversation):
+    # Tells a page opened without a conversation which one it now talks to.
+    response['X-Conversation-Id'] = str(conversation.id)
+    return response
+
+
+def _enqueue_completion(user_message: Message, character: Character) -> CompletionJob:
+    # The worker reads the history, so the message goes in with the job.
+    with transaction.atomic():
+        user_message.save()
+        return CompletionJob.objects.create(conversation=user_message.conversation, character=character)
+
+
+@transaction.non_atomic_requests
+@require_POST
+@admission.limit_chat()
+def chat_api_view(request):
+    try:
+        character, conversation, user_message = _parse_chat_api_request(request)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+
+    if jobs.job_mode_enabled():
+        job = _enqueue_completion(user_message, character)
+        return _with_conversation(JsonResponse(jobs.serialize(job), status=202), conversation)
+
+    payload = chat.build_message_payload(conversation, character, user_message)
+    ai_text = chat.complete(character, payload, "Wystąpił błąd po stronie serwera.")
+    chat.save_turn(user_message, ai_text)
+
+    return _with_conversation(JsonResponse({'response': ai_text}), conversation)
+
+
+@require_GET
+def chat_job_api_view(request, job_id: int):
+    job = get_object_or_404(CompletionJob.objects.select_related('response'), id=job_id)
+    session_key = _conversation_session_key(job.character_id)
+    try:
+        _authorize_conversation(request.session.get(session_key), job.conversation_id)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    return JsonResponse(jobs.serialize(job))
+
+
+def _parse_history_request(request) -> Tuple[int, int, Optional[str]]:
     try:
-        conversation_id = int(conversation_id)
+        character_id = int(request.GET.get('character_id'))
+        conversation_id = int(request.GET.get('conversation_id'))
     except (TypeError, ValueError):
-        return JsonResponse({'error': 'Nieprawidłowe ID konwersacji'}, status=400)
+        raise ChatRequestError('Nieprawidłowe ID konwersacji')
+    before = request.GET.get('before') or None
+    if before:
+        try:
+            history.decode_cursor(before)
+        except ValueError:
+            raise ChatRequestError('Nieprawidłowy kursor')
+    return character_id, conversation_id, before
 
-    if session_conversation_id is None or conversation_id != int(session_conversation_id):
-        return JsonResponse({'error': 'Nieautoryzowany dostęp do konwersacji'}, status=403)
 
-    conversation = get_object_or_404(Conversation, id=conversation_id, character=character)
+@require_GET
+def chat_history_api_view(request):
+    try:
+        character_id, conversation_id, before = _parse_history_request(request)
+        session_key = _conversation_session_key(character_id)
+        _authorize_conversation(request.session.get(session_key), conversation_id)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+
+    messages, cursor = history.history_page(conversation_id, before)
+    return JsonResponse({
+        'messages': [history.serialize(msg) for msg in messages],
+        'next_cursor': cursor,
+    })
+
+
+SEARCH_WHO = {'user': True, 'ai': False}
+
+
+def _parse_search_request(request) -> dict:
+    """Keyword arguments of search.search() from the query string."""
+    params = request.GET
+    query = params.get('q', '').strip()
+    if not query:
+        raise ChatRequestError('Podaj szukany tekst')
+    if len(query) > 200:
+        raise ChatRequestError('Zapytanie jest za długie')
+    filters = {'query': query}
+    for name, key in (('character', 'character_id'), ('before', 'before')):
+        if params.get(name):
+            filters[key] = _parse_id(params[name])
+            if filters[key] is None:
+                raise ChatRequestError(f'Nieprawidłowy parametr {name}')
+    for name in ('since', 'until'):
+        if params.get(name):
+            try:
+                filters[name] = chat_export.parse_moment(params[name])
+            except ValueError:
+                raise ChatRequestError(f'Nieprawidłowa data: {name}')
+    if params.get('who'):
+        if params['who'] not in SEARCH_WHO:
+            raise ChatRequestError('Nieprawidłowy parametr who')
+        filters['is_user'] = SEARCH_WHO[params['who']]
+    return filters
 
-    Message.objects.create(conversation=conversation, is_user=True, content=user_text)
 
+@staff_required
+@require_GET
+def admin_message_search(request):
+    context = {'characters': catalog.get_catalog(), 'params': request.GET}
+    if 'q' in request.GET:
+        try:
+            messages, cursor = search.search(**_parse_search_request(request))
+        except ChatRequestError as e:
+            context['error'] = e.message
+        else:
+            context['results'] = messages
+            if cursor is not None:
+                next_params = request.GET.copy()
+                next_params['before'] = cursor
+                context['next_query'] = next_params.urlencode()
+    return render(request, 'admin_message_search.html', context)
+
+
+@staff_required
+@require_GET
+def admin_message_search_api(request):
     try:
-        client = get_openai_client()
-        payload = _build_message_payload(conversation, character)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=payload,
-        )
-        ai_text = response.choices[0].message.content.strip()
-    except Exception as e:
-        print("API error:", e)
-        ai_text = "Wystąpił błąd po stronie serwera."
+        messages, cursor = search.search(**_parse_search_request(request))
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    return JsonResponse({
+        'messages': [search.serialize(msg) for msg in messages],
+        'next_cursor': cursor,
+    })
+
+
+def _sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _stream_completion(character: Character, user_message: Message, payload: List[dict]) -> Iterator[str]:
+    """Relay completion chunks as SSE events, then store the turn."""
+    cached = completion_cache.lookup(character, payload)
+    if cached is not None:
+        metrics.record_cache_hit()
+        chat.save_turn(user_message, cached)
+        yield _sse_event({'delta': cached})
+        yield _sse_event({'done': True, 'error': False, 'response': cached})
+        return
+
+    chunks = []
+    try:
+        with metrics.llm_call(stream=True) as call:
+            for delta in llm_backends.stream(character, payload, call):
+                call.first_token()
+                chunks.append(delta)
+                yield _sse_event({'delta': delta})
+        if chunks:
+            completion_cache.store(character, payload, ''.join(chunks).strip())
+    except Exception:
+        logger.exception("Streamed completion failed for character %s, conversation %s (backend: %s)",
+                         character.id, user_message.conversation_id, call.backend)
+    finally:
+        # Runs also when the client disconnects mid-stream, so the partial
+        # answer still lands in the history.
+        ai_text = ''.join(chunks).strip()
+        if not ai_text:
+            ai_text = "Wystąpił błąd po stronie serwera."
+        chat.save_turn(user_message, ai_text)
+
+    yield _sse_event({'done': True, 'error': not chunks, 'response': ai_text})
+
+
+@transaction.non_atomic_requests
+@require_POST
+@admission.limit_chat()
+def chat_stream_api_view(request):
+    try:
+        character, conversation, user_message = _parse_chat_api_request(request)
+    except ChatRequestError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
 
-    Message.objects.create(conversation=conversation, is_user=False, content=ai_text)
+    payload = chat.build_message_payload(conversation, character, user_message)
 
-    return JsonResponse({'response': ai_text})
+    return _with_conversation(_sse_response(_stream_completion(character, user_message, payload)), conversation)
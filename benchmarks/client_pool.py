@@ -0,0 +1,73 @@
+"""
+Per-turn latency: a new OpenAI client per message vs the pooled client
+from ``backend.llm``.
+
+    python -m benchmarks.client_pool --turns 200
+
+Runs against the local stub server, so the gap is client construction plus
+TCP connect; against api.openai.com every fresh client also pays DNS and a
+TLS handshake, which widens it considerably.
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+import django
+from django.conf import settings
+
+from benchmarks.stub_openai import start_stub_server
+
+
+def _measure(get_client, turns):
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        client = get_client()
+        client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": "Cześć"}],
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def _report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<22} mean {statistics.mean(samples):7.2f} ms   "
+          f"p50 {statistics.median(samples):7.2f} ms   p95 {p95:7.2f} ms")
+    return statistics.mean(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI client pooling benchmark")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub latency in seconds")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(latency=args.latency)
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    settings.configure(OPENAI_BASE_URL=base_url, OPENAI_MAX_RETRIES=0)
+    django.setup()
+
+    from openai import OpenAI
+    from backend import llm
+
+    def fresh_client():
+        return OpenAI(api_key="benchmark", base_url=base_url, max_retries=0)
+
+    # Warm up imports and the stub before measuring.
+    _measure(llm.get_openai_client, 5)
+
+    fresh = _report("client per turn", _measure(fresh_client, args.turns))
+    pooled = _report("pooled client", _measure(llm.get_openai_client, args.turns))
+    print(f"saved per turn: {fresh - pooled:.2f} ms")
+
+    llm.close_clients()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
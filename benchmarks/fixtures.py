@@ -0,0 +1,61 @@
+"""
+Deterministic benchmark data: characters with long prompts and
+conversations with thousands of messages.
+
+The same ``seed`` always produces the same rows, so runs on a fresh
+database are comparable.
+"""
+
+import random
+from io import StringIO
+from typing import Dict, List
+
+from django.core.management import call_command
+from django.db import transaction
+
+from backend.context import count_tokens
+from backend.models import Character, Conversation, Message
+
+
+WORDS = (
+    "pomysł startup klient rynek produkt koszt przychód zespół inwestor plan "
+    "problem rozwiązanie konkurencja marża skala sprzedaż marketing użytkownik "
+    "wartość ryzyko test wynik dane model cena budżet termin cel strategia"
+).split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+@transaction.atomic
+def create_fixtures(characters: int = 10, conversations: int = 4, messages: int = 2000,
+                    seed: int = 0, batch_size: int = 1000) -> Dict[int, List[int]]:
+    """Returns ``{character_id: [conversation_id, ...]}``."""
+    rng = random.Random(seed)
+    created = {}
+    for i in range(characters):
+        character = Character.objects.create(
+            name=f"Postać {i}",
+            short_description=_text(rng, 12),
+            header_description=_text(rng, 20),
+            greeting=_text(rng, 15),
+            description=_text(rng, 400),
+        )
+        created[character.id] = []
+        for _ in range(conversations):
+            conversation = Conversation.objects.create(character=character)
+            created[character.id].append(conversation.id)
+            rows = []
+            for n in range(messages):
+                content = _text(rng, rng.randint(5, 80))
+                rows.append(Message(
+                    conversation=conversation,
+                    is_user=n % 2 == 1,
+                    content=content,
+                    token_count=count_tokens(content),
+                ))
+            Message.objects.bulk_create(rows, batch_size=batch_size)
+    # bulk_create skips Message.save(), which keeps the counters.
+    call_command('recount_conversation_stats', stdout=StringIO())
+    return created
@@ -0,0 +1,265 @@
+"""
+Concurrent load test of the chat path against the local stub OpenAI server.
+
+    python -m benchmarks.load --concurrency 8 --requests 200 --output bench.json
+    python -m benchmarks.load --compare bench.json --max-regression 0.15
+
+Each run migrates a fresh database (a temporary SQLite file unless
+``--database-url`` is given), loads the seeded fixtures and drives the
+scenarios through Django's test client from ``--concurrency`` threads, one
+session per thread; ``--llm fake`` replaces the stub server with the
+in-process ``FakeBackend`` (no HTTP client in the measurement). Every
+scenario reports throughput, p50/p95/p99 latency and DB queries per request. ``--compare`` exits with status 1
+when a scenario's p95 latency or throughput is worse than the baseline by
+more than ``--max-regression``, or when it runs more queries per request.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+from benchmarks.stub_openai import start_stub_server
+
+
+SCENARIOS = ('character_list', 'chat_get', 'chat_post', 'api_chat', 'api_chat_stream')
+
+
+def _configure(args, base_url, tmpdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai_assistant_project.settings')
+    os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmark')
+    os.environ['DJANGO_DEBUG'] = '0'
+    os.environ['DJANGO_STATIC_MANIFEST'] = '0'  # no collectstatic run
+    os.environ['DJANGO_ALLOWED_HOSTS'] = 'testserver'
+    os.environ['CHAT_RATE_CLIENT_PER_MINUTE'] = '0'  # every simulated user shares one address
+    os.environ['OPENAI_API_KEY'] = 'benchmark'
+    os.environ['OPENAI_MAX_RETRIES'] = '0'
+    if base_url:
+        os.environ['OPENAI_BASE_URL'] = base_url
+    else:
+        os.environ['LLM_FAKE'] = '1'
+        os.environ['LLM_DEFAULT_ROUTE'] = 'fake'
+        os.environ['LLM_FAKE_LATENCY'] = str(args.latency)
+        os.environ['LLM_FAKE_TOKEN_RATE'] = str(args.token_rate)
+        os.environ['LLM_FAKE_REPLY_TOKENS'] = str(args.reply_tokens)
+    # Only the request path is measured: no background summaries, no
+    # completion cache hits, no job queue, no per-request log lines.
+    os.environ['CHAT_SUMMARY_WORKERS'] = '0'
+    os.environ['CHAT_COMPLETION_CACHE_BACKEND'] = ''
+    os.environ['DJANGO_CHAT_JOBS'] = '0'
+    os.environ['REQUEST_METRICS_LOG_LEVEL'] = 'WARNING'
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        os.environ.pop('DATABASE_URL', None)
+        os.environ['DJANGO_DB_ENGINE'] = 'django.db.backends.sqlite3'
+        os.environ['DJANGO_DB_NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+    django.setup()
+
+
+class Worker:
+    """One browser: its own client and session, bound to one conversation."""
+
+    def __init__(self, character_id, conversation_id):
+        from django.test import Client
+
+        self.character_id = character_id
+        self.conversation_id = conversation_id
+        self.client = Client()
+        session = self.client.session
+        session[f"conversation_{character_id}"] = conversation_id
+        session.save()
+        self.turn = 0
+
+    def _message(self):
+        self.turn += 1
+        return f"Pytanie numer {self.turn}: jak zdobyć pierwszych klientów?"
+
+    def _api_payload(self):
+        return json.dumps({
+            'character_id': self.character_id,
+            'conversation_id': self.conversation_id,
+            'message': self._message(),
+        })
+
+    def run(self, scenario):
+        client = self.client
+        if scenario == 'character_list':
+            return client.get('/')
+        if scenario == 'chat_get':
+            return client.get('/chat/', {'character_id': self.character_id})
+        if scenario == 'chat_post':
+            return client.post('/chat/', {
+                'character_id': self.character_id,
+                'conversation_id': self.conversation_id,
+                'content': self._message(),
+            })
+        if scenario == 'api_chat':
+            return client.post('/api/chat/', self._api_payload(), content_type='application/json')
+        if scenario == 'api_chat_stream':
+            return client.post('/api/chat/stream/', self._api_payload(), content_type='application/json')
+        raise ValueError(scenario)
+
+
+def _timed_request(worker, scenario):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        try:
+            response = worker.run(scenario)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            ok = response.status_code < 400
+        except Exception as e:
+            print(f"{scenario}: {e!r}", file=sys.stderr)
+            ok = False
+        elapsed = time.perf_counter() - start
+    return elapsed, len(queries), ok
+
+
+def _run_scenario(scenario, workers, requests, warmup):
+    from django.db import close_old_connections
+
+    remaining = {'warmup': warmup, 'measured': requests}
+    lock = threading.Lock()
+    samples = []
+
+    def take(phase):
+        with lock:
+            if remaining[phase] <= 0:
+                return False
+            remaining[phase] -= 1
+            return True
+
+    def drive(worker, phase):
+        try:
+            while take(phase):
+                sample = _timed_request(worker, scenario)
+                if phase == 'measured':
+                    with lock:
+                        samples.append(sample)
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        list(executor.map(lambda worker: drive(worker, 'warmup'), workers))
+        start = time.perf_counter()
+        list(executor.map(lambda worker: drive(worker, 'measured'), workers))
+        duration = time.perf_counter() - start
+
+    latencies = sorted(elapsed for elapsed, _, _ in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(samples) / duration, 2),
+        'p50_ms': _percentile(latencies, 50),
+        'p95_ms': _percentile(latencies, 95),
+        'p99_ms': _percentile(latencies, 99),
+        'queries_per_request': round(sum(count for _, count, _ in samples) / len(samples), 2),
+    }
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile, in milliseconds."""
+    index = max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)
+    return round(sorted_values[index] * 1000, 2)
+
+
+def _report(results):
+    print(f"{'scenario':<16} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}")
+    for name, result in results.items():
+        print(f"{name:<16} {result['throughput_rps']:>8.1f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f} {result['queries_per_request']:>8.1f} {result['errors']:>7}")
+
+
+def _compare(results, config, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get('config') != config:
+        print("warning: baseline was recorded with a different configuration", file=sys.stderr)
+
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result['throughput_rps'] < before['throughput_rps'] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {before['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result['queries_per_request'] > before['queries_per_request'] + 0.5:
+            regressions.append(f"{name}: queries {before['queries_per_request']} -> {result['queries_per_request']}")
+        if result['errors'] > before['errors']:
+            regressions.append(f"{name}: errors {before['errors']} -> {result['errors']}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat path load test")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=20, help="unmeasured requests per scenario")
+    parser.add_argument('--characters', type=int, default=10)
+    parser.add_argument('--conversations', type=int, default=4, help="per character")
+    parser.add_argument('--messages', type=int, default=2000, help="per conversation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--llm', choices=('stub', 'fake'), default='stub',
+                        help="stub OpenAI server over HTTP or the in-process fake backend")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=0.0, help="stub tokens per second (0 = instant)")
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--database-url', help="benchmark this database instead of a temporary SQLite file "
+                                               "(it must be empty, the run migrates it and adds fixtures)")
+    parser.add_argument('--output', help="write results as JSON (a baseline for --compare)")
+    parser.add_argument('--compare', help="baseline JSON to gate regressions against")
+    parser.add_argument('--max-regression', type=float, default=0.10, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    server, base_url = None, None
+    if args.llm == 'stub':
+        server, base_url = start_stub_server(latency=args.latency, token_rate=args.token_rate,
+                                             reply_tokens=args.reply_tokens)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _configure(args, base_url, tmpdir)
+
+        from django.core.management import call_command
+        from benchmarks.fixtures import create_fixtures
+
+        call_command('migrate', verbosity=0)
+        created = create_fixtures(args.characters, args.conversations, args.messages, args.seed)
+        conversations = [(character_id, conversation_id)
+                         for character_id, ids in created.items() for conversation_id in ids]
+        workers = [Worker(*conversations[i % len(conversations)]) for i in range(args.concurrency)]
+
+        results = {}
+        for scenario in args.scenarios:
+            results[scenario] = _run_scenario(scenario, workers, args.requests, args.warmup)
+        if server:
+            server.shutdown()
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ('output', 'compare', 'max_regression', 'scenarios')}
+    _report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2)
+    if args.compare and not _compare(results, config, args.compare, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
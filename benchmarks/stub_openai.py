@@ -0,0 +1,144 @@
+"""
+Minimal OpenAI-compatible server for local benchmarks.
+
+Answers ``POST /v1/chat/completions`` over HTTP/1.1 keep-alive, so
+client-side connection reuse is measurable. ``--latency`` is the wait before
+the first token, ``--token-rate`` the tokens per second after it (0 sends
+them all at once); ``"stream": true`` requests get SSE chunks paced at that
+rate, with a usage chunk when ``stream_options.include_usage`` is set.
+
+    python -m benchmarks.stub_openai --port 8765 --latency 0.3 --token-rate 50
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle, islice
+
+
+DEFAULT_REPLY = "Dzień dobry, w czym mogę pomóc?"
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    token_rate = 0.0
+    tokens = DEFAULT_REPLY.split(" ")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        usage = {
+            "prompt_tokens": len(json.dumps(request.get("messages", []), ensure_ascii=False)) // 4,
+            "completion_tokens": len(self.tokens),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if self.latency:
+            time.sleep(self.latency)
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self._stream(request.get("model", "stub"), usage if include_usage else None)
+            return
+
+        if self.token_rate:
+            time.sleep(len(self.tokens) / self.token_rate)
+        self._send_json(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(self.tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _stream(self, model, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(choices, **extra):
+            return json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }, ensure_ascii=False)
+
+        for i, token in enumerate(self.tokens):
+            if i and self.token_rate:
+                time.sleep(1 / self.token_rate)
+            text = token if i == 0 else " " + token
+            self._send_event(chunk([{"index": 0, "delta": {"content": text}, "finish_reason": None}]))
+        self._send_event(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if usage:
+            self._send_event(chunk([], usage=usage))
+        self._send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_event(self, data):
+        event = f"data: {data}\n\n".encode()
+        self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host="127.0.0.1", port=0, latency=0.0, token_rate=0.0, reply_tokens=None):
+    """Run the stub in a daemon thread; returns (server, base_url).
+
+    ``reply_tokens`` sets the answer length in words (tokens); by default
+    the answer is a short greeting.
+    """
+    attrs = {"latency": latency, "token_rate": token_rate}
+    if reply_tokens:
+        attrs["tokens"] = list(islice(cycle(DEFAULT_REPLY.split(" ")), reply_tokens))
+    handler = type("ConfiguredStubHandler", (StubOpenAIHandler,), attrs)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, default=None, help="answer length in tokens")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.host, args.port, args.latency, args.token_rate, args.reply_tokens)
+    print(f"Stub OpenAI server on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()